@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Parser benchmark"""
+# Times the stages of the parsing pipeline on synthetic maps built by
+# mapgen.py. The results can be saved as a baseline, later runs are compared
+# against it and fail when a stage got slower than the allowed threshold, so
+# performance work on the parser can be measured without any real maps.
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import config
+import main
+import mapgen
+
+# name -> mapgen.build_map() arguments
+SCENARIOS = {
+    "small": {},
+    "many_members": {"extra_members": 500, "member_size": 1024},
+    "large_members": {"extra_members": 8, "member_size": 256 << 10},
+    "deep_paths": {"extra_members": 100, "subdirectories": 8},
+    "string_table": {"string_table_size": 50000},
+    "bzip2": {"extra_members": 8, "compression": "bzip2"},
+    "pkware": {"extra_members": 8, "compression": "pkware"},
+    "uncompressed": {"extra_members": 8, "compression": "none"},
+    "encrypted": {"extra_members": 8, "encrypted": True},
+    "single_unit": {"extra_members": 8, "single_unit": True},
+    "padded_hash_table": {"extra_members": 8, "hash_padding": 4000},
+    "swapped_listfile": {"listfile": "swapped"},
+    "missing_listfile": {"listfile": "missing"},
+    "reforged": {"version": 31, "players": 24},
+    "doodads": {"doodads": 20000},
+    "dropping_doodads": {"doodads": 20000, "doodad_drops": True},
+    "big_script": {"script_functions": 20000},
+}
+
+STAGES = ("valid_map", "extract_members", "read_string_file", "read_map",
+          "route")
+
+
+def best_time(function, min_time=0.2, repeat=5):
+    """
+    Returns the best per call time out of repeat runs, each run calls the
+    function as many times as it takes to last at least min_time. The
+    first call isn't timed, it starts the sandbox processes and whatever
+    else is started lazily.
+    """
+    function()
+
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for i in range(number):
+            function()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed / number
+    for i in range(repeat - 1):
+        started = time.perf_counter()
+        for j in range(number):
+            function()
+        best = min(best, (time.perf_counter() - started) / number)
+
+    return best
+
+
+def extract_members(map_buffer):
+    """
+    Opens the map's archive and decompresses its MAP_MEMBERS like read_map()
+    does, returns them by name.
+    """
+    members = main.ArchiveMembers(main.open_map_archive(map_buffer)[0])
+    return dict((name, members[name]) for name in main.MAP_MEMBERS)
+
+
+def bench_scenario(map_bytes, min_time, repeat):
+    """Returns the best time of every stage for the given map."""
+    map_buffer = memoryview(map_bytes)
+    members = extract_members(map_buffer)
+    client = main.KRAFTVER.test_client()
+
+    def post():
+        client.post('/', data={'map': (io.BytesIO(map_bytes), 'bench.w3x')})
+
+    stages = {
+        "valid_map": lambda: main.valid_map(map_buffer),
+        "extract_members": lambda: extract_members(map_buffer),
+        # the strings are looked up too, the table is indexed lazily
+        "read_string_file":
+            lambda: main.read_string_file(members['war3map.wts'])[
+                'TRIGSTR_004'],
+        "read_map": lambda: main.read_map(map_buffer),
+        "route": post,
+    }
+
+    return dict((stage, best_time(stages[stage], min_time, repeat))
+                for stage in STAGES)
+
+
+def compare(results, baseline, threshold, min_delta):
+    """
+    Returns the (scenario, stage, baseline, current) tuples of the stages
+    which got more than threshold (a fraction) and min_delta seconds slower.
+    """
+    regressions = []
+    for scenario, stages in sorted(results.items()):
+        for stage, current in sorted(stages.items()):
+            previous = baseline.get(scenario, {}).get(stage)
+            if previous is None:
+                continue
+            if current > previous * (1 + threshold) and \
+               current - previous > min_delta:
+                regressions.append((scenario, stage, previous, current))
+
+    return regressions
+
+
+def report(results, baseline):
+    """Writes a table of the results, compared to the baseline if any."""
+    for scenario, stages in sorted(results.items()):
+        for stage in STAGES:
+            current = stages[stage]
+            line = "%-18s %-18s %10.3f ms" % (scenario, stage, current * 1000)
+            previous = baseline.get(scenario, {}).get(stage)
+            if previous:
+                line += " %+7.1f%%" % ((current / previous - 1) * 100)
+            print(line)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the map parser on synthetic maps.")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run (all by default): " +
+                             ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("-b", "--baseline", default="bench_baseline.json",
+                        help="baseline file to compare with or save to")
+    parser.add_argument("-s", "--save", action="store_true",
+                        help="save the results as the new baseline")
+    parser.add_argument("-t", "--threshold", type=float, default=0.25,
+                        help="slowdown (as a fraction of the baseline) "
+                             "which counts as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.0001,
+                        help="slowdowns below this many seconds are noise")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum duration of a timing run in seconds")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timing runs per stage, the best one counts")
+    args = parser.parse_args()
+
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario: " + scenario)
+
+    # every request has to go through the parser, without touching the
+    # server's cache databases
+    config.CACHE_ENABLED = False
+    config.CACHE_DB = None
+    config.MEMBER_CACHE_DB = None
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        map_bytes = mapgen.build_map(**SCENARIOS[scenario])
+        results[scenario] = bench_scenario(map_bytes, args.min_time,
+                                           args.repeat)
+
+    report(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, sort_keys=True, indent=4)
+            f.write('\n')
+        return
+
+    regressions = compare(results, baseline, args.threshold, args.min_delta)
+    for scenario, stage, previous, current in regressions:
+        sys.stderr.write("regression: %s %s %.3f ms -> %.3f ms\n" %
+                         (scenario, stage, previous * 1000, current * 1000))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Result cache"""
+# Popular maps get uploaded over and over again. Responses are cached under
+# the hash of the uploaded bytes plus the parser version and the settings
+# the response depends on, first in an in-process LRU and then in a SQLite
+# database shared by all workers on the node. Concurrent requests for the
+# same map wait for the one which is already parsing it instead of parsing
+# it again.
+
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# the persistent tier is counted and trimmed every this many inserts of a
+# worker (or every tenth of db_entries if that's less), it may go past its
+# bound by that many rows per worker in between
+EVICTION_INTERVAL = 100
+
+
+def digest_key(digest, parser_version, *parameters):
+    """
+    Returns the cache key for the given map hash, parser version and the
+    parameters (settings and available libraries) the response depends on.
+    """
+    key = str(parser_version) + '-' + digest
+    if parameters:
+        key += '-' + hashlib.sha256(repr(parameters).encode('utf-8')) \
+            .hexdigest()[:16]
+    return key
+
+
+class ResultCache(object):
+    """
+    Two tier cache of JSON serializable responses. memory_entries bounds the
+    in-process LRU tier, db_path (if any) enables the persistent tier which
+    is bound to about db_entries rows (0 means unbound, see
+    EVICTION_INTERVAL).
+    """
+
+    def __init__(self, memory_entries, db_path=None, db_entries=0):
+        self.memory_entries = memory_entries
+        self.db_path = db_path
+        self.db_entries = db_entries
+        self.eviction_interval = max(min(EVICTION_INTERVAL,
+                                         db_entries // 10), 1)
+        # inserts since the persistent tier was last counted, the first
+        # insert counts it
+        self.unchecked = self.eviction_interval
+
+        self.memory = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.in_flight = {}  # key -> threading.Event of the parsing request
+        self.local = threading.local()
+
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+            "disk_errors": 0,
+        }
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def _connection(self):
+        """
+        Returns this thread's connection to the persistent tier. Connections
+        are never shared between threads or inherited across a fork.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.db_path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS results ("
+                           "key TEXT PRIMARY KEY, "
+                           "response TEXT NOT NULL, "
+                           "accessed REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_accessed "
+                           "ON results (accessed)")
+        connection.commit()
+
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def _remember(self, key, response):
+        """Puts the response into the in-process tier."""
+        with self.lock:
+            self.memory[key] = response
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+                self.counters["memory_evictions"] += 1
+
+    def get(self, key):
+        """Returns the cached response JSON for the given key or None."""
+        with self.lock:
+            response = self.memory.get(key)
+            if response is not None:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return response
+
+        if self.db_path is None:
+            return None
+
+        try:
+            connection = self._connection()
+            row = connection.execute("SELECT response FROM results "
+                                     "WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE results SET accessed = ? "
+                                   "WHERE key = ?", (time.time(), key))
+                connection.commit()
+        except sqlite3.Error:
+            self._count("disk_errors")
+            return None
+
+        if row is None:
+            return None
+
+        self._count("disk_hits")
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key, response):
+        """Stores the response JSON under the given key in both tiers."""
+        self._remember(key, response)
+
+        if self.db_path is None:
+            return
+
+        try:
+            connection = self._connection()
+            connection.execute("INSERT OR REPLACE INTO results "
+                               "(key, response, accessed) VALUES (?, ?, ?)",
+                               (key, response, time.time()))
+            evicted = 0
+            if self.db_entries and self._check_due():
+                rows = connection.execute("SELECT COUNT(*) FROM results")
+                evicted = max(rows.fetchone()[0] - self.db_entries, 0)
+            if evicted:
+                connection.execute("DELETE FROM results WHERE key IN ("
+                                   "SELECT key FROM results "
+                                   "ORDER BY accessed LIMIT ?)", (evicted,))
+            connection.commit()
+        except sqlite3.Error:
+            self._count("disk_errors")
+            return
+
+        if evicted:
+            self._count("disk_evictions", evicted)
+
+    def _check_due(self):
+        """
+        Tells whether the persistent tier should be counted and trimmed on
+        this insert, once every eviction_interval inserts.
+        """
+        with self.lock:
+            self.unchecked += 1
+            if self.unchecked < self.eviction_interval:
+                return False
+            self.unchecked = 0
+            return True
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the cached response for the given key, or computes it with
+        compute() and caches it. Only one caller computes a given key at a
+        time, the others wait for its result.
+        """
+        while True:
+            response = self.get(key)
+            if response is not None:
+                return json.loads(response)
+
+            with self.lock:
+                event = self.in_flight.get(key)
+                if event is None:
+                    event = self.in_flight[key] = threading.Event()
+                    self.counters["misses"] += 1
+                    break
+                self.counters["coalesced"] += 1
+
+            # somebody else is computing it already, wait and look again, if
+            # they failed we'll compute it ourselves
+            event.wait()
+
+        try:
+            result = compute()
+            self.put(key, json.dumps(result, sort_keys=True))
+            return result
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def stats(self):
+        """Returns the hit, miss and eviction counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+
+        stats["hits"] = stats["memory_hits"] + stats["disk_hits"]
+        return stats
+
+
+class FileCache(object):
+    """
+    Cache of binary blobs stored as files in a directory shared by all
+    workers on the node. The least recently used files are removed once
+    they take more than max_bytes (0 means unbound) in total.
+    """
+
+    def __init__(self, directory, max_bytes=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # bytes written since the directory was last measured, so it's only
+        # scanned when it may be over the limit
+        self.total = None
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0,
+                         "errors": 0}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def get(self, key):
+        """Returns the cached bytes for the given key or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # the mtime marks the last use
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        except OSError:
+            self._count("errors")
+            return None
+
+        self._count("hits")
+        return data
+
+    def put(self, key, data):
+        """Stores the bytes under the given key."""
+        path = self._path(key)
+        temporary = path + '.' + str(os.getpid()) + '.' + \
+            str(threading.get_ident())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, 'wb') as f:
+                f.write(data)
+            # readers never see a partly written file
+            os.replace(temporary, path)
+        except OSError:
+            self._count("errors")
+            return
+
+        if not self.max_bytes:
+            return
+
+        with self.lock:
+            if self.total is not None:
+                self.total += len(data)
+            if self.total is not None and self.total <= self.max_bytes:
+                return
+
+        self._evict()
+
+    def _evict(self):
+        """Removes the least recently used files until under max_bytes."""
+        files = []
+        try:
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            self._count("errors")
+            return
+
+        total = sum(size for mtime, size, path in files)
+        evicted = 0
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        with self.lock:
+            self.total = total
+            self.counters["evictions"] += evicted
+
+    def stats(self):
+        """Returns the hit, miss and eviction counters."""
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Map catalog"""
+# Every map read successfully is recorded in a SQLite catalog shared by all
+# workers on the node, under the SHA-256 of its bytes. The name, author and
+# description go into an FTS5 full-text index (without the color codes),
+# the numeric fields and the tileset into B-tree indexes, so GET /search
+# looks through hundreds of thousands of maps in milliseconds. Pages are
+# fetched one row past their end instead of counting all the matches.
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# response fields kept in the catalog and their column types
+COLUMNS = (
+    ('file_name', 'TEXT'),
+    ('map_name', 'TEXT'),
+    ('map_author', 'TEXT'),
+    ('map_description', 'TEXT'),
+    ('tileset', 'TEXT COLLATE NOCASE'),
+    ('script_language', 'TEXT COLLATE NOCASE'),
+    ('expansion_required', 'TEXT COLLATE NOCASE'),
+    ('max_players', 'INTEGER'),
+    ('map_width', 'INTEGER'),
+    ('map_height', 'INTEGER'),
+    ('playable_map_area_width', 'INTEGER'),
+    ('playable_map_area_height', 'INTEGER'),
+    ('map_version', 'INTEGER'),
+    ('editor_version', 'INTEGER'),
+)
+
+# fields matched by the text search
+TEXT_COLUMNS = ('map_name', 'map_author', 'map_description')
+
+# fields the search filters on and the type of their values, booleans are
+# "Yes" or "No" in the responses
+FILTERS = {
+    "tileset": str,
+    "script_language": str,
+    "expansion_required": bool,
+    "max_players": int,
+    "map_width": int,
+    "map_height": int,
+    "playable_map_area_width": int,
+    "playable_map_area_height": int,
+    "map_version": int,
+    "editor_version": int,
+}
+
+FILTER = re.compile(r'^(\w+)[ \t]*(?:(>=|<=|!=|=|>|<)[ \t]*(.*))?$', re.S)
+
+BOOLEANS = {"yes": "Yes", "true": "Yes", "1": "Yes",
+            "no": "No", "false": "No", "0": "No"}
+
+# Warcraft III color codes and line breaks, |cAARRGGBB...|r and |n
+COLOR_CODE = re.compile(r'\|c[0-9a-fA-F]{8}|\|[rRnN]')
+
+WORD = re.compile(r'\w+')
+
+
+def plain_text(text):
+    """Returns the given map string without color codes."""
+    if text is None:
+        return None
+    return COLOR_CODE.sub(' ', text)
+
+
+def match_query(text):
+    """
+    Returns the FTS5 query matching every word of the given text, or None if
+    it has no words. Words match as prefixes, single letters (which would
+    match most of the catalog) as whole words.
+    """
+    words = WORD.findall(plain_text(text))
+    if not words:
+        return None
+    return ' '.join('"' + word + '"' + ('*' if len(word) > 1 else '')
+                    for word in words)
+
+
+def parse_filter(term):
+    """
+    Parses a filter such as max_players>=8, tileset=Northrend or
+    expansion_required into a (field, operator, value) tuple. Raises
+    ValueError if the field or value are unknown or invalid.
+    """
+    match = FILTER.match(term)
+    if match is None or match.group(1) not in FILTERS:
+        raise ValueError("unknown filter: " + term)
+    field, operator, value = match.groups()
+    value_type = FILTERS[field]
+
+    if value_type is bool:
+        if operator is None:
+            return field, '=', 'Yes'
+        if operator not in ('=', '!=') or value.lower() not in BOOLEANS:
+            raise ValueError("invalid filter: " + term)
+        return field, operator, BOOLEANS[value.lower()]
+
+    if operator is None:
+        raise ValueError("filter without a value: " + term)
+    if value_type is str:
+        if operator not in ('=', '!='):
+            raise ValueError("invalid filter: " + term)
+        return field, operator, value
+    try:
+        return field, operator, int(value)
+    except ValueError:
+        raise ValueError("invalid filter: " + term)
+
+
+class MapCatalog(object):
+    """The catalog of the maps read so far, stored in the db_path database."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = {"recorded": 0, "searches": 0, "errors": 0}
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _connection(self):
+        """
+        Returns this thread's connection to the catalog. Connections are
+        never shared between threads or inherited across a fork.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.db_path, timeout=5,
+                                     isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS maps ("
+                           "id INTEGER PRIMARY KEY, "
+                           "sha256 TEXT NOT NULL UNIQUE, "
+                           "parser_version INTEGER NOT NULL, "
+                           "recorded REAL NOT NULL, " +
+                           ', '.join(name + ' ' + column_type
+                                     for name, column_type in COLUMNS) + ")")
+        for field in FILTERS:
+            connection.execute("CREATE INDEX IF NOT EXISTS maps_" + field +
+                               " ON maps (" + field + ")")
+        # the text index keeps its own copy, without the color codes
+        connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS maps_text "
+                           "USING fts5(" + ', '.join(TEXT_COLUMNS) +
+                           ", prefix='2 3')")
+
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def record(self, digest, response, parser_version):
+        """
+        Records the successful response of the map with the given SHA-256
+        hash, unless it was recorded by this parser version already.
+        """
+        try:
+            connection = self._connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute("SELECT id, parser_version "
+                                         "FROM maps WHERE sha256 = ?",
+                                         (digest,)).fetchone()
+                if row is not None and row[1] >= parser_version:
+                    connection.execute("COMMIT")
+                    return
+                if row is not None:
+                    connection.execute("DELETE FROM maps WHERE id = ?",
+                                       (row[0],))
+                    connection.execute("DELETE FROM maps_text "
+                                       "WHERE rowid = ?", (row[0],))
+
+                names = [name for name, column_type in COLUMNS]
+                cursor = connection.execute(
+                    "INSERT INTO maps (sha256, parser_version, recorded, " +
+                    ', '.join(names) + ") VALUES (?, ?, ?, " +
+                    ', '.join('?' * len(names)) + ")",
+                    [digest, parser_version, time.time()] +
+                    [response[name] for name in names])
+                connection.execute(
+                    "INSERT INTO maps_text (rowid, " +
+                    ', '.join(TEXT_COLUMNS) + ") VALUES (?, " +
+                    ', '.join('?' * len(TEXT_COLUMNS)) + ")",
+                    [cursor.lastrowid] + [plain_text(response[name])
+                                          for name in TEXT_COLUMNS])
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        except sqlite3.Error:
+            self._count("errors")
+            return
+
+        self._count("recorded")
+
+    def search(self, text=None, filters=(), page=1, page_size=20):
+        """
+        Returns a page of the maps matching every word of the text (best
+        matches first) and all the (field, operator, value) filters, most
+        recently recorded first without a text. Raises sqlite3.Error if the
+        catalog can't be read.
+        """
+        conditions = []
+        parameters = []
+        query = match_query(text) if text else None
+        if query is not None:
+            tables = "maps_text JOIN maps ON maps.id = maps_text.rowid"
+            conditions.append("maps_text MATCH ?")
+            parameters.append(query)
+            order = "maps_text.rank"
+        else:
+            tables = "maps"
+            order = "maps.id DESC"
+
+        for field, operator, value in filters:
+            conditions.append("maps." + field + " " + operator + " ?")
+            parameters.append(value)
+
+        names = ['sha256'] + [name for name, column_type in COLUMNS]
+        try:
+            rows = self._connection().execute(
+                "SELECT " + ', '.join('maps.' + name for name in names) +
+                " FROM " + tables +
+                " WHERE " + (' AND '.join(conditions) or '1') +
+                " ORDER BY " + order + " LIMIT ? OFFSET ?",
+                parameters + [page_size + 1, (page - 1) * page_size])
+            rows = rows.fetchall()
+        except sqlite3.Error:
+            self._count("errors")
+            raise
+        self._count("searches")
+
+        return {
+            "results": [dict(zip(names, row)) for row in rows[:page_size]],
+            "page": page,
+            "page_size": page_size,
+            "next_page": page + 1 if len(rows) > page_size else None,
+        }
+
+    def stats(self):
+        """Returns the record, search and error counters."""
+        with self.lock:
+            return dict(self.counters)
@@ -5,4 +5,121 @@ MAX_MAP_SIZE = 130  # in megabytes
 DEBUG = False
 HOST = "0.0.0.0"
 PORT = 8080
-TMP_DIR = "/tmp"
+# maps up to this size are kept in a bytes buffer, bigger ones are spooled to
+# an anonymous mmap, uploads never touch the disk
+MEMORY_UPLOAD_THRESHOLD = 16  # in megabytes
+# uploads bigger than that are received into workspace files in
+# WORKSPACE_DIR (a tmpfs, None maps anonymous memory instead), which every
+# worker keeps and reuses. All workers together reserve at most
+# WORKSPACE_QUOTA for them, uploads past it are rejected with 503. Workspace
+# files and temporary thumbnail cache and profile files of crashed workers
+# (and workspaces of older versions once older than WORKSPACE_TTL) are
+# removed at startup and every WORKSPACE_JANITOR_INTERVAL.
+WORKSPACE_DIR = "/dev/shm"
+WORKSPACE_QUOTA = 2048  # in megabytes, 0 means unbound
+WORKSPACE_TTL = 3600  # in seconds
+WORKSPACE_JANITOR_INTERVAL = 300  # in seconds
+WORKSPACE_RETRY_AFTER = 5  # in seconds, sent with the 503 responses
+# uploaded maps are checked while they're received, the HM3W header right
+# away and the MPQ header once this much of the map is in
+UPLOAD_CHECK_SIZE = 64  # in kilobytes
+
+# archive members read from a map may decompress to EXTRACT_MAX_OUTPUT in
+# total and to at most EXTRACT_MAX_RATIO times their compressed size, maps
+# going past that are rejected before anything is decompressed
+EXTRACT_MAX_OUTPUT = 256  # in megabytes, 0 means unbound
+EXTRACT_MAX_RATIO = 1000  # 0 means unbound
+
+# maps are read by SANDBOX_WORKERS long-lived processes of every server
+# worker (0 reads them in the server worker itself, without a time limit).
+# A map gets SANDBOX_TIMEOUT seconds and the process reading it at most
+# SANDBOX_MEMORY of address space, processes going over are killed and
+# replaced and the map gets an error response. Maps waiting longer than
+# SANDBOX_WAIT for a free process are rejected with 503
+SANDBOX_WORKERS = 2
+SANDBOX_TIMEOUT = 10  # in seconds
+SANDBOX_MEMORY = 1024  # in megabytes, 0 means unbound
+SANDBOX_WAIT = 10  # in seconds
+SANDBOX_RETRY_AFTER = 5  # in seconds, sent with the 503 responses
+
+# the terrain's heightmap is averaged down to at most this many points a side
+TERRAIN_HEIGHTMAP_SIZE = 32
+
+# calls of these natives in the map script are counted one by one in the
+# response's script field, they're what cheats, desyncs and exploits use
+SCRIPT_FLAGGED_NATIVES = ("ExecuteFunc", "GetLocalPlayer", "Cheat",
+                          "Preloader", "PreloadGenEnd", "SaveGameCache",
+                          "SyncStoredInteger", "BlzSendSyncData",
+                          "BlzCreateFrame")
+
+# thumbnails (POST /thumbnail) are THUMBNAIL_SIZE pixels a side unless the
+# request asks for another size, the rendered ones are kept in
+# THUMBNAIL_CACHE_DIR (None disables it) up to THUMBNAIL_CACHE_SIZE in total
+THUMBNAIL_SIZE = 256
+THUMBNAIL_MAX_SIZE = 1024
+THUMBNAIL_CACHE_DIR = "/var/tmp/kraftver-thumbnails"
+THUMBNAIL_CACHE_SIZE = 256  # in megabytes
+
+# responses are cached under the hash of the uploaded map, first in every
+# worker's memory and then in a SQLite database shared by all workers on the
+# node (set CACHE_DB to None to keep the cache in memory only)
+CACHE_ENABLED = True
+CACHE_MEMORY_ENTRIES = 1024
+CACHE_DB = "/var/tmp/kraftver-cache.sqlite"
+CACHE_DB_ENTRIES = 100000  # 0 means unbound
+# the terrain, objects, script and the strings looked up are also cached on
+# their own under the hashes of the archive members they come from, so a
+# re-upload of an edited map only decompresses the members which changed
+MEMBER_CACHE_ENTRIES = 256
+MEMBER_CACHE_DB = "/var/tmp/kraftver-members.sqlite"
+MEMBER_CACHE_DB_ENTRIES = 100000  # 0 means unbound
+
+# maps read successfully are recorded in the SEARCH_DB catalog shared by all
+# workers on the node (None disables it and GET /search), search results
+# come in pages of SEARCH_PAGE_SIZE unless the request asks for up to
+# SEARCH_MAX_PAGE_SIZE
+SEARCH_DB = None  # e.g. "/var/tmp/kraftver-catalog.sqlite"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+
+# a PROFILE_SAMPLE_RATE fraction of the map uploads (POST /), and the ones
+# sent with an X-Kraftver-Admin header holding ADMIN_TOKEN, are read under
+# the profiler. The PROFILE_ENTRIES most recent profiles are kept in
+# PROFILE_DIR (None disables profiling), one per map, with a summary of
+# their PROFILE_TOP_FUNCTIONS functions with the most cumulative time.
+# GET /profiles lists them, it needs the same header when ADMIN_TOKEN is set
+PROFILE_DIR = None  # e.g. "/var/tmp/kraftver-profiles"
+PROFILE_SAMPLE_RATE = 0.0  # 0.01 profiles one upload out of a hundred
+PROFILE_ENTRIES = 100  # 0 means unbound
+PROFILE_TOP_FUNCTIONS = 30
+ADMIN_TOKEN = None
+
+# number of processes reading the maps of batch uploads, 0 means one per CPU.
+# Batches (archives included) of more than BATCH_MAX_MAPS maps or
+# BATCH_MAX_SIZE of unpacked maps are rejected with 413
+BATCH_WORKERS = 0
+BATCH_MAX_MAPS = 1000  # 0 means unbound
+BATCH_MAX_SIZE = 1024  # in megabytes, 0 means unbound
+
+# asynchronous jobs (POST /jobs), JOB_WORKERS maps are read at the same time,
+# at most JOB_QUEUE_SIZE maps wait for their turn and the rest are rejected,
+# results are kept for JOB_RESULT_TTL seconds. The job statuses are shared
+# through JOB_DB by all server workers on the node (None keeps them in the
+# worker which took the job, only do that with a single worker)
+JOB_WORKERS = 4
+JOB_QUEUE_SIZE = 64
+JOB_RESULT_TTL = 600  # in seconds
+JOB_RETRY_AFTER = 5  # in seconds, sent to the clients of rejected jobs
+JOB_DB = "/var/tmp/kraftver-jobs.sqlite"
+
+# production server (server.py): SERVER_WORKERS processes, 0 means one per
+# CPU, each of them receives uploads asynchronously and runs up to
+# SERVER_CONCURRENCY requests at the same time
+SERVER_WORKERS = 0
+SERVER_CONCURRENCY = 4
+SERVER_BACKLOG = 1024
+SERVER_KEEPALIVE_TIMEOUT = 5  # in seconds, idle time between requests
+SERVER_READ_TIMEOUT = 60  # in seconds, to receive a whole request
+SERVER_REQUEST_TIMEOUT = 120  # in seconds, to start responding
+SERVER_SHUTDOWN_TIMEOUT = 30  # in seconds, to finish the running requests
+SERVER_LINGER_TIMEOUT = 2  # in seconds, to drain a rejected upload
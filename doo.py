@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""war3map.doo and war3mapUnits.doo parsers"""
+# The doodad file places the trees, rocks and other doodads, the units file
+# places the units, buildings, items and start locations. Melee maps carry
+# tens of thousands of doodads: their records have a fixed size (unless they
+# drop items, which is rare) so they're viewed as a NumPy structured array
+# over the buffer. Unit records have variable length parts (dropped items,
+# inventory, abilities, random unit lists) and are read in a single pass
+# with precompiled structs. Both need NumPy.
+
+import collections
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER = struct.Struct('<4sIII')
+INT = struct.Struct('<i')
+PLACEMENT = struct.Struct('<4si3ff3f')
+SKIN = struct.Struct('<4s')
+DOODAD_STATE = struct.Struct('<BB')
+UNIT_OWNER = struct.Struct('<BiBBii')
+DROP = struct.Struct('<4si')
+UNIT_GOLD = struct.Struct('<ifi')
+HERO_STATS = struct.Struct('<iii')
+INVENTORY_ITEM = struct.Struct('<i4s')
+ABILITY = struct.Struct('<4sii')
+RANDOM_GROUP = struct.Struct('<ii')
+UNIT_TAIL = struct.Struct('<iii')
+
+# doodad records viewed at once while looking for ones which drop items
+DOODAD_WINDOW = 4096
+
+START_LOCATION = b'sloc'
+GOLD_MINE = b'ngol'
+
+# fields shared by doodad and unit placements
+PLACEMENT_FIELDS = [
+    ('id', 'S4'),
+    ('variation', '<i4'),
+    ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+    ('angle', '<f4'),
+    ('scale_x', '<f4'), ('scale_y', '<f4'), ('scale_z', '<f4'),
+]
+
+
+def doodad_dtype(version, skins):
+    """
+    Returns the dtype of a doodad record which doesn't drop any items. TFT
+    (version 8) records carry an item table and dropped item sets, Reforged
+    (1.32+) maps add a skin to every record.
+    """
+    fields = list(PLACEMENT_FIELDS)
+    if skins:
+        fields.append(('skin', 'S4'))
+    fields += [('flags', 'u1'), ('life', 'u1')]
+    if version >= 8:
+        fields += [('item_table', '<i4'), ('item_sets', '<i4')]
+    fields.append(('editor_id', '<i4'))
+    return numpy.dtype(fields)
+
+
+SPECIAL_DOODAD = None
+if numpy is not None:
+    SPECIAL_DOODAD = numpy.dtype([('id', 'S4'), ('z', '<i4'), ('x', '<i4'),
+                                  ('y', '<i4')])
+
+
+def _header(data, name):
+    try:
+        magic, version, subversion, count = HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError(name + " is truncated")
+    if magic != b'W3do':
+        raise ValueError(name + " isn't a doodad file")
+    if count > len(data) // PLACEMENT.size:
+        raise ValueError(name + " is truncated")
+
+    return version, subversion, count
+
+
+def parse_doodads(data, skins=False):
+    """
+    Parses the war3map.doo file contents. Returns the doodads as a
+    structured array (see doodad_dtype(), item_sets is the number of dropped
+    item sets) and the special doodads (cliffs, ramps...) as another one.
+    Raises ValueError if the file is damaged.
+    """
+    data = bytes(data)
+    version, subversion, count = _header(data, "war3map.doo")
+    dtype = doodad_dtype(version, skins)
+    position = HEADER.size
+
+    # records which drop items are longer and move the ones after them,
+    # the records are viewed up to each of them and copied, the view resumes
+    # past it. Views span a window of records so each one only scans the
+    # records it keeps.
+    doodads = numpy.empty(count, dtype)
+    done = 0
+    while done < count:
+        available = min(count - done, DOODAD_WINDOW,
+                        (len(data) - position) // dtype.itemsize)
+        if not available:
+            raise ValueError("war3map.doo is truncated")
+        view = numpy.frombuffer(data, dtype, available, position)
+        end = available
+        if version >= 8:
+            dropping = numpy.flatnonzero(view['item_sets'])
+            if len(dropping):
+                end = dropping[0]
+        doodads[done:done + end] = view[:end]
+        position += end * dtype.itemsize
+        done += end
+        if end < available:
+            doodads[done] = view[end]
+            doodads['editor_id'][done], position = \
+                _skip_dropped_items(data, position, dtype, view[end])
+            done += 1
+
+    special = numpy.zeros(0, SPECIAL_DOODAD)
+    if len(data) >= position + 8:
+        special_count = struct.unpack_from('<ii', data, position)[1]
+        position += 8
+        if 0 < special_count <= (len(data) - position) // \
+           SPECIAL_DOODAD.itemsize:
+            special = numpy.frombuffer(data, SPECIAL_DOODAD, special_count,
+                                       position)
+
+    return doodads, special
+
+
+def _skip_dropped_items(data, position, dtype, record):
+    """
+    Skips the dropped item sets of the doodad record at the given position.
+    Returns its editor id, which follows them, and the position of the next
+    record.
+    """
+    # the item sets start where the editor id would be
+    position += dtype.itemsize - INT.size
+    try:
+        for i in range(int(record['item_sets'])):
+            position += INT.size + INT.unpack_from(data, position)[0] * \
+                DROP.size
+        editor_id = INT.unpack_from(data, position)[0]
+    except struct.error:
+        raise ValueError("war3map.doo is truncated")
+
+    return editor_id, position + INT.size
+
+
+def parse_units(data, skins=False):
+    """
+    Parses the war3mapUnits.doo file contents. Returns a dictionary of
+    arrays, one entry per unit: id (bytes), x, y, player, gold, item_sets
+    (the number of dropped item sets) and item_drops (the number of items in
+    them). Raises ValueError if the file is damaged.
+    """
+    data = bytes(data)
+    version, subversion, count = _header(data, "war3mapUnits.doo")
+    tft = version >= 8
+
+    ids = []
+    xs = []
+    ys = []
+    players = []
+    golds = []
+    item_sets = []
+    item_drops = []
+
+    # local names keep the loop tight
+    unpack_placement = PLACEMENT.unpack_from
+    unpack_owner = UNIT_OWNER.unpack_from
+    unpack_int = INT.unpack_from
+    unpack_gold = UNIT_GOLD.unpack_from
+    position = HEADER.size
+    try:
+        for i in range(count):
+            unit_id, variation, x, y = unpack_placement(data, position)[:4]
+            position += PLACEMENT.size
+            if skins:
+                position += SKIN.size
+            player = unpack_owner(data, position)[1]
+            position += UNIT_OWNER.size
+            if tft:
+                position += INT.size  # item table
+
+            sets = unpack_int(data, position)[0]
+            position += INT.size
+            drops = 0
+            for j in range(sets):
+                items = unpack_int(data, position)[0]
+                position += INT.size + items * DROP.size
+                drops += items
+
+            gold = unpack_gold(data, position)[0]
+            position += UNIT_GOLD.size
+            if tft:
+                position += HERO_STATS.size
+
+            position += INT.size + unpack_int(data, position)[0] * \
+                INVENTORY_ITEM.size
+            position += INT.size + unpack_int(data, position)[0] * \
+                ABILITY.size
+
+            random_type = unpack_int(data, position)[0]
+            position += INT.size
+            if random_type == 0:
+                position += INT.size  # level and item class
+            elif random_type == 1:
+                position += RANDOM_GROUP.size
+            elif random_type == 2:
+                position += INT.size + unpack_int(data, position)[0] * \
+                    DROP.size
+
+            position += UNIT_TAIL.size
+            if position > len(data):
+                raise struct.error()
+
+            ids.append(unit_id)
+            xs.append(x)
+            ys.append(y)
+            players.append(player)
+            golds.append(gold)
+            item_sets.append(sets)
+            item_drops.append(drops)
+    except struct.error:
+        raise ValueError("war3mapUnits.doo is truncated")
+
+    return {
+        "id": numpy.array(ids, 'S4'),
+        "x": numpy.array(xs, numpy.float32),
+        "y": numpy.array(ys, numpy.float32),
+        "player": numpy.array(players, numpy.int32),
+        "gold": numpy.array(golds, numpy.int64),
+        "item_sets": numpy.array(item_sets, numpy.int32),
+        "item_drops": numpy.array(item_drops, numpy.int32),
+    }
+
+
+def type_counts(ids):
+    """Returns the number of objects of every type id, decoded."""
+    # sorting integers is much faster than sorting strings
+    types, counts = numpy.unique(numpy.ascontiguousarray(ids).view('<u4'),
+                                 return_counts=True)
+    types = types.astype('<u4').view('S4')
+    return collections.OrderedDict(sorted(
+        (type_id.decode('latin-1'), int(type_count))
+        for type_id, type_count in zip(types.tolist(), counts.tolist())))
+
+
+def start_locations(units):
+    """
+    Returns the start locations with the gold mines closest to each of them
+    (every mine belongs to its nearest start location).
+    """
+    starts = units["id"] == START_LOCATION
+    mines = units["id"] == GOLD_MINE
+    start_x, start_y = units["x"][starts], units["y"][starts]
+    mine_x, mine_y = units["x"][mines], units["y"][mines]
+    mine_gold = units["gold"][mines]
+
+    owners = numpy.zeros(0, numpy.intp)
+    distances = numpy.zeros((0, 0), numpy.float32)
+    if len(start_x) and len(mine_x):
+        distances = numpy.hypot(mine_x[:, None] - start_x[None, :],
+                                mine_y[:, None] - start_y[None, :])
+        owners = distances.argmin(axis=1)
+
+    locations = []
+    for index, player in enumerate(units["player"][starts].tolist()):
+        owned = owners == index
+        locations.append({
+            "player": player,
+            "x": round(float(start_x[index]), 1),
+            "y": round(float(start_y[index]), 1),
+            "gold_mines": int(owned.sum()),
+            "gold": int(mine_gold[owned].sum()),
+            "nearest_gold_mine": round(float(distances[:, index].min()), 1)
+                                 if len(mine_x) else None,
+        })
+
+    return locations
+
+
+def statistics(doodads, special_doodads, units):
+    """
+    Returns the object counts of the parsed doodads and units, either of
+    which can be None when the file is missing.
+    """
+    result = {}
+    if doodads is not None:
+        result["doodads"] = len(doodads)
+        result["doodad_types"] = type_counts(doodads["id"])
+        result["special_doodads"] = len(special_doodads)
+
+    if units is not None:
+        placed = units["id"] != START_LOCATION
+        players, counts = numpy.unique(units["player"][placed],
+                                       return_counts=True)
+        result["units"] = int(placed.sum())
+        result["unit_types"] = type_counts(units["id"][placed])
+        result["units_per_player"] = collections.OrderedDict(
+            (str(player), int(count))
+            for player, count in zip(players.tolist(), counts.tolist()))
+        result["start_locations"] = start_locations(units)
+        result["gold_mines"] = int((units["id"] == GOLD_MINE).sum())
+        result["units_with_item_drops"] = int((units["item_sets"] > 0).sum())
+        result["item_drops"] = int(units["item_drops"].sum())
+
+    return result
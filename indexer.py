@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""Bulk indexer"""
+# Reads whole map collections without going through the HTTP server. Maps
+# found in the given directories (or matching the given globs) are read by a
+# pool of processes and written to a JSONL file or a SQLite database, one
+# record per map with the same fields as the server's response. Maps which
+# are already in the index are skipped so an interrupted run can be resumed.
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+
+import main
+
+MAP_EXTENSIONS = ('.w3m', '.w3x', '.w3n')
+
+# Fields of a record besides the ones of the server's response
+INDEX_FIELDS = ('path', 'size', 'mtime', 'sha256')
+RESPONSE_FIELDS = tuple(sorted(main.map_error("", "").keys()))
+
+
+def find_maps(sources):
+    """Yields the paths of the maps in the given directories and globs."""
+    for source in sources:
+        if os.path.isdir(source):
+            for directory, subdirs, files in os.walk(source):
+                subdirs.sort()
+                for file_name in sorted(files):
+                    if file_name.lower().endswith(MAP_EXTENSIONS):
+                        yield os.path.join(directory, file_name)
+        else:
+            for path in sorted(glob.glob(source)):
+                if os.path.isfile(path):
+                    yield path
+
+
+class JSONLIndex(object):
+    """Index stored as a JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def known(self):
+        """Returns the (path, mtime, size) tuples and hashes in the index."""
+        files = set()
+        hashes = set()
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # torn write of an interrupted run
+                        continue
+                    files.add((record['path'], record['mtime'],
+                               record['size']))
+                    hashes.add(record['sha256'])
+
+        return files, hashes
+
+    def open(self):
+        self.file = open(self.path, 'a')
+
+    def add(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class SQLiteIndex(object):
+    """Index stored in a SQLite table with a column per field."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        columns = ', '.join(field + (' PRIMARY KEY' if field == 'path' else '')
+                            for field in INDEX_FIELDS + RESPONSE_FIELDS)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS maps (" +
+                                columns + ")")
+        # indexes written by older versions lack the newer fields
+        existing = set(row[1] for row in self.connection.execute(
+            "PRAGMA table_info(maps)"))
+        for field in INDEX_FIELDS + RESPONSE_FIELDS:
+            if field not in existing:
+                self.connection.execute("ALTER TABLE maps ADD COLUMN " +
+                                        field)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS maps_sha256 "
+                                "ON maps (sha256)")
+        self.connection.commit()
+
+    def known(self):
+        """Returns the (path, mtime, size) tuples and hashes in the index."""
+        files = set()
+        hashes = set()
+        for path, mtime, size, sha256 in self.connection.execute(
+                "SELECT path, mtime, size, sha256 FROM maps"):
+            files.add((path, mtime, size))
+            hashes.add(sha256)
+
+        return files, hashes
+
+    def open(self):
+        self.pending = 0
+
+    def add(self, record):
+        fields = INDEX_FIELDS + RESPONSE_FIELDS
+        # lists (players, forces...) are stored as JSON
+        values = [json.dumps(record[field], sort_keys=True)
+                  if isinstance(record[field], (list, dict)) else record[field]
+                  for field in fields]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO maps (" + ', '.join(fields) +
+            ") VALUES (" + ', '.join('?' * len(fields)) + ")", values)
+
+        # commit in batches, an interrupted run loses at most a batch
+        self.pending += 1
+        if self.pending >= 100:
+            self.connection.commit()
+            self.pending = 0
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+def open_index(path):
+    """Returns the index stored at the given path, by its extension."""
+    if path.endswith(('.sqlite', '.sqlite3', '.db')):
+        return SQLiteIndex(path)
+
+    return JSONLIndex(path)
+
+
+KNOWN_HASHES = set()
+
+
+def init_worker(known_hashes):
+    """Hands the hashes of the already indexed maps to a worker process."""
+    global KNOWN_HASHES
+    KNOWN_HASHES = known_hashes
+
+
+def index_map(path):
+    """
+    Reads the map at the given path and returns its record, or None if a
+    map with the same contents is already in the index.
+    """
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        map_bytes = f.read()
+
+    sha256 = hashlib.sha256(map_bytes).hexdigest()
+    if sha256 in KNOWN_HASHES:
+        return None
+
+    file_name = os.path.basename(path)
+    if len(map_bytes) == 0:
+        response = main.map_error("empty map file", file_name)
+    else:
+        try:
+            response = main.process_map(memoryview(map_bytes), file_name)
+            # the indexer's workers read the maps of a campaign themselves
+            if response['maps'] is not None:
+                response['maps'] = main.read_campaign_maps(
+                    response['maps'], parallel=False)
+        except MemoryError:
+            response = main.map_error(main.LIMIT_ERROR + "reading the map "
+                                      "ran out of memory", file_name)
+
+    record = dict(response)
+    record.update({
+        "path": path,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "sha256": sha256,
+    })
+    return record
+
+
+def progress(indexed, skipped, total, started):
+    """Writes the progress and throughput to stderr."""
+    elapsed = time.time() - started
+    rate = indexed / elapsed if elapsed else 0
+    sys.stderr.write("\r%d/%d maps indexed, %d skipped, %.1f maps/s" %
+                     (indexed, total, skipped, rate))
+    sys.stderr.flush()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Reads Warcraft III maps into a JSONL or SQLite index.")
+    parser.add_argument("sources", nargs="+",
+                        help="directories (searched recursively for .w3m, "
+                             ".w3x and .w3n files) or globs of maps")
+    parser.add_argument("-o", "--output", required=True,
+                        help="index file, .sqlite/.sqlite3/.db for SQLite, "
+                             "JSONL otherwise")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--match", choices=("stat", "hash"), default="stat",
+                        help="skip maps already indexed with the same path, "
+                             "mtime and size (stat) or with the same "
+                             "contents (hash)")
+    args = parser.parse_args()
+
+    index = open_index(args.output)
+    known_files, known_hashes = index.known()
+
+    paths = []
+    skipped = 0
+    for path in find_maps(args.sources):
+        stat = os.stat(path)
+        if args.match == "stat" and \
+           (path, stat.st_mtime, stat.st_size) in known_files:
+            skipped += 1
+            continue
+        paths.append(path)
+
+    if args.match != "hash":
+        known_hashes = set()
+
+    total = len(paths) + skipped
+    indexed = 0
+    started = time.time()
+    last_progress = 0
+
+    index.open()
+    pool = multiprocessing.Pool(args.jobs, init_worker, (known_hashes,))
+    try:
+        for record in pool.imap_unordered(index_map, paths, chunksize=4):
+            if record is None:
+                skipped += 1
+            else:
+                index.add(record)
+                indexed += 1
+
+            if time.time() - last_progress >= 1:
+                progress(indexed, skipped, total, started)
+                last_progress = time.time()
+    finally:
+        pool.terminate()
+        index.close()
+
+    progress(indexed, skipped, total, started)
+    sys.stderr.write("\n")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""war3map.j script analysis"""
+# The map script is JASS: the global variables are declared in a globals
+# block, followed by the natives and functions, one statement per line.
+# Scripts of big custom maps run to several megabytes, so they're scanned a
+# chunk at a time as their sectors are decompressed and only the counts are
+# kept, only the last incomplete line of a chunk is carried over to the next
+# one. The string literals, rawcodes and comments are cut out of a chunk and
+# its definitions and calls are found and counted by regular expressions,
+# never token by token in Python.
+
+import collections
+import re
+
+# chunks are scanned once this many bytes are pending, lines longer than
+# SCAN_SIZE (the game itself doesn't read them) are scanned in pieces
+SCAN_SIZE = 64 * 1024
+
+# names of the functions defined by the script which are remembered to tell
+# their calls from native calls, later ones count as natives
+MAX_FUNCTIONS = 1 << 16
+
+# string literals, rawcodes and comments, which may hold anything
+NOISE = re.compile(br'"(?:[^"\\\n]|\\.)*"?|\'[^\'\n]*\'?|//[^\n]*')
+
+DEFINITION = re.compile(br'^[ \t]*(?:constant[ \t]+)?(function|native)[ \t]+'
+                        br'([A-Za-z_]\w*)', re.M)
+CALL = re.compile(br'\b([A-Za-z_]\w*)[ \t]*\(')
+
+GLOBALS_START = re.compile(br'^[ \t]*globals\b', re.M)
+GLOBALS_END = re.compile(br'^[ \t]*endglobals\b', re.M)
+
+# lines of the globals block which declare a variable
+DECLARATION = re.compile(br'^[ \t]*(?!//)[A-Za-z_]', re.M)
+
+# keywords which may be followed by a parenthesis
+KEYWORDS = (b'if', b'elseif', b'and', b'or', b'not', b'return', b'exitwhen',
+            b'set', b'call', b'local', b'constant')
+
+
+class ScriptScanner(object):
+    """
+    Counts the functions, globals and calls of a JASS script fed to it a
+    chunk at a time. Calls of the functions in flagged (a set of bytes) are
+    also counted by name. Memory use doesn't depend on the script's size.
+    """
+
+    def __init__(self, flagged=()):
+        self.flagged = frozenset(flagged)
+        self.pending = b''
+        self.in_globals = False
+        self.functions = set()
+
+        self.size = 0
+        self.counts = {"functions": 0, "natives": 0, "globals": 0,
+                       "function_calls": 0, "native_calls": 0}
+        self.flagged_calls = collections.Counter()
+
+    def feed(self, data):
+        """Scans the complete lines of the pending data and the given data."""
+        self.size += len(data)
+        self.pending += data
+        if len(self.pending) < SCAN_SIZE:
+            return
+
+        end = self.pending.rfind(b'\n') + 1
+        if not end:
+            end = len(self.pending)
+        self._scan(self.pending[:end])
+        self.pending = self.pending[end:]
+
+    def close(self):
+        """Scans what's left and returns the counts."""
+        self._scan(self.pending)
+        self.pending = b''
+
+        result = dict(self.counts)
+        result["size"] = self.size
+        result["flagged_natives"] = dict(
+            (name.decode('latin-1'), count)
+            for name, count in sorted(self.flagged_calls.items()))
+        return result
+
+    def _scan(self, text):
+        """Scans whole lines, the globals blocks and the code around them."""
+        position = 0
+        while position < len(text):
+            if self.in_globals:
+                match = GLOBALS_END.search(text, position)
+                stop = len(text) if match is None else match.start()
+                self.counts["globals"] += len(DECLARATION.findall(
+                    text, position, stop))
+                if match is None:
+                    return
+                self.in_globals = False
+                position = match.end()
+
+            match = GLOBALS_START.search(text, position)
+            stop = len(text) if match is None else match.start()
+            self._scan_code(NOISE.sub(b'', text[position:stop]))
+            if match is None:
+                return
+            self.in_globals = True
+            position = match.end()
+
+    def _scan_code(self, code):
+        """Counts the definitions and calls of code without any noise."""
+        counts = self.counts
+        for kind, name in DEFINITION.findall(code):
+            if kind == b'native':
+                counts["natives"] += 1
+                continue
+            counts["functions"] += 1
+            if len(self.functions) < MAX_FUNCTIONS:
+                self.functions.add(name)
+
+        calls = collections.Counter(CALL.findall(code))
+        for keyword in KEYWORDS:
+            calls.pop(keyword, None)
+        for name, count in calls.items():
+            if name in self.functions:
+                counts["function_calls"] += count
+            else:
+                counts["native_calls"] += count
+            if name in self.flagged:
+                self.flagged_calls[name] += count
+
+
+def analyze(chunks, flagged=()):
+    """
+    Returns the counts of the JASS script made of the given chunks of bytes:
+    its size, functions, natives (declared), globals, function_calls (of
+    the functions it defines), native_calls (of all the others, natives and
+    Blizzard.j functions) and the calls of every flagged native it uses.
+    """
+    scanner = ScriptScanner(name.encode('latin-1') for name in flagged)
+    for chunk in chunks:
+        scanner.feed(chunk)
+
+    return scanner.close()
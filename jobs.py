@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Asynchronous jobs"""
+# Big maps take a while to read and clients time out waiting for them. A job
+# is queued right away and read by a fixed number of worker threads, the
+# client polls for the result which is kept around for a while. The queue is
+# bounded, when it's full new jobs are rejected instead of piling up. When
+# several server processes are running, the job statuses are also written to
+# a SQLite database so the client can poll any of them.
+
+import collections
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+
+
+class QueueFull(Exception):
+    """Raised when the job queue can't take any more jobs."""
+
+
+class Job(object):
+    """A single queued map and, once it's read, its response."""
+
+    def __init__(self, map_bytes, file_name):
+        self.id = uuid.uuid4().hex
+        self.map_bytes = map_bytes
+        self.file_name = file_name
+        self.status = QUEUED
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    @classmethod
+    def from_row(cls, row):
+        """Returns the job stored in a row of the jobs table."""
+        job = cls(None, None)
+        (job.id, job.status, job.submitted, job.started, job.finished,
+         result) = row
+        job.result = json.loads(result) if result is not None else None
+        return job
+
+    def to_dict(self):
+        """Returns the job status as a dictionary, to be used as a response."""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "result": self.result,
+        }
+
+
+class JobQueue(object):
+    """
+    Bounded queue of jobs read by a fixed number of worker threads. run is
+    called as run(map_bytes, file_name) and returns the job's response,
+    finished jobs are forgotten after result_ttl seconds. If db_path is given
+    the job statuses are shared through it with the other processes.
+    """
+
+    def __init__(self, run, workers, max_queued, result_ttl, db_path=None):
+        self.run = run
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.db_path = db_path
+        self.local = threading.local()
+
+        self.queue = queue.Queue(max_queued)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = 0
+        self.counters = {"submitted": 0, "rejected": 0, "finished": 0,
+                         "expired": 0}
+        self.wait_times = collections.deque(maxlen=1000)
+
+    def _connection(self):
+        """
+        Returns this thread's connection to the shared job database.
+        Connections are never shared between threads or inherited across a
+        fork.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None and self.local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.db_path, timeout=5)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                           "id TEXT PRIMARY KEY, "
+                           "status TEXT NOT NULL, "
+                           "submitted REAL NOT NULL, "
+                           "started REAL, "
+                           "finished REAL, "
+                           "result TEXT)")
+        connection.commit()
+
+        self.local.connection = connection
+        self.local.pid = os.getpid()
+        return connection
+
+    def _store(self, job, replace=True):
+        """Writes the job's status to the shared database, if there's one."""
+        if self.db_path is None:
+            return
+
+        result = json.dumps(job.result, sort_keys=True) \
+            if job.result is not None else None
+        try:
+            connection = self._connection()
+            connection.execute("INSERT OR " +
+                               ("REPLACE" if replace else "IGNORE") +
+                               " INTO jobs (id, status, "
+                               "submitted, started, finished, result) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (job.id, job.status, job.submitted,
+                                job.started, job.finished, result))
+            connection.commit()
+        except sqlite3.Error:
+            pass  # the job can still be polled from this process
+
+    def _load(self, job_id):
+        """Returns the job from the shared database or None."""
+        if self.db_path is None:
+            return None
+
+        try:
+            row = self._connection().execute(
+                "SELECT id, status, submitted, started, finished, result "
+                "FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        except sqlite3.Error:
+            return None
+
+        return Job.from_row(row) if row is not None else None
+
+    def _start(self):
+        """Starts the worker threads, lazily so they're not lost in a fork."""
+        with self.lock:
+            self.threads = [thread for thread in self.threads
+                            if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+
+            with self.lock:
+                job.status = RUNNING
+                job.started = time.time()
+                self.wait_times.append(job.started - job.submitted)
+                self.running += 1
+            self._store(job)
+
+            try:
+                result = self.run(job.map_bytes, job.file_name)
+            except Exception as e:
+                result = {"success": False, "error": str(e),
+                          "file_name": job.file_name}
+
+            with self.lock:
+                job.result = result
+                job.map_bytes = None
+                job.status = DONE
+                job.finished = time.time()
+                self.running -= 1
+                self.counters["finished"] += 1
+            self._store(job)
+
+            self.queue.task_done()
+
+    def _expire(self):
+        """Forgets the finished jobs older than result_ttl."""
+        deadline = time.time() - self.result_ttl
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.status == DONE and job.finished < deadline]
+            for job_id in expired:
+                del self.jobs[job_id]
+            self.counters["expired"] += len(expired)
+
+        if self.db_path is not None:
+            try:
+                connection = self._connection()
+                connection.execute("DELETE FROM jobs WHERE finished < ?",
+                                   (deadline,))
+                connection.commit()
+            except sqlite3.Error:
+                pass
+
+    def submit(self, map_bytes, file_name):
+        """Queues the map and returns its job. Raises QueueFull if it can't."""
+        self._start()
+        self._expire()
+
+        job = Job(map_bytes, file_name)
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                self.counters["rejected"] += 1
+                raise QueueFull()
+            self.jobs[job.id] = job
+            self.counters["submitted"] += 1
+
+        # a worker may have picked the job up already, don't overwrite it
+        self._store(job, replace=False)
+
+        return job
+
+    def get(self, job_id):
+        """Returns the job with the given id or None if it's unknown."""
+        self._expire()
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+        # submitted to another process
+        if job is None:
+            job = self._load(job_id)
+
+        return job
+
+    def stats(self):
+        """Returns the queue depth, wait times and job counters."""
+        now = time.time()
+        with self.lock:
+            queued = [job for job in self.jobs.values()
+                      if job.status == QUEUED]
+            stats = dict(self.counters)
+            stats["queue_depth"] = len(queued)
+            stats["queue_capacity"] = self.queue.maxsize
+            stats["running"] = self.running
+            stats["workers"] = self.workers
+            stats["oldest_queued_age"] = max([now - job.submitted
+                                              for job in queued] or [0])
+            wait_times = list(self.wait_times)
+
+        stats["wait_time_avg"] = sum(wait_times) / len(wait_times) \
+                                 if wait_times else 0
+        stats["wait_time_max"] = max(wait_times or [0])
+        return stats
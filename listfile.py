@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Known archive member names"""
+# Members are found by the hashes of their names, protected maps remove or
+# scramble their (listfile) but the hashes are still in the hash table. The
+# names Warcraft III itself reads from maps and campaigns are well known,
+# mpq.py computes their hashes once when it's imported so looking them up
+# never hashes a name again.
+
+# Files every map may carry, war3map.<extension>
+MAP_EXTENSIONS = ('j', 'lua', 'w3e', 'w3i', 'wts', 'wtg', 'wct', 'w3r', 'w3c',
+                  'w3s', 'w3u', 'w3t', 'w3b', 'w3d', 'w3a', 'w3h', 'w3q',
+                  'doo', 'shd', 'mmp', 'wpm', 'imp', 'w3o')
+
+# Object data files campaigns share with their maps, war3campaign.<extension>
+CAMPAIGN_EXTENSIONS = ('w3u', 'w3t', 'w3a', 'w3b', 'w3d', 'w3q', 'w3h', 'w3f',
+                       'wts', 'imp')
+
+# Reforged skin files, war3mapSkin.<extension>
+SKIN_EXTENSIONS = ('w3u', 'w3t', 'w3a', 'w3b', 'w3d', 'w3h', 'w3q', 'txt')
+
+RACES = ('Human', 'Orc', 'Undead', 'NightElf', 'Neutral', 'Campaign',
+         'Common', 'Item')
+
+KINDS = ('Unit', 'Ability', 'Upgrade')
+
+OTHER_NAMES = (
+    "(listfile)", "(attributes)", "(signature)",
+    "war3mapUnits.doo", "war3mapMap.blp", "war3mapMap.tga",
+    "war3mapMap.b00", "war3mapPreview.tga", "war3mapPath.tga",
+    "war3mapMisc.txt", "war3mapExtra.txt",
+    "Scripts\\war3map.j", "scripts\\war3map.j", "Scripts\\war3map.lua",
+    "Scripts\\common.j", "Scripts\\Blizzard.j", "Scripts\\common.ai",
+    "Units\\UnitData.slk", "Units\\UnitUI.slk", "Units\\UnitBalance.slk",
+    "Units\\UnitAbilities.slk", "Units\\UnitWeapons.slk",
+    "Units\\AbilityData.slk", "Units\\AbilityBuffData.slk",
+    "Units\\ItemData.slk", "Units\\UpgradeData.slk",
+    "Units\\DestructableData.slk", "Units\\UnitMetaData.slk",
+    "Units\\AbilityMetaData.slk", "Units\\UpgradeMetaData.slk",
+    "Units\\DestructableMetaData.slk", "Units\\MiscData.txt",
+    "Units\\MiscGame.txt", "Units\\ItemFunc.txt", "Units\\ItemStrings.txt",
+    "Units\\CommandFunc.txt", "Units\\CommandStrings.txt",
+    "Doodads\\Doodads.slk", "Doodads\\DoodadMetaData.slk",
+    "TerrainArt\\Terrain.slk", "TerrainArt\\CliffTypes.slk",
+    "TerrainArt\\Water.slk", "UI\\MiscData.txt", "UI\\MiscUI.txt",
+    "UI\\SoundInfo\\AnimLookups.slk", "UI\\SoundInfo\\UnitAckSounds.slk",
+    "UI\\SoundInfo\\UnitCombatSounds.slk", "UI\\SoundInfo\\AmbienceSounds.slk",
+    "UI\\SoundInfo\\MIDISounds.slk", "UI\\SoundInfo\\UISounds.slk",
+    "UI\\WorldEditStrings.txt", "UI\\WorldEditData.txt",
+    "UI\\TriggerData.txt", "UI\\TriggerStrings.txt",
+    "UI\\FrameDef\\GlobalStrings.fdf", "UI\\war3skins.txt",
+    "Splats\\SplatData.slk", "Splats\\UberSplatData.slk",
+    "Splats\\LightningData.slk", "Splats\\SpawnData.slk",
+    "ReplaceableTextures\\Selection\\SpellAreaOfEffect.blp",
+    "LoadingScreen.mdx", "war3mapImported\\LoadingScreen.mdx",
+)
+
+
+def _known_names():
+    names = ['war3map.' + extension for extension in MAP_EXTENSIONS]
+    names += ['war3campaign.' + extension
+              for extension in CAMPAIGN_EXTENSIONS]
+    names += ['war3mapSkin.' + extension for extension in SKIN_EXTENSIONS]
+    for race in RACES:
+        for kind in KINDS:
+            names.append('Units\\' + race + kind + 'Func.txt')
+            names.append('Units\\' + race + kind + 'Strings.txt')
+    return tuple(names) + OTHER_NAMES
+
+KNOWN_NAMES = _known_names()
@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+"""Load generator"""
+# Replays a corpus of maps against a running server, or against the Flask
+# application in this process, to size the fleet. Uploads are sent either
+# with a fixed number of them in flight (--concurrency) or at a fixed
+# arrival rate (--rate), their latency is then counted from the time they
+# were due so a stalled server isn't hidden by the load generator waiting
+# for it. The report has the throughput, latency percentiles, errors by
+# their map_error() reason and the server's peak memory and temporary disk
+# use, as JSON so runs of different serving modes and config.py settings
+# can be compared side by side (--compare).
+
+import argparse
+import ast
+import concurrent.futures
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+import config
+import workspace
+
+BOUNDARY = 'kraftver-loadtest-boundary'
+CONTENT_TYPE = 'multipart/form-data; boundary=' + BOUNDARY
+
+PERCENTILES = (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))
+
+# rows of the --compare table: title, path in the report, scale
+COMPARED = (
+    ("throughput (maps/s)", ("throughput",), 1),
+    ("latency p50 (ms)", ("latency", "p50"), 1000),
+    ("latency p95 (ms)", ("latency", "p95"), 1000),
+    ("latency p99 (ms)", ("latency", "p99"), 1000),
+    ("error rate (%)", ("error_rate",), 100),
+    ("peak RSS (MB)", ("peak_rss",), 1.0 / (1024 * 1024)),
+    ("peak PSS (MB)", ("peak_pss",), 1.0 / (1024 * 1024)),
+    ("peak temp disk (MB)", ("peak_temporary_disk",), 1.0 / (1024 * 1024)),
+)
+
+
+def upload_body(map_bytes, file_name):
+    """Returns the multipart/form-data body uploading the map."""
+    return (b'--' + BOUNDARY.encode('ascii') + b'\r\n'
+            b'Content-Disposition: form-data; name="map"; filename="' +
+            file_name.replace('"', '').encode('utf-8') + b'"\r\n'
+            b'Content-Type: application/octet-stream\r\n\r\n' +
+            map_bytes + b'\r\n--' + BOUNDARY.encode('ascii') + b'--\r\n')
+
+
+class HTTPClient(object):
+    """Uploads maps to a running server over a keep-alive connection."""
+
+    def __init__(self, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = (parts.path or '/') + \
+            ('?' + parts.query if parts.query else '')
+        self.timeout = timeout
+        self.connection = None
+
+    def post(self, body):
+        """Returns the status and body of the response to the upload."""
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request('POST', self.path, body,
+                                    {'Content-Type': CONTENT_TYPE})
+            response = self.connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+        if response.will_close:
+            self.connection.close()
+            self.connection = None
+        return response.status, data
+
+
+class FlaskClient(object):
+    """Uploads maps to the Flask application of this process."""
+
+    def __init__(self, application, path):
+        self.client = application.test_client()
+        self.path = path
+
+    def post(self, body):
+        """Returns the status and body of the response to the upload."""
+        response = self.client.post(self.path, data=body,
+                                    content_type=CONTENT_TYPE)
+        return response.status_code, response.get_data()
+
+
+def error_reason(error):
+    """Returns the reason of a map_error() message, without its details."""
+    return error.split(': ', 1)[0]
+
+
+def outcome(status, data):
+    """Returns the error reason of a response, None if the map was read."""
+    try:
+        error = json.loads(data).get('error')
+    except (ValueError, AttributeError):
+        return "HTTP %d" % status
+    if error is not None:
+        return error_reason(error)
+    if status != 200:
+        return "HTTP %d" % status
+    return None
+
+
+def process_tree(pid):
+    """Returns the given pid and the pids of all of its descendants."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/' + name + '/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may hold spaces and parentheses
+        ppid = int(stat[stat.rindex(b')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    tree = [pid]
+    for parent in tree:
+        tree.extend(children.get(parent, ()))
+    return tree
+
+
+def memory_usage(pids):
+    """
+    Returns the summed RSS and PSS of the given processes in bytes. The RSS
+    counts the pages forked workers share once per worker, the PSS splits
+    them between the workers. The PSS is None if it can't be read.
+    """
+    rss = 0
+    pss = 0
+    for pid in pids:
+        try:
+            with open('/proc/%d/status' % pid, 'r') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+        if pss is None:
+            continue
+        try:
+            with open('/proc/%d/smaps_rollup' % pid, 'r') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        pss += int(line.split()[1]) * 1024
+        except FileNotFoundError:
+            continue  # the process just exited
+        except OSError:
+            pss = None  # not ours or an older kernel
+
+    return rss, pss
+
+
+def temporary_disk(directories):
+    """
+    Returns the bytes allocated to the upload workspace files and to the
+    files under the given directories.
+    """
+    total = 0
+    if config.WORKSPACE_DIR is not None:
+        try:
+            for entry in os.scandir(config.WORKSPACE_DIR):
+                if workspace.WORKSPACE_NAME.match(entry.name) and \
+                   entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_blocks * 512
+        except OSError:
+            pass
+
+    for directory in directories:
+        for root, subdirs, files in os.walk(directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    total += os.lstat(path).st_blocks * 512
+                except OSError:
+                    continue
+    return total
+
+
+class ResourceMonitor(object):
+    """
+    Samples the memory of the server's process tree and the temporary disk
+    use every interval seconds in a thread, keeping the peaks. Without a
+    pid only the disk is sampled.
+    """
+
+    def __init__(self, pid, directories, interval):
+        self.pid = pid
+        self.directories = directories
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peaks = {"peak_rss": None, "peak_pss": None,
+                      "peak_temporary_disk": 0}
+        self.start_rss = None
+        self.thread = None
+
+    def _sample(self):
+        disk = temporary_disk(self.directories)
+        self.peaks["peak_temporary_disk"] = max(
+            self.peaks["peak_temporary_disk"], disk)
+        if self.pid is None:
+            return
+
+        rss, pss = memory_usage(process_tree(self.pid))
+        self.peaks["peak_rss"] = max(self.peaks["peak_rss"] or 0, rss)
+        if pss is not None:
+            self.peaks["peak_pss"] = max(self.peaks["peak_pss"] or 0, pss)
+        if self.start_rss is None:
+            self.start_rss = rss
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._sample()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the peaks."""
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+        result = dict(self.peaks)
+        result["start_rss"] = self.start_rss
+        return result
+
+
+class Recorder(object):
+    """Collects the latency and outcome of every upload."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = {}
+        self.statuses = {}
+        self.bytes = 0
+
+    def add(self, latency, status, reason, size):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if reason is not None:
+                self.errors[reason] = self.errors.get(reason, 0) + 1
+            self.bytes += size
+
+
+def send(client, body, due, recorder):
+    """
+    Uploads the body and records how long it took from the time it was due
+    to the end of the response.
+    """
+    try:
+        status, data = client.post(body)
+        reason = outcome(status, data)
+    except Exception as e:  # refused, reset, timed out...
+        status = None
+        reason = "connection error: " + type(e).__name__
+    recorder.add(time.perf_counter() - due, status, reason, len(body))
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of the sorted values."""
+    if not values:
+        return None
+    rank = max(int(fraction * len(values) + 0.999999) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run_closed(clients, bodies, requests, deadline, recorder):
+    """
+    Keeps an upload in flight per client until requests were sent or the
+    deadline passed.
+    """
+    lock = threading.Lock()
+    sent = [0]
+
+    def loop(client):
+        while True:
+            with lock:
+                if sent[0] >= requests or time.perf_counter() >= deadline:
+                    return
+                body = bodies[sent[0] % len(bodies)]
+                sent[0] += 1
+            send(client, body, time.perf_counter(), recorder)
+
+    threads = [threading.Thread(target=loop, args=(client,))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open(clients, bodies, requests, deadline, rate, recorder):
+    """
+    Sends rate uploads a second until requests were sent or the deadline
+    passed, using at most one client per upload in flight. Uploads which
+    have to wait for a free client count the wait in their latency.
+    """
+    idle = list(clients)
+    lock = threading.Lock()
+
+    def task(body, due):
+        with lock:
+            client = idle.pop()
+        try:
+            send(client, body, due, recorder)
+        finally:
+            with lock:
+                idle.append(client)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(len(clients)) as pool:
+        for i in range(requests):
+            due = started + i / rate
+            if due >= deadline:
+                break
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(task, bodies[i % len(bodies)], due)
+
+
+def summarize(recorder, seconds, peaks):
+    """Returns the report of a run."""
+    latencies = sorted(recorder.latencies)
+    count = len(latencies)
+    error_count = sum(recorder.errors.values())
+    report = {
+        "requests": count,
+        "seconds": round(seconds, 6),
+        "throughput": round(count / seconds, 3) if seconds else None,
+        "upload_bytes_per_second": round(recorder.bytes / seconds) if
+        seconds else None,
+        "latency": {
+            "mean": round(sum(latencies) / count, 6) if count else None,
+            "max": round(latencies[-1], 6) if count else None,
+        },
+        "errors": recorder.errors,
+        "error_rate": round(error_count / count, 6) if count else None,
+        "status_codes": dict((str(status), number) for status, number in
+                             recorder.statuses.items()),
+    }
+    for name, fraction in PERCENTILES:
+        value = percentile(latencies, fraction)
+        report["latency"][name] = round(value, 6) if value is not None \
+            else None
+    report.update(peaks)
+    return report
+
+
+def compare(reports, labels):
+    """Writes the main figures of the reports side by side."""
+    width = max([len(label) for label in labels] + [10])
+    print("%-22s" % "" + ''.join(" %*s" % (width, label)
+                                 for label in labels))
+    for title, path, scale in COMPARED:
+        cells = []
+        for report in reports:
+            value = report
+            for key in path:
+                value = value.get(key) if value is not None else None
+            cells.append(" %*s" % (width, "-" if value is None else
+                                   "%.1f" % (value * scale)))
+        print("%-22s" % title + ''.join(cells))
+
+
+def apply_settings(settings):
+    """
+    Applies the NAME=VALUE settings to config, values are Python literals
+    or else strings. Returns them as a dictionary.
+    """
+    applied = {}
+    for setting in settings:
+        name, separator, value = setting.partition('=')
+        if not separator or not name.isupper() or not hasattr(config, name):
+            raise ValueError("unknown setting: " + setting)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        setattr(config, name, value)
+        applied[name] = value
+    return applied
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Replays Warcraft III maps against the server and "
+                    "reports its throughput, latency, errors and resource "
+                    "use.")
+    parser.add_argument("sources", nargs="*",
+                        help="directories (searched recursively for .w3m, "
+                             ".w3x and .w3n files) or globs of maps")
+    parser.add_argument("-u", "--url",
+                        help="URL of a running server to upload to, e.g. "
+                             "http://127.0.0.1:8080/ (the application is "
+                             "run in this process by default)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4,
+                        help="uploads in flight, the most of them with "
+                             "--rate")
+    parser.add_argument("-r", "--rate", type=float,
+                        help="uploads started a second instead of keeping "
+                             "--concurrency of them in flight")
+    parser.add_argument("-n", "--requests", type=int,
+                        help="uploads to send (one pass over the maps by "
+                             "default)")
+    parser.add_argument("-d", "--duration", type=float,
+                        help="stop sending uploads after this many seconds")
+    parser.add_argument("--warmup", type=int, default=0,
+                        help="uploads sent one by one before the run, "
+                             "which don't count")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="replay the maps in a random order")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the --shuffle order")
+    parser.add_argument("--fields",
+                        help="comma separated response fields to ask for")
+    parser.add_argument("--server-pid", type=int,
+                        help="pid of the server's master process, its "
+                             "process tree's memory is sampled (this "
+                             "process' own in-process)")
+    parser.add_argument("--disk-dir", action="append", default=[],
+                        help="directory whose files count as temporary disk "
+                             "use besides the upload workspaces, may be "
+                             "repeated")
+    parser.add_argument("--interval", type=float, default=0.1,
+                        help="seconds between resource samples")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds to wait for a response")
+    parser.add_argument("-s", "--set", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="config.py setting of the in-process "
+                             "application, may be repeated")
+    parser.add_argument("-l", "--label",
+                        help="name of the run in --compare tables")
+    parser.add_argument("-o", "--output",
+                        help="file to write the JSON report to (stdout by "
+                             "default), .jsonl files get a line appended")
+    parser.add_argument("--compare", nargs="+", metavar="REPORT",
+                        help="print the reports in the given JSON or JSONL "
+                             "files side by side and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for path in args.compare:
+            with open(path, 'r') as f:
+                reports += [json.loads(line) for line in f.read().split('\n')
+                            if line.strip()] if path.endswith('.jsonl') \
+                    else [json.loads(f.read())]
+        compare(reports, [report["run"].get("label") or str(i + 1)
+                          for i, report in enumerate(reports)])
+        return
+
+    if not args.sources:
+        parser.error("no maps to replay")
+    if args.concurrency < 1:
+        parser.error("the concurrency must be at least 1")
+    if args.rate is not None and args.rate <= 0:
+        parser.error("the rate must be positive")
+    if args.url is not None:
+        if urllib.parse.urlsplit(args.url).scheme != 'http':
+            parser.error("only http:// URLs are supported")
+        if args.set:
+            parser.error("--set only applies to the in-process application")
+
+    try:
+        settings = apply_settings(args.set)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # main (which indexer imports) reads the settings when it's imported
+    import indexer
+    import main
+
+    paths = list(indexer.find_maps(args.sources))
+    if not paths:
+        parser.error("no maps found")
+    bodies = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            bodies.append(upload_body(f.read(), os.path.basename(path)))
+    if args.shuffle:
+        random.Random(args.seed).shuffle(bodies)
+
+    query = ''
+    if args.fields:
+        query = urllib.parse.urlencode({'fields': args.fields})
+    if args.url is not None:
+        url = args.url
+        if query:
+            url += ('&' if '?' in url else '?') + query
+        clients = [HTTPClient(url, args.timeout)
+                   for i in range(args.concurrency)]
+        pid = args.server_pid
+    else:
+        if main.SANDBOX is not None:
+            main.SANDBOX.start()
+        path = '/?' + query if query else '/'
+        clients = [FlaskClient(main.KRAFTVER, path)
+                   for i in range(args.concurrency)]
+        pid = args.server_pid or os.getpid()
+
+    for i in range(args.warmup):
+        try:
+            clients[0].post(bodies[i % len(bodies)])
+        except Exception:
+            pass
+
+    requests = args.requests
+    if requests is None:
+        requests = sys.maxsize if args.duration else len(bodies)
+    monitor = ResourceMonitor(pid, args.disk_dir, args.interval)
+    recorder = Recorder()
+
+    monitor.start()
+    started = time.perf_counter()
+    deadline = started + args.duration if args.duration else float('inf')
+    if args.rate is None:
+        run_closed(clients, bodies, requests, deadline, recorder)
+    else:
+        run_open(clients, bodies, requests, deadline, args.rate, recorder)
+    seconds = time.perf_counter() - started
+    peaks = monitor.stop()
+
+    report = summarize(recorder, seconds, peaks)
+    report["run"] = {
+        "label": args.label,
+        "target": args.url or "in-process",
+        "concurrency": args.concurrency,
+        "rate": args.rate,
+        "maps": len(bodies),
+        "fields": args.fields,
+        "settings": settings,
+        "started": time.time() - seconds,
+    }
+
+    if args.output is None:
+        print(json.dumps(report, sort_keys=True, indent=4))
+    elif args.output.endswith('.jsonl'):
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(report, sort_keys=True) + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, sort_keys=True, indent=4)
+            f.write('\n')
+
+    sys.stderr.write("%d maps in %.1f s, %.1f maps/s, p50 %.1f ms, p99 %.1f "
+                     "ms, %d errors\n" %
+                     (report["requests"], seconds, report["throughput"] or 0,
+                      (report["latency"]["p50"] or 0) * 1000,
+                      (report["latency"]["p99"] or 0) * 1000,
+                      sum(recorder.errors.values())))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -3,20 +3,323 @@
 # Kraftver is a simple Flask webserver to which you can upload an Warcraft III
 # map (in .w3c and .w3x formats) and get the map data back as a JSON response.
 
-import uuid
-import os
+import concurrent.futures
+import hashlib
+import hmac
+import io
 import json
-import shutil
-import subprocess
+import mmap
+import os
+import multiprocessing
+import random
+import signal
+import sqlite3
 import struct
+import tarfile
+import threading
+import time
+import urllib.parse
+import zipfile
+import cache
+import catalog
 import config
-
-from flask import Flask, request
+import doo
+import jass
+import jobs
+import metrics
+import mpq
+import profiling
+import sandbox
+import thumbnails
+import upload
+import w3e
+import w3f
+import w3i
+import workspace
+import wtg
+import wts
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from flask import Flask, Request, Response, request
 from werkzeug.utils import secure_filename
 
+
+class MappedUpload(object):
+    """
+    Write-once upload container backed by an anonymous mmap, used for maps
+    too big to be kept in a regular bytes buffer. The mapping is reserved
+    for the whole request body, the kernel only backs the pages we write to.
+    """
+
+    def __init__(self, capacity):
+        self.mapping = mmap.mmap(-1, max(capacity, 1))
+        self.size = 0
+
+    def write(self, data):
+        self.mapping.write(data)
+        self.size = max(self.size, self.mapping.tell())
+        return len(data)
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.mapping.tell()
+        elif whence == 2:  # relative to the end of the upload, not the mapping
+            position += self.size
+        if position < 0 or position > len(self.mapping):
+            raise OSError("seek out of range")
+        self.mapping.seek(position)
+        return position
+
+    def tell(self):
+        return self.mapping.tell()
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.mapping.tell()
+        size = min(size, self.size - self.mapping.tell())
+        return self.mapping.read(max(size, 0))
+
+    def getbuffer(self):
+        """Returns a memoryview over the written part of the mapping."""
+        return memoryview(self.mapping)[:self.size]
+
+    def close(self):
+        try:
+            self.mapping.close()
+        except BufferError:  # a view is still alive, the GC will unmap it
+            pass
+
+
+def upload_spool(capacity):
+    """
+    Returns the container of an upload of up to capacity bytes too big to be
+    kept in a bytes buffer. Raises workspace.WorkspaceFull if the workspaces
+    are out of quota.
+    """
+    if WORKSPACES is not None:
+        return WORKSPACES.acquire(capacity)
+
+    return MappedUpload(capacity)
+
+
+class CheckedUpload(object):
+    """
+    Upload container which checks the map as it's written, the form parser
+    stops reading the request as soon as it turns out not to be a map.
+    """
+
+    def __init__(self, stream, checker):
+        self.stream = stream
+        self.checker = checker
+
+    def write(self, data):
+        self.checker.feed(data)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class KraftverRequest(Request):
+    """Request which keeps uploaded maps in memory instead of on disk."""
+
+    # set by the views whose response reads the uploads while it's streamed,
+    # the uploads are closed with the response instead, see close_uploads()
+    streams_uploads = False
+
+    def close(self):
+        if not self.streams_uploads:
+            self.close_uploads()
+
+    def close_uploads(self):
+        """Closes the uploaded files."""
+        super().close()
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if total_content_length is not None and \
+           total_content_length <= config.MEMORY_UPLOAD_THRESHOLD * 1024 * 1024:
+            stream = io.BytesIO()
+        else:
+            stream = upload_spool(total_content_length or
+                                  KRAFTVER.config['MAX_CONTENT_LENGTH'])
+
+        if self.endpoint in MAP_UPLOAD_ENDPOINTS:
+            return CheckedUpload(stream, upload.MapChecker(
+                filename, total_content_length))
+        return stream
+
+
+# Workspace files of the big uploads, kept by every worker process
+WORKSPACES = None
+if config.WORKSPACE_DIR is not None:
+    WORKSPACES = workspace.WorkspacePool(config.WORKSPACE_DIR,
+                                         config.WORKSPACE_QUOTA * 1024 * 1024)
+
 KRAFTVER = Flask(__name__)
+KRAFTVER.request_class = KraftverRequest
 KRAFTVER.config['MAX_CONTENT_LENGTH'] = config.MAX_MAP_SIZE * 1024 * 1024
 
+# Flags and max players number which follow the map name in the HM3W header
+MAP_HEADER_TAIL = struct.Struct('<4sI')
+
+# Views taking a single map in the "map" field, their uploads are checked
+# while they're received
+MAP_UPLOAD_ENDPOINTS = ('route', 'thumbnail_route', 'submit_job')
+
+# Archive members read_map needs from every map
+MAP_MEMBERS = ('war3map.w3e', 'war3map.wts', 'war3map.w3i')
+
+# Object placement members, read when they're there: protected maps often
+# drop war3mapUnits.doo since only the editor needs it
+OBJECT_MEMBERS = ('war3map.doo', 'war3mapUnits.doo')
+
+# The map script (older maps keep it in the scripts folder) and the trigger
+# file, both optional. They're streamed a sector at a time instead of being
+# read into memory.
+SCRIPT_MEMBERS = ('war3map.j', 'scripts\\war3map.j', 'war3map.wtg')
+
+# Campaigns are archives of maps, their info file lists the maps and the
+# archive members they're stored in
+CAMPAIGN_INFO = 'war3campaign.w3f'
+CAMPAIGN_STRINGS = 'war3campaign.wts'
+
+# Stages of read_map(), in the order they run
+STAGES = ('header', 'extract', 'tileset', 'terrain', 'strings', 'w3i',
+          'objects', 'script', 'maps')
+
+# Archive members every stage needs
+STAGE_MEMBERS = {
+    'tileset': ('war3map.w3e',),
+    'terrain': ('war3map.w3e',),
+    'strings': ('war3map.wts',),
+    'w3i': ('war3map.w3i',),
+}
+
+# Stages each response field needs, the "fields" request parameter picks
+# the fields and only their stages are run
+FIELD_STAGES = {
+    "warning": ('extract',),
+    "map_name": ('header',),
+    "map_flags": ('header',),
+    "max_players": ('header',),
+    "tileset": ('tileset',),
+    "terrain": ('terrain',),
+    "map_flags_w3i": ('w3i',),
+    "main_ground_type": ('w3i',),
+    "expansion_required": ('w3i',),
+    "map_version": ('w3i',),
+    "editor_version": ('w3i',),
+    "game_version": ('w3i',),
+    "script_language": ('w3i',),
+    "left_camera_bound": ('w3i',),
+    "right_camera_bound": ('w3i',),
+    "top_camera_bound": ('w3i',),
+    "bottom_camera_bound": ('w3i',),
+    "playable_map_area_height": ('w3i',),
+    "playable_map_area_width": ('w3i',),
+    "map_height": ('w3i',),
+    "map_width": ('w3i',),
+    "upgrades": ('w3i',),
+    "tech": ('w3i',),
+    "map_name_info_file": ('w3i', 'strings'),
+    "map_author": ('w3i', 'strings'),
+    "map_description": ('w3i', 'strings'),
+    "recommended_players": ('w3i', 'strings'),
+    "players": ('w3i', 'strings'),
+    "forces": ('w3i', 'strings'),
+    "objects": ('w3i', 'objects'),
+    "script": ('script',),
+    "campaign": ('extract',),
+    "maps": ('extract', 'maps'),
+}
+
+# Fields of every response, whichever fields were asked for
+BASE_FIELDS = ('success', 'error', 'file_name')
+
+# Response formats ("format" request parameter) and their mimetypes, the
+# compact JSON has no whitespace, msgpack needs the msgpack package
+OUTPUT_FORMATS = {
+    'json': 'text/html',
+    'compact': 'text/html',
+    'msgpack': 'application/msgpack',
+}
+
+# Bump this whenever the response for a map changes, cached responses of
+# other parser versions are ignored
+PARSER_VERSION = 7
+
+RESULT_CACHE = cache.ResultCache(config.CACHE_MEMORY_ENTRIES, config.CACHE_DB,
+                                 config.CACHE_DB_ENTRIES)
+
+# Parse results of single archive members, shared by the versions of a map
+# which have the same members, created by member_cache() on the first use
+MEMBER_CACHE = None
+MEMBER_CACHE_LOCK = threading.Lock()
+
+# Settings the sandbox workers take from the server process with every job,
+# it may have changed them after importing this module (bench.py does) while
+# the workers' forkserver imported config.py again
+SANDBOX_SETTINGS = ('CACHE_ENABLED', 'MEMBER_CACHE_ENTRIES', 'MEMBER_CACHE_DB',
+                    'MEMBER_CACHE_DB_ENTRIES')
+
+# Rendered thumbnails, shared by all workers on the node
+THUMBNAIL_CACHE = None
+if config.THUMBNAIL_CACHE_DIR is not None:
+    THUMBNAIL_CACHE = cache.FileCache(config.THUMBNAIL_CACHE_DIR,
+                                      config.THUMBNAIL_CACHE_SIZE *
+                                      1024 * 1024)
+
+# Maps read so far, searched by GET /search
+CATALOG = None
+if config.SEARCH_DB is not None:
+    CATALOG = catalog.MapCatalog(config.SEARCH_DB)
+
+# Profiles of the maps read under the profiler, listed by GET /profiles
+PROFILES = None
+if config.PROFILE_DIR is not None:
+    PROFILES = profiling.ProfileStore(config.PROFILE_DIR,
+                                      config.PROFILE_ENTRIES,
+                                      config.PROFILE_TOP_FUNCTIONS)
+
+# Header carrying ADMIN_TOKEN, uploads sent with it are profiled
+ADMIN_HEADER = 'X-Kraftver-Admin'
+
+# Stages a response needs to be recorded in the catalog
+CATALOG_STAGES = ('header', 'tileset', 'strings', 'w3i')
+
+# Parameters of GET /search which aren't filters
+SEARCH_PARAMETERS = ('q', 'page', 'page_size')
+
+# Process pool for batch uploads, created on the first batch
+BATCH_POOL = None
+
+# Whether this is a process of BATCH_POOL, which can't start processes
+BATCH_WORKER = False
+
+# Worker processes reading the maps under the time and memory limits, the
+# forkserver they're forked from has this module imported already
+SANDBOX = None
+if config.SANDBOX_WORKERS:
+    SANDBOX = sandbox.SandboxPool(config.SANDBOX_WORKERS,
+                                  config.SANDBOX_TIMEOUT,
+                                  config.SANDBOX_MEMORY * 1024 * 1024,
+                                  preload=[__name__],
+                                  wait=config.SANDBOX_WAIT)
+
+# Error of the maps which go past the reading limits, the details follow it
+LIMIT_ERROR = "map exceeds the reading limits: "
+
 def decode_tileset(tile_char):
     """
     Returns the string describing the tileset (ground type) for a given char.
@@ -64,216 +367,302 @@ def decode_tileset(tile_char):
     return tile_char
 
 
-def read_map(file_name, unpack_dir_name):
-    """Reads the map name from the supplied file and returns data about it."""
-    map_name = ""
-    map_flags = ""
-
-    with open(file_name, "rb") as map_file:
-        # Read the map name, map name is stored from 9th byte until the \x00.
-        map_file.seek(8)
+def read_map_header(map_buffer):
+    """
+    Reads the map name, flags and max players number from the 512 bytes long
+    HM3W header which precedes the MPQ archive.
+    """
+    header = bytes(map_buffer[:512])
 
-        # while our byte isn't zero, read the bytes and convert them to text
-        byte = map_file.read(1)
-        while byte != b'\x00':
-            try:
-                map_name += byte.decode('utf-8')
-            except UnicodeDecodeError:  # probably utf8 char so we need 1 more byte
-                byte += map_file.read(1)
-                map_name += byte.decode('utf-8')
-
-            byte = map_file.read(1)
-
-        # Read the flags from the w3x header and transform them to a string
-        # of ones and zeros
-        for i in range(4):
-            byte = map_file.read(1)
-            byte = ord(byte)
-            byte = bin(byte)[2:].rjust(8, '0')
-            for bit in byte:
-                map_flags += str(bit)
-
-        # read the max players number
-        max_player_num = map_file.read(4)
-        max_player_num = int.from_bytes(max_player_num, byteorder='little')
-
-    # Extract the MPQ archive from the map file
+    # Map name is stored from 9th byte until the \x00, followed by the flags
+    # and the max players number
     try:
-        warning = extract_map_file(file_name, unpack_dir_name)
-    except ValueError as e:
-        raise ValueError(e)
-
-    # Reads the tileset from the file
-    if is_valid_w3e(unpack_dir_name + '/war3map.w3e'):
-        with open(unpack_dir_name + '/war3map.w3e', "rb") as f:
-            # 9nth byte contains the tileset
-            main_tileset = f.read(9)
-            main_tileset = main_tileset[-1]
-            main_tileset = str(chr(main_tileset))
-
-            # Determine the tileset from the char
-            main_tileset = decode_tileset(main_tileset)
-    else:
-        raise ValueError("doesn't contain a valid .w3e file")
+        name_end = header.index(b'\x00', 8)
+        map_flags, max_player_num = MAP_HEADER_TAIL.unpack_from(header,
+                                                                name_end + 1)
+    except (ValueError, struct.error):
+        raise ValueError("map header is truncated")
+
+    return header[8:name_end].decode('utf-8'), w3i.bit_string(map_flags), \
+        max_player_num
+
+
+def w3i_string(raw_string, strings_array, encoding='utf-8'):
+    """
+    Decodes a string from the w3i file. Strings which are references into
+    the strings file (TRIGSTR_xxx) are looked up in the strings_array.
+    """
+    string = raw_string.decode(encoding, 'replace')
+    if 'TRIGSTR' in string:
+        return strings_array[string]
+
+    return string
+
+
+class ArchiveMembers(object):
+    """
+    The members of a map's archive, decompressed when they're first looked
+    up so the ones whose results are in MEMBER_CACHE never are. The
+    streamed ones are iterators over their decompressed sectors instead of
+    bytes.
+    """
+
+    def __init__(self, archive, streamed_names=()):
+        self.archive = archive
+        self.streamed_names = streamed_names
+        self.members = {}
+
+    def __contains__(self, name):
+        return self.archive.has_file(name)
+
+    def __getitem__(self, name):
+        if name in self.streamed_names:
+            return self.archive.iter_file(name)
+        if name not in self.members:
+            self.members[name] = self.archive.read_file(name)
+        return self.members[name]
+
+    def digest(self, name):
+        """Returns the member's digest, None if there's no such member."""
+        try:
+            return self.archive.member_digest(name)
+        except KeyError:
+            return None
+
+
+class CachedStrings(object):
+    """
+    String table of a map which looks strings up among the ones cached for
+    its string file first. The file is only decompressed (and validated)
+    for the others or when nothing is cached, the strings looked up are
+    cached for the next versions of the map.
+    """
+
+    def __init__(self, members):
+        self.members = members
+        self.table = None
+        self.strings = {}
+        self.added = False
+        self.key = None
+        self.cache = member_cache()
+        if self.cache is not None:
+            self.key = member_key('strings', members, ('war3map.wts',))
+            strings = self.cache.get(self.key)
+            if strings is not None:
+                self.strings = json.loads(strings)
+        if not self.strings:
+            self._load()
+
+    def _load(self):
+        if self.table is None:
+            self.table = read_string_file(self.members['war3map.wts'])
+
+    def __getitem__(self, reference):
+        value = self.strings.get(reference)
+        if value is None:
+            self._load()
+            value = self.strings[reference] = self.table[reference]
+            self.added = True
+        return value
+
+    def save(self):
+        """Caches the strings looked up."""
+        if self.added and self.key is not None:
+            self.cache.put(self.key, json.dumps(self.strings,
+                                                sort_keys=True))
+
+
+def read_map(map_buffer, stages=STAGES):
+    """
+    Reads the map name from the supplied map buffer and returns data about
+    it. Only the given stages are run (see FIELD_STAGES), the data of the
+    others is left out, the MPQ archive isn't opened if none of them needs
+    it.
+    """
+    map_data = {}
+
+    if 'header' in stages:
+        with metrics.stage('header'):
+            map_name, map_flags, max_player_num = read_map_header(map_buffer)
+        map_data.update({
+            "map_name": map_name,
+            "map_flags": map_flags,
+            "max_players": max_player_num,
+        })
+
+    member_names = []
+    for stage in STAGES:
+        for member_name in STAGE_MEMBERS.get(stage, ()):
+            if stage in stages and member_name not in member_names:
+                member_names.append(member_name)
+    optional_names = OBJECT_MEMBERS if 'objects' in stages else ()
+    streamed_names = SCRIPT_MEMBERS if 'script' in stages else ()
+    if not member_names and not optional_names and not streamed_names and \
+       'extract' not in stages:
+        return map_data
+
+    # Open the map's MPQ archive, campaigns have none of the members we
+    # need. The members are only decompressed if their results aren't
+    # cached.
+    with metrics.stage('extract'):
+        archive, warning = open_map_archive(map_buffer)
+        campaign = archive.has_file(CAMPAIGN_INFO)
+        if not campaign:
+            for member_name in member_names:
+                if not archive.has_file(member_name):
+                    raise ValueError("can't find " + member_name +
+                                     " inside the map file")
+            members = ArchiveMembers(archive, streamed_names)
+    map_data["warning"] = warning
+
+    if campaign:
+        map_data.update(read_campaign(archive, stages))
+        return map_data
+
+    # Reads the tileset from the file, 9nth byte contains the tileset
+    if 'tileset' in stages or 'terrain' in stages:
+        with metrics.stage('w3e'):
+            if 'tileset' in stages:
+                map_data["tileset"] = cached_result(
+                    'tileset', members, ('war3map.w3e',),
+                    lambda: decode_tileset(chr(read_w3e(members)[8])))
+            if 'terrain' in stages:
+                map_data["terrain"] = cached_result(
+                    'terrain', members, ('war3map.w3e',),
+                    lambda: read_terrain(read_w3e(members)),
+                    config.TERRAIN_HEIGHTMAP_SIZE, w3e.numpy is not None)
 
     # Read the .w3s string file
-    try:
-        strings_array = read_string_file(unpack_dir_name)
-    except ValueError as e:
-        raise ValueError(e)
-
-    # Read the expansion state
-    with open(unpack_dir_name + '/war3map.w3i', 'rb') as f:
-        # first 4 bytes contain infofile format version
-        info_file_bytes = f.read(4)
-        infofile_format_ver = int.from_bytes(info_file_bytes,
-                                             byteorder='little')
-
-        if infofile_format_ver == 18:
-            expansion_required = 'No'
-        elif infofile_format_ver == 25:
-            expansion_required = 'Yes'
-        else:
-            expansion_required = str(infofile_format_ver) + ' (bug?)'
-
-        # second 4 bytes contain the number of saves during the map
-        # development (ie. map version)
-        info_file_bytes = f.read(4)
-        map_version = int.from_bytes(info_file_bytes, byteorder='little')
-
-        # third 4 bytes contain the version of editor used to create the map
-        info_file_bytes = f.read(4)
-        editor_version = int.from_bytes(info_file_bytes, byteorder='little')
-
-        # read the string id from strings file describing map name, again
-        info_file_bytes = 1
-        map_name_infofile = ""
-        while info_file_bytes != 0:
-            info_file_bytes = f.read(1)
-            info_file_bytes = info_file_bytes[0]
-            map_name_infofile += str(chr(info_file_bytes))
-        if 'TRIGSTR' in map_name_infofile:
-            # remove the \x00 garbage at the end
-            map_name_infofile = map_name_infofile.replace('\000', '')
-            # read the correct string from the strings_array
-            map_name_infofile = strings_array[map_name_infofile]
-        else:
-            map_name_infofile = map_name_infofile[:-1]
-
-        # read the string id from strings file describing map author
-        info_file_bytes = 1
-        map_author = ""
-        while info_file_bytes != 0:
-            info_file_bytes = f.read(1)
-            info_file_bytes = info_file_bytes[0]
-            map_author += str(chr(info_file_bytes))
-        if 'TRIGSTR' in map_author:
-            map_author = map_author.replace('\000', '')
-            map_author = strings_array[map_author]
-        else:
-            map_author = map_author.replace('\000', '')
-
-        # read the string id from strings file describing map description
-        info_file_bytes = 1
-        map_description = ""
-        while info_file_bytes != 0:
-            info_file_bytes = f.read(1)
-            info_file_bytes = info_file_bytes[0]
-            map_description += str(chr(info_file_bytes))
-        if 'TRIGSTR' in map_description:
-            map_description = map_description.replace('\000', '')
-            map_description = strings_array[map_description]
-        else:
-            map_description = map_description.replace('\000', '')
-
-        # read the string id from strings file describing recommended players
-        info_file_bytes = 1
-        recommended_players = ""
-        while info_file_bytes != 0:
-            info_file_bytes = f.read(1)
-            info_file_bytes = info_file_bytes[0]
-            recommended_players += str(chr(info_file_bytes))
-        if 'TRIGSTR' in recommended_players:
-            recommended_players = recommended_players.replace('\000', '')
-            recommended_players = strings_array[recommended_players]
-        else:
-            recommended_players = recommended_players.replace('\000', '')
-
-        # we read 8 floats (each float is 4 bytes) where the camera bounds 
-        # are defined, little endian
-        # first 4 floats are enough but we also read the second 4, for some 
-        # unidentified reason (verifying purposes?)
-        left_camera_bound = f.read(4)
-        left_camera_bound = struct.unpack_from('f', left_camera_bound)[0]
-        bottom_camera_bound = f.read(4)
-        bottom_camera_bound = struct.unpack_from('f', bottom_camera_bound)[0]
-        right_camera_bound = f.read(4)
-        right_camera_bound = struct.unpack_from('f', right_camera_bound)[0]
-        top_camera_bound = f.read(4)
-        top_camera_bound = struct.unpack_from('f', top_camera_bound)[0]
-        # read over the rest of the 4 floats, we do not know why they exist
-        for i in range(4):
-            f.read(4)
-
-        # read the camera bounds complements needed for calculating the 
-        # map width and height
-        camera_bounds_complement_a = f.read(4)
-        camera_bounds_complement_a = int.from_bytes(camera_bounds_complement_a,
-                                                    byteorder='little')
-        camera_bounds_complement_b = f.read(4)
-        camera_bounds_complement_b = int.from_bytes(camera_bounds_complement_b,
-                                                    byteorder='little')
-        camera_bounds_complement_c = f.read(4)
-        camera_bounds_complement_c = int.from_bytes(camera_bounds_complement_c,
-                                                    byteorder='little')
-        camera_bounds_complement_d = f.read(4)
-        camera_bounds_complement_d = int.from_bytes(camera_bounds_complement_d,
-                                                    byteorder='little')
-
-        # read the playable map width and height
-        playable_map_area_width = f.read(4)
-        playable_map_area_width = int.from_bytes(playable_map_area_width,
-                                                 byteorder='little')
-        playable_map_area_height = f.read(4)
-        playable_map_area_height = int.from_bytes(playable_map_area_height,
-                                                  byteorder='little')
-
-        # calculate the map width and height
-        map_width = camera_bounds_complement_a + playable_map_area_width + \
-                    camera_bounds_complement_b
-        map_height = camera_bounds_complement_c + playable_map_area_height + \
-                     camera_bounds_complement_d
-
-        # Read the 4 bytes from w3i file which contain the map flags
-        # TODO: we have to experiment and figure out the correct flag meaning
-        map_flags_w3i = ""
-        for i in range(4):
-            byte = f.read(1)
-            byte = ord(byte)
-            byte = bin(byte)[2:].rjust(8, '0')
-            for bit in byte:
-                map_flags_w3i += str(bit)
-
-        # Now we read a byte which contains the map main ground type in w3i file
-        main_ground_type = f.read(1)
-
-        main_ground_type = str(chr(main_ground_type[0]))
-        main_ground_type = decode_tileset(main_ground_type)
+    strings_array = None
+    if 'strings' in stages:
+        with metrics.stage('strings'):
+            strings_array = CachedStrings(members)
+
+    if 'w3i' in stages:
+        with metrics.stage('w3i'):
+            info = w3i.parse(members['war3map.w3i'])
+        map_data.update(read_info(info, strings_array))
+        if strings_array is not None:
+            strings_array.save()
+
+        if 'objects' in stages:
+            # Reforged (1.32) added a skin to every placed object
+            game_version = info['game_version']
+            skins = game_version is not None and \
+                tuple(game_version[:2]) >= (1, 32)
+            with metrics.stage('objects'):
+                map_data["objects"] = cached_result(
+                    'objects', members, OBJECT_MEMBERS,
+                    lambda: read_objects(members, skins),
+                    skins, doo.numpy is not None)
+
+    if 'script' in stages:
+        with metrics.stage('script'):
+            map_data["script"] = cached_result(
+                'script', members, SCRIPT_MEMBERS,
+                lambda: read_script(members), config.SCRIPT_FLAGGED_NATIVES)
+
+    return map_data
+
+
+def member_key(name, members, member_names, *parameters):
+    """
+    Returns the MEMBER_CACHE key of the named result of the given members,
+    made of their digests and the parameters the result depends on.
+    """
+    parts = [str(PARSER_VERSION)] + \
+        [str(members.digest(member_name)) for member_name in member_names] + \
+        [repr(parameter) for parameter in parameters]
+    digest = hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+    return name + '-' + digest
+
+
+def cached_result(name, members, member_names, compute, *parameters):
+    """
+    Returns the named result of the given members computed by compute(),
+    from MEMBER_CACHE if a map with the same members was read before (see
+    member_key()). Errors aren't cached.
+    """
+    results = member_cache()
+    if results is None:
+        return compute()
+
+    key = member_key(name, members, member_names, *parameters)
+    result = results.get(key)
+    if result is not None:
+        return json.loads(result)
+
+    result = compute()
+    results.put(key, json.dumps(result, sort_keys=True))
+    return result
+
+
+def member_cache():
+    """
+    Returns MEMBER_CACHE, creating it on the first call. Returns None when
+    CACHE_ENABLED is off and when the map is read under the profiler, whose
+    profile should show all the parsing.
+    """
+    global MEMBER_CACHE
+
+    if not config.CACHE_ENABLED or profiling.active():
+        return None
+    with MEMBER_CACHE_LOCK:
+        if MEMBER_CACHE is None:
+            MEMBER_CACHE = cache.ResultCache(config.MEMBER_CACHE_ENTRIES,
+                                             config.MEMBER_CACHE_DB,
+                                             config.MEMBER_CACHE_DB_ENTRIES)
+        return MEMBER_CACHE
+
+
+def read_info(info, strings_array):
+    """
+    Returns the map data found in the parsed w3i file. The fields which may
+    be strings of the string table are only there if strings_array is given.
+    """
+    # Read the expansion state from the infofile format version
+    if info['version'] == 18:
+        expansion_required = 'No'
+    elif info['version'] in w3i.SUPPORTED_VERSIONS:
+        expansion_required = 'Yes'
+    else:
+        expansion_required = str(info['version']) + ' (bug?)'
+
+    game_version = None
+    if info['game_version'] is not None:
+        game_version = '.'.join(str(part) for part in info['game_version'])
+
+    # we read 8 floats where the camera bounds are defined, first 4 floats
+    # are enough, we do not know why the second 4 exist
+    left_camera_bound, bottom_camera_bound, right_camera_bound, \
+        top_camera_bound = info['camera_bounds'][:4]
+
+    # calculate the map width and height from the playable area and the
+    # camera bounds complements
+    camera_bounds_complement_a, camera_bounds_complement_b, \
+        camera_bounds_complement_c, camera_bounds_complement_d = \
+        info['camera_bounds_complements']
+    playable_map_area_width = info['playable_width']
+    playable_map_area_height = info['playable_height']
+    map_width = camera_bounds_complement_a + playable_map_area_width + \
+                camera_bounds_complement_b
+    map_height = camera_bounds_complement_c + playable_map_area_height + \
+                 camera_bounds_complement_d
+
+    # TODO: we have to experiment and figure out the correct flag meaning
+    map_flags_w3i = w3i.bit_string(info['flags'])
+
+    main_ground_type = info['main_ground_type'].decode('latin-1')
+    main_ground_type = decode_tileset(main_ground_type)
 
     map_data = {
-        "warning": warning,
-        "map_name": map_name,
-        "map_flags": map_flags,
         "map_flags_w3i": map_flags_w3i,
-        "max_players": max_player_num,
-        "tileset": main_tileset,
         "main_ground_type": main_ground_type,
         "expansion_required": expansion_required,
-        "map_version": map_version,
-        "editor_version": editor_version,
-        "map_name_info_file": map_name_infofile,
-        "map_author": map_author,
-        "map_description": map_description,
+        "map_version": info['map_version'],
+        "editor_version": info['editor_version'],
+        "game_version": game_version,
+        "script_language": info['script_language'],
         "left_camera_bound": left_camera_bound,
         "right_camera_bound": right_camera_bound,
         "top_camera_bound": top_camera_bound,
@@ -282,19 +671,224 @@ def read_map(file_name, unpack_dir_name):
         "playable_map_area_width": playable_map_area_width,
         "map_height": map_height,
         "map_width": map_width,
-        "recommended_players": recommended_players
+        "upgrades": info['upgrades'],
+        "tech": info['tech'],
     }
 
+    if strings_array is None:
+        return map_data
+
+    # The map name, author, description and recommended players have always
+    # been decoded byte by byte (as latin-1), keep it that way
+    map_data["map_name_info_file"] = w3i_string(info['name'], strings_array,
+                                                'latin-1')
+    map_data["map_author"] = w3i_string(info['author'], strings_array,
+                                        'latin-1')
+    map_data["map_description"] = w3i_string(info['description'],
+                                             strings_array, 'latin-1')
+    map_data["recommended_players"] = w3i_string(
+        info['recommended_players'], strings_array, 'latin-1')
+
+    players = None
+    if info['players'] is not None:
+        players = []
+        for player in info['players']:
+            player = dict(player)
+            player['name'] = w3i_string(player['name'], strings_array)
+            players.append(player)
+    map_data["players"] = players
+
+    forces = None
+    if info['forces'] is not None:
+        forces = []
+        for force in info['forces']:
+            force = dict(force)
+            force['name'] = w3i_string(force['name'], strings_array)
+            forces.append(force)
+    map_data["forces"] = forces
+
     return map_data
 
 
-def valid_map(file_name):
+def read_terrain(w3e_file):
+    """
+    Returns the tilesets, grid size and terrain statistics of the given w3e
+    file contents, or None if the file is damaged.
     """
-    Checks if the magic numbers of a given file correspond to a
+    try:
+        terrain = w3e.parse(w3e_file)
+    except ValueError:
+        return None
+
+    result = {
+        "tilesets": terrain['tilesets'],
+        "cliff_tilesets": terrain['cliff_tilesets'],
+        "width": terrain['width'],
+        "height": terrain['height'],
+    }
+
+    # without NumPy the tilepoints aren't decoded
+    statistics = w3e.statistics(terrain, config.TERRAIN_HEIGHTMAP_SIZE)
+    if statistics is not None:
+        result.update(statistics)
+
+    return result
+
+
+def read_objects(members, skins):
+    """
+    Returns the doodad and unit statistics of the map, or None if it has
+    neither file, one of them is damaged or NumPy isn't available. skins
+    tells whether the objects have a skin (Reforged maps).
+    """
+    if doo.numpy is None:
+        return None
+
+    doodads = special_doodads = units = None
+    try:
+        if 'war3map.doo' in members:
+            doodads, special_doodads = doo.parse_doodads(
+                members['war3map.doo'], skins)
+        if 'war3mapUnits.doo' in members:
+            units = doo.parse_units(members['war3mapUnits.doo'], skins)
+    except ValueError:
+        return None
+
+    if doodads is None and units is None:
+        return None
+
+    return doo.statistics(doodads, special_doodads, units)
+
+
+def read_campaign(archive, stages):
+    """
+    Returns the data of the campaign in the given archive: its info and,
+    with the maps stage, the maps it's made of as (path, bytes) pairs, in
+    the order of the info file (bytes is None if a map is missing).
+    """
+    with metrics.stage('w3f'):
+        info = w3f.parse(archive.read_file(CAMPAIGN_INFO))
+
+    strings_array = None
+    if archive.has_file(CAMPAIGN_STRINGS):
+        with metrics.stage('strings'):
+            strings_array = read_string_file(
+                archive.read_file(CAMPAIGN_STRINGS))
+
+    def string(raw_string):
+        if strings_array is None:
+            return raw_string.decode('utf-8', 'replace')
+        return w3i_string(raw_string, strings_array)
+
+    maps = []
+    for campaign_map in info['maps']:
+        maps.append({
+            "path": campaign_map['path'].decode('utf-8', 'replace'),
+            "chapter": string(campaign_map['chapter']),
+            "title": string(campaign_map['title']),
+            "visible": campaign_map['visible'],
+        })
+
+    map_data = {
+        "campaign": {
+            "name": string(info['name']),
+            "difficulty": string(info['difficulty']),
+            "author": string(info['author']),
+            "description": string(info['description']),
+            "campaign_version": info['campaign_version'],
+            "editor_version": info['editor_version'],
+            "variable_difficulty": info['variable_difficulty'],
+            "expansion_required": 'Yes' if info['expansion'] else 'No',
+            "cursor_race": info['cursor_race'],
+            "maps": maps,
+        },
+    }
+
+    if 'maps' in stages:
+        embedded_maps = []
+        for campaign_map in maps:
+            try:
+                map_bytes = archive.read_file(campaign_map['path'])
+            except KeyError:
+                map_bytes = None
+            embedded_maps.append((campaign_map['path'], map_bytes))
+        map_data["maps"] = embedded_maps
+
+    return map_data
+
+
+def read_campaign_maps(maps, parallel=True):
+    """
+    Returns the responses of a campaign's maps, given as (path, bytes) pairs
+    by read_campaign(), in the same order. They're read at the same time by
+    BATCH_POOL, or one after the other by this process if parallel is False
+    (in processes which can't start processes of their own).
+    """
+    futures = {}
+    if parallel:
+        for path, map_bytes in maps:
+            if map_bytes is not None and path not in futures:
+                futures[path] = batch_pool().submit(batch_map_response,
+                                                    map_bytes, path)
+
+    responses = []
+    for path, map_bytes in maps:
+        if map_bytes is None:
+            response = map_error("can't find " + path + " inside the "
+                                 "campaign", path)
+        elif parallel:
+            try:
+                response = futures[path].result()
+            except Exception as e:  # the worker itself died
+                response = map_error("can't process map file: " + str(e),
+                                     path)
+        else:
+            response = process_map(memoryview(map_bytes), path)
+            if response['maps'] is not None:
+                response['maps'] = read_campaign_maps(response['maps'],
+                                                      False)
+        responses.append(response)
+
+    return responses
+
+
+def read_script(members):
+    """
+    Returns the counts of the map's JASS script and the header of its
+    trigger file, or None if it has neither. A damaged file's part is None.
+    """
+    if not any(name in members for name in SCRIPT_MEMBERS):
+        return None
+
+    script = triggers = None
+    try:
+        for member_name in SCRIPT_MEMBERS[:2]:
+            if member_name in members:
+                script = jass.analyze(members[member_name],
+                                      config.SCRIPT_FLAGGED_NATIVES)
+                break
+    except mpq.LimitExceeded:
+        raise
+    except ValueError:
+        pass
+
+    try:
+        if 'war3map.wtg' in members:
+            triggers = wtg.parse(members['war3map.wtg'])
+    except mpq.LimitExceeded:
+        raise
+    except ValueError:
+        pass
+
+    return {"jass": script, "triggers": triggers}
+
+
+def valid_map(map_buffer):
+    """
+    Checks if the magic numbers of a given map buffer correspond to a
     Warcraft III map file
     """
-    with open(file_name, "rb") as f:
-        map_name_bytes = f.read(4)
+    map_name_bytes = bytes(map_buffer[:4])
 
     try:
         map_name_bytes = str(map_name_bytes.decode('utf-8'))
@@ -307,7 +901,31 @@ def valid_map(file_name):
     return False
 
 
-def map_error(error_string, file):
+def upload_buffer(upload):
+    """
+    Returns a memoryview over the uploaded map. Maps kept in memory by
+    KraftverRequest aren't copied.
+    """
+    if hasattr(upload.stream, 'getbuffer'):
+        return upload.stream.getbuffer()
+
+    return memoryview(upload.stream.read())
+
+
+def map_upload():
+    """
+    Returns the uploaded map. Raises upload.InvalidUpload if it was found
+    not to be a map while it was received, by the form parser or already by
+    server.py.
+    """
+    invalid_upload = request.environ.get('kraftver.invalid_upload')
+    if invalid_upload is not None:
+        raise invalid_upload
+
+    return request.files['map']
+
+
+def map_error(error_string, file_name):
     """
     Returns a simple dictionary explaining the error during the map
     reading process, to be used as a JSON response
@@ -325,6 +943,8 @@ def map_error(error_string, file):
         "expansion_required": None,
         "map_version": None,
         "editor_version": None,
+        "game_version": None,
+        "script_language": None,
         "map_name_info_file": None,
         "map_author": None,
         "map_description": None,
@@ -337,300 +957,1065 @@ def map_error(error_string, file):
         "playable_map_area_width": None,
         "map_height": None,
         "map_width": None,
-        "file_name": secure_filename(file.filename)
+        "players": None,
+        "forces": None,
+        "upgrades": None,
+        "tech": None,
+        "terrain": None,
+        "objects": None,
+        "script": None,
+        "campaign": None,
+        "maps": None,
+        "file_name": secure_filename(file_name)
     }
 
     return response
 
 
-def extract_map_file(file_name, unpack_dir_name):
-    """Extracts the given file name via the mpq-extract external tool."""
+def open_map_archive(map_buffer):
+    """
+    Opens the map's MPQ archive under the extraction limits and returns it
+    and a non-fatal warning (if any) about its listfile.
+    """
     warning = ""  # will contain any non-fatal warning
 
+    archive = mpq.MPQArchive(map_buffer,
+                             config.EXTRACT_MAX_OUTPUT * 1024 * 1024,
+                             config.EXTRACT_MAX_RATIO)
+
+    # Members are found by their name hash so we don't need the
+    # listfile to read them, but a missing listfile or one which
+    # doesn't match the archive contents means a protected map.
     try:
-        os.mkdir(unpack_dir_name)
-    except FileExistsError:
-        shutil.rmtree(unpack_dir_name)
-        os.mkdir(unpack_dir_name)
-
-    # Construct the extract shell command
-    extract_command = ("cd %s && mpq-extract -e %s &>/dev/null") % \
-                      (unpack_dir_name.replace(" ", "\\ "),
-                       file_name.replace(" ", "\\ "))
-    # We need to escape the command because it may contain ' (or spacec like
-    # above) which can confuse the shell
-    extract_command = extract_command.replace("'", "\\'")
-    extract_command = extract_command.replace("(", "\\(")
-    extract_command = extract_command.replace(")", "\\)")
-
-    # Call the external mpq-extract tool to extract the map
-    extract_shell = subprocess.Popen(extract_command,
-                                     shell=True,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-    extract_std = extract_shell.communicate()
-
-    if extract_shell.returncode != 0:  # can't extract the map file properly
-        raise ValueError("can't extract the map file properly: " \
-                         + str(extract_std[1].decode("utf-8")))
-
-    # Get the list of all physical files extracted by the mpq-extract tool
-    archive_files = sorted(os.listdir(unpack_dir_name))
-
-    # Sometimes mpg-extract doesn't extract anything at all and remains silent
-    #  about it
-    if len(archive_files) == 0:
-        raise ValueError("external tool didn't extract anything")
-
-    # And sometimes mpg-extract extracts one empty file, a valid map should
-    # contain at least 16 files inside
-    if len(archive_files) < 16:
-        raise ValueError("external tool didn't extract properly")
-
-    # Rename extracted files according to the data in listfile
-    # The last file is usually attributes and the file before the last
-    # file is listfile
-    os.rename(unpack_dir_name + '/' + archive_files[-2],
-              unpack_dir_name + '/listfile')
-    os.rename(unpack_dir_name + '/' + archive_files[-1],
-              unpack_dir_name + '/attributes')
-
-    # But sometimes listfile may be the last file, we need to check if our
-    # listfile is correct and rename a bit differently if the attributes and
-    # the listfile were swapped in the map file
-
-    if not is_valid_list_file(unpack_dir_name + '/listfile') and \
-        is_valid_list_file(unpack_dir_name + '/attributes'):
-        warning = "listfile and attribute file were swapped, reswapping"
-        os.rename(unpack_dir_name + '/attributes',
-                  unpack_dir_name + '/correctlistfile')
-        os.rename(unpack_dir_name + '/listfile',
-                  unpack_dir_name + '/attributes')
-        os.rename(unpack_dir_name + '/correctlistfile',
-                  unpack_dir_name + '/listfile')
-    elif not is_valid_list_file(unpack_dir_name + '/listfile') \
-         and not is_valid_list_file(unpack_dir_name + '/attributes'):
-        raise ValueError("can't find valid listfile inside the map file")
-
-    # We renamed the listfile and attributes file successfully so we remove
-    # them from the list
-    archive_files = archive_files[:-2]
-
-    # We read the listfile into the list array
-    list_file = []
-    with open(unpack_dir_name + '/listfile', 'r') as f:
-        for line in f:
-            list_file.append(line.replace('\n', ''))
-
-    # We check if the files listed in the listfile actually exist in the MPQ
-    # archive or was the archive "protected" by removing some files.
-    if len(list_file) != len(archive_files):
-        warning = "number of files listed in the listfile (" + \
-        str(len(list_file)) + ") do not match the number of physical files (" + \
-        str(len(archive_files)) + "), protected map, may encounter errors"
-
-    # We rename the files according to the listfile
-    number_of_files = len(archive_files) - 1
-
-    while number_of_files > -1:
-        # archive_files contains regular filenames in the directory
-        # (file00000.xxx, for example) list_file contains filenames from the
-        # listfile (war3map.doo for example)
-        genericfilename = unpack_dir_name + '/' + archive_files[number_of_files]
-        listfilename = unpack_dir_name + '/' + list_file[number_of_files]
-        os.rename(genericfilename, listfilename)
-
-        # The archive can also contain subdirectories so we need to recreate
-        # the subdirs and move files into it
-        if len(list_file[number_of_files].split('\\')) > 1:
-            path = ''
-
-            for subdir in list_file[number_of_files].split('\\')[:-1]:
-                path += subdir + '/'
-
-            os.makedirs(unpack_dir_name + '/' + path, exist_ok=True)  # Recreate the subdir
-
-            # .datadir/'AoW\Images\TGA\BTNRessAuraIcon.tga' bellow
-            filenamewithslashes = unpack_dir_name + '/' + list_file[number_of_files]
-            # .datadir/AoW/Images/TGA/'BTNRessAuraIcon.tga' bellow
-            filenameinsubdir = unpack_dir_name + '/' + path + \
-            list_file[number_of_files].split('\\')[-1]
-
-            shutil.move(filenamewithslashes, filenameinsubdir)
-
-        number_of_files -= 1
-
-    return warning
-
-
-def read_string_file(unpack_dir_name):
-    """
-    Reads the string file from the given file. String file is a text file
-    which contains all the strings used within the map.
+        list_file = archive.read_file('(listfile)')
+    except KeyError:
+        list_file = b''
+
+    if not is_valid_list_file(list_file):
+        warning = "can't find valid listfile inside the map file, " \
+                  "protected map, may encounter errors"
+    else:
+        list_file = [line for line in
+                     list_file.decode('utf-8').splitlines() if line]
+        number_of_files = archive.file_count()
+        if len(list_file) != number_of_files:
+            warning = "number of files listed in the listfile (" + \
+            str(len(list_file)) + ") do not match the number of " \
+            "physical files (" + str(number_of_files) + \
+            "), protected map, may encounter errors"
+
+    return archive, warning
+
+
+def read_string_file(strings_file):
+    """
+    Returns the string table of the given string file contents. String file
+    is a text file which contains all the strings used within the map, they
+    are decoded only when they're looked up.
     """
     # We need to check if the strings file is a valid strings file at all.
-    if not is_valid_wts(unpack_dir_name + '/war3map.wts'):
+    if not is_valid_wts(strings_file):
         raise ValueError("can't find valid strings file in the map")
 
-    with open(unpack_dir_name + '/war3map.wts', 'r') as f:
-        strings_array = {'TRIGSTR_START': ''}
-        total_lines = len(f.readlines())
-        f.seek(0)
-        current_line = 0
-
-        while current_line <= total_lines:
-            line = f.readline()
-            current_line += 1
-            if 'STRING' in line:
-                # create a key name for found string
-                stringno = int(line.split(' ')[1])
-                if stringno < 10:
-                    stringno = '00' + str(stringno)
-                elif stringno < 100:
-                    stringno = '0' + str(stringno)
-                keyname = 'TRIGSTR_' + str(stringno)
-                line = f.readline()  # read the next line
-                current_line += 1
-
-                # maybe we stumbled upon a comment
-                if line[:3] == '// ':
-                    line = f.readline()
-                    current_line += 1
-                    
-                # if the next line is a curly bracket which marks the beggining of the string
-                if line == '{\n':
-                    # read the next char which is hopefully the string value
-                    line = f.readline()
-                    current_line += 1
-                    value = ''
-
-                    # read the lines until we reach the mark which denotes end of the string
-                    while line != '}\n':
-                        value += line
-                        line = f.readline()
-                        current_line += 1
-
-                    # we reached the end of the string so we need to save the string into the dictionary
-                    strings_array[keyname] = value.strip('\n')
-
-        strings_array.pop("TRIGSTR_START", None)  # we don't need this first dict entry anymore
-
-    return strings_array
-
-
-def is_valid_w3e(file_path):
-    """Checks if a given file is a valid w3e file."""
-    with open(file_path, "rb") as f:
-        main_tileset_sig = f.read(4)
-
-    main_tileset_sig = str(main_tileset_sig.decode('utf-8'))
-
-    if main_tileset_sig == "W3E!":
+    return wts.StringTable(strings_file)
+
+
+def read_w3e(members):
+    """Returns the map's w3e file. Raises ValueError if it isn't valid."""
+    if not is_valid_w3e(members['war3map.w3e']):
+        raise ValueError("doesn't contain a valid .w3e file")
+
+    return members['war3map.w3e']
+
+
+def is_valid_w3e(w3e_file):
+    """Checks if the given file contents are a valid w3e file."""
+    main_tileset_sig = w3e_file[:4]
+
+    if main_tileset_sig == b"W3E!":
         return True
     else:
         return False
 
 
-def is_valid_list_file(list_file_path):
+def is_valid_list_file(list_file):
     """
-    Checks if a given filename is a valid listfile. We read the listfile and
-    check if any of the lines contain names such as war3map.w3i, war3map.wts
-    or war3map.shd. If they do, it's a valid listfile.
+    Checks if the given file contents are a valid listfile. We read the
+    listfile and check if any of the lines contain names such as war3map.w3i,
+    war3map.wts, war3map.shd or war3campaign.w3f. If they do, it's a valid
+    listfile.
     """
-    with open(list_file_path, 'r') as f:
+    try:
+        listfile_data = list_file.decode('utf-8').splitlines()
+    except UnicodeDecodeError:  # prob. binary file, not a listfile
+        return False
+
+    if "war3map.w3i" in listfile_data or "war3map.wts" \
+        in listfile_data or "war3map.shd" in listfile_data or \
+        CAMPAIGN_INFO in listfile_data:
+        return True
+    else:
+        return False
+
+
+def is_valid_wts(strings_file):
+    """Checks if the given file contents are a valid strings file."""
+    try:
+        first_line = strings_file.split(b'\n', 1)[0].decode('utf-8')
+    except UnicodeDecodeError:  # probably a binary file
+        return False
+
+    if not 'STRING' in first_line:  # probably not a strings file
+        return False
+    else:
+        return True
+
+
+def process_map(map_buffer, file_name, stages=STAGES):
+    """
+    Validates and reads the map in the given buffer and returns the response
+    dictionary, either with the map data or with the error. The fields of
+    the stages which weren't run are None. The maps of a campaign are
+    (path, bytes) pairs, read_campaign_maps() reads them.
+    """
+    # Check if the uploaded file is a valid wc3 map
+    with metrics.stage('valid_map'):
+        valid = valid_map(map_buffer)
+    if not valid:
+        return map_error("invalid map file", file_name)
+
+    # Try to read the map
+    try:
+        map_data = read_map(map_buffer, stages)
+    except mpq.LimitExceeded as e:
+        return map_error(LIMIT_ERROR + str(e), file_name)
+    except MemoryError:
+        raise  # the sandbox replaces the worker which ran out of memory
+    except Exception as e:
+        return map_error("can't process map file: " + str(e), file_name)
+
+    response = {
+        "success": True,
+        "error": None,
+        "warning": map_data.get('warning'),
+        "map_name": map_data.get('map_name'),
+        "map_flags": map_data.get('map_flags'),
+        "map_flags_w3i": map_data.get('map_flags_w3i'),
+        "max_players": map_data.get('max_players'),
+        "tileset": map_data.get('tileset'),
+        "main_ground_type": map_data.get('main_ground_type'),
+        "expansion_required": map_data.get('expansion_required'),
+        "map_version": map_data.get('map_version'),
+        "editor_version": map_data.get('editor_version'),
+        "game_version": map_data.get('game_version'),
+        "script_language": map_data.get('script_language'),
+        "map_name_info_file": map_data.get('map_name_info_file'),
+        "map_author": map_data.get('map_author'),
+        "map_description": map_data.get('map_description'),
+        "recommended_players": map_data.get('recommended_players'),
+        "left_camera_bound": map_data.get('left_camera_bound'),
+        "right_camera_bound": map_data.get('right_camera_bound'),
+        "top_camera_bound": map_data.get('top_camera_bound'),
+        "bottom_camera_bound": map_data.get('bottom_camera_bound'),
+        "playable_map_area_height": map_data.get('playable_map_area_height'),
+        "playable_map_area_width": map_data.get('playable_map_area_width'),
+        "map_height": map_data.get('map_height'),
+        "map_width": map_data.get('map_width'),
+        "players": map_data.get('players'),
+        "forces": map_data.get('forces'),
+        "upgrades": map_data.get('upgrades'),
+        "tech": map_data.get('tech'),
+        "terrain": map_data.get('terrain'),
+        "objects": map_data.get('objects'),
+        "script": map_data.get('script'),
+        "campaign": map_data.get('campaign'),
+        "maps": map_data.get('maps'),
+        "file_name": secure_filename(file_name)
+    }
+
+    return response
+
+
+def map_response(map_buffer, file_name, fields=None, profile=False):
+    """
+    Returns the response dictionary for the uploaded map, popular maps are
+    served from the cache without reading them again. Only the given fields
+    (all of them by default) are read and returned. Profiled maps are always
+    read, under the profiler.
+    """
+    stages = STAGES if fields is None else field_stages(fields)
+
+    # Check if we didn't receive an empty file
+    if len(map_buffer) == 0:
+        response = map_error("empty map file", file_name)
+    elif not set(stages) - set(['header']):
+        # reading the HM3W header alone is cheaper than hashing the map or
+        # handing it to the sandbox
+        response = process_map(map_buffer, file_name, stages)
+    else:
+        digest = None
+        if config.CACHE_ENABLED or CATALOG is not None or profile:
+            with metrics.stage('hash'):
+                digest = hashlib.sha256(map_buffer).hexdigest()
+        # maps which ran out of time or memory aren't cached, the server may
+        # just have been busy
         try:
-            listfile_data = f.readlines()
-        except UnicodeDecodeError:  # prob. binary file, not a listfile
-            return False
+            if profile:
+                response = read_and_record(map_buffer, file_name, stages,
+                                           digest, profile)
+            elif config.CACHE_ENABLED:
+                response = cached_response(
+                    digest, stages, lambda: read_and_record(
+                        map_buffer, file_name, stages, digest))
+            else:
+                response = read_and_record(map_buffer, file_name, stages,
+                                           digest)
+        except sandbox.Busy:
+            raise  # answered with 503, see sandbox_busy()
+        except sandbox.SandboxError as e:
+            response = sandbox_error(e, file_name)
+
+    # The same map may have been uploaded before under a different name
+    response['file_name'] = secure_filename(file_name)
+
+    return project(response, fields)
+
+
+def response_parameters():
+    """
+    Returns the settings and the optional libraries the responses depend
+    on, like the parameters of each stage's member_key().
+    """
+    return (config.TERRAIN_HEIGHTMAP_SIZE, config.SCRIPT_FLAGGED_NATIVES,
+            w3e.numpy is not None, doo.numpy is not None,
+            thumbnails.Image is not None)
+
 
-        if "war3map.w3i\n" in listfile_data or "war3map.wts\n" \
-            in listfile_data or "war3map.shd\n" in listfile_data:
-            return True
+def cached_response(digest, stages, compute):
+    """
+    Returns the cached response of the map with the given hash, or computes
+    it with compute() and caches it. A cached full response has the fields
+    of every stage.
+    """
+    key = cache.digest_key(digest, PARSER_VERSION, *response_parameters())
+    if stages != STAGES:
+        response = RESULT_CACHE.get(key)
+        if response is not None:
+            return json.loads(response)
+        key += '-' + '+'.join(stages)
+
+    return RESULT_CACHE.get_or_compute(key, compute)
+
+
+def read_and_record(map_buffer, file_name, stages, digest, profile=False):
+    """
+    Reads the map in the sandbox and records it in the catalog if it was
+    read successfully and its response has the catalog's fields. Profiled
+    maps are read under the profiler and their profile is kept in PROFILES.
+    """
+    if profile:
+        response, seconds, data = read_sandboxed(map_buffer, file_name,
+                                                 stages, profiled_process_map)
+        with metrics.stage('profile'):
+            PROFILES.save(digest, secure_filename(file_name), seconds, data)
+    else:
+        response = read_sandboxed(map_buffer, file_name, stages)
+    if response['maps'] is not None:
+        with metrics.stage('maps'):
+            response['maps'] = read_campaign_maps(response['maps'],
+                                                  not BATCH_WORKER)
+
+    # the maps of a campaign are recorded on their own
+    if CATALOG is not None and response['success'] and \
+       response['campaign'] is None and set(CATALOG_STAGES) <= set(stages):
+        with metrics.stage('catalog'):
+            CATALOG.record(digest, response, PARSER_VERSION)
+
+    return response
+
+
+def read_sandboxed(map_buffer, file_name, stages=STAGES, reader=process_map):
+    """
+    Reads the map with reader() (process_map() or profiled_process_map()) in
+    a sandbox worker, or right here without them. Raises
+    sandbox.SandboxError if it ran out of time or memory or the worker died.
+    """
+    if SANDBOX is None:
+        try:
+            return reader(map_buffer, file_name, stages)
+        except MemoryError:
+            raise sandbox.OutOfMemory("reading the map ran out of memory")
+
+    settings = [(name, getattr(config, name)) for name in SANDBOX_SETTINGS]
+    result, timings = SANDBOX.run(read_with_settings, map_buffer, settings,
+                                  reader, file_name, stages)
+    for stage, seconds in timings:
+        metrics.record(stage, seconds)
+    return result
+
+
+def read_with_settings(map_buffer, settings, reader, file_name, stages):
+    """
+    Reads the map with reader() in a sandbox worker after applying the
+    server process' (name, value) settings to config.
+    """
+    for name, value in settings:
+        setattr(config, name, value)
+    return reader(map_buffer, file_name, stages)
+
+
+def profiled_process_map(map_buffer, file_name, stages=STAGES):
+    """
+    Reads the map with process_map() under the profiler. Returns the
+    response, the seconds it took and the marshalled profile.
+    """
+    return profiling.run(process_map, map_buffer, file_name, stages)
+
+
+def admin_request():
+    """Tells whether the request carries ADMIN_TOKEN in its admin header."""
+    token = request.headers.get(ADMIN_HEADER)
+    if config.ADMIN_TOKEN is None or token is None:
+        return False
+
+    return hmac.compare_digest(token.encode('utf-8'),
+                               config.ADMIN_TOKEN.encode('utf-8'))
+
+
+def profile_request():
+    """
+    Tells whether the map of the request should be read under the profiler:
+    a PROFILE_SAMPLE_RATE sample of the uploads and the admin's ones.
+    """
+    if PROFILES is None:
+        return False
+
+    return random.random() < config.PROFILE_SAMPLE_RATE or admin_request()
+
+
+def sandbox_error(error, file_name):
+    """Returns the error response of a map the sandbox couldn't read."""
+    if isinstance(error, sandbox.WorkerLost):
+        return map_error("can't process map file: " + str(error), file_name)
+
+    return map_error(LIMIT_ERROR + str(error), file_name)
+
+
+def field_stages(fields):
+    """Returns the stages the given response fields need, in their order."""
+    needed = set()
+    for field in fields:
+        needed.update(FIELD_STAGES.get(field, ()))
+
+    return tuple(stage for stage in STAGES if stage in needed)
+
+
+def project(response, fields):
+    """Returns the response with only the given fields, if any."""
+    if fields is None:
+        return response
+
+    return dict((field, response[field])
+                for field in BASE_FIELDS + tuple(fields))
+
+
+def response_fields(values):
+    """
+    Returns the response fields asked for by the "fields" parameter (comma
+    separated) of the given request values, or None for all of them. Raises
+    ValueError for unknown fields.
+    """
+    names = [name.strip() for value in values.getlist('fields')
+             for name in value.split(',') if name.strip()]
+    if not names:
+        return None
+
+    fields = []
+    for name in names:
+        if name not in FIELD_STAGES and name not in BASE_FIELDS:
+            raise ValueError("unknown field: " + name)
+        if name not in fields and name not in BASE_FIELDS:
+            fields.append(name)
+
+    return fields
+
+
+def response_format(values):
+    """
+    Returns the response format asked for by the "format" parameter of the
+    given request values. Raises ValueError if it's unknown or unavailable.
+    """
+    output_format = values.get('format', 'json')
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("unknown response format: " + output_format)
+    if output_format == 'msgpack' and msgpack is None:
+        raise ValueError("the msgpack format needs msgpack")
+
+    return output_format
+
+
+def serialize(response, output_format):
+    """Returns the response body in the given format and its mimetype."""
+    if output_format == 'msgpack':
+        return msgpack.packb(response), OUTPUT_FORMATS[output_format]
+    if output_format == 'compact':
+        return json.dumps(response, sort_keys=True, separators=(',', ':')), \
+            OUTPUT_FORMATS[output_format]
+
+    return json.dumps(response, sort_keys=True, indent=4) + '\n', \
+        OUTPUT_FORMATS[output_format]
+
+
+class BatchTooLarge(ValueError):
+    """Raised when a batch has too many maps or too many bytes of them."""
+
+
+def upload_members(upload):
+    """
+    Yields (file name, size, read function) for every map in the given
+    upload, which is either a map itself or a zip or tar archive of maps.
+    Nothing is read until the read function is called, before the next
+    map is asked for.
+    """
+    stream = upload.stream
+    stream.seek(0)
+    magic = stream.read(4)
+    stream.seek(0)
+
+    if magic != b'HM3W' and zipfile.is_zipfile(stream):
+        stream.seek(0)
+        with zipfile.ZipFile(stream) as archive:
+            for member in archive.infolist():
+                if member.filename.endswith('/'):  # directory
+                    continue
+                # reads stop at the member's size, whatever it inflates to
+                yield member.filename, member.file_size, \
+                    lambda member=member: archive.read(member)
+        return
+
+    stream.seek(0)
+    if magic != b'HM3W':
+        try:
+            archive = tarfile.open(fileobj=stream, mode='r:*')
+        except tarfile.TarError:
+            archive = None
+        if archive is not None:
+            with archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, member.size, \
+                            lambda member=member: \
+                            archive.extractfile(member).read()
+            return
+
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    yield upload.filename, size, stream.read
+
+
+def batch_members(uploads):
+    """
+    Yields (file name, size, read function) for every map in the given
+    uploads. Raises BatchTooLarge once there are more than BATCH_MAX_MAPS
+    maps or the maps which aren't too big to be read take more than
+    BATCH_MAX_SIZE, checked before the map going over is read.
+    """
+    max_size = KRAFTVER.config['MAX_CONTENT_LENGTH']
+    count = 0
+    total = 0
+
+    for upload in uploads:
+        for file_name, size, read in upload_members(upload):
+            count += 1
+            if size <= max_size:
+                total += size
+            if config.BATCH_MAX_MAPS and count > config.BATCH_MAX_MAPS:
+                raise BatchTooLarge("batch has more than %d maps" %
+                                    config.BATCH_MAX_MAPS)
+            if config.BATCH_MAX_SIZE and \
+               total > config.BATCH_MAX_SIZE * 1024 * 1024:
+                raise BatchTooLarge("batch maps take more than %d MB" %
+                                    config.BATCH_MAX_SIZE)
+            yield file_name, size, read
+
+
+def batch_maps(uploads):
+    """
+    Yields (file name, map bytes) for every map in the given uploads, one
+    map at a time. Maps bigger than MAX_CONTENT_LENGTH aren't read, their
+    bytes are None.
+    """
+    max_size = KRAFTVER.config['MAX_CONTENT_LENGTH']
+
+    for file_name, size, read in batch_members(uploads):
+        if size > max_size:
+            yield file_name, None
         else:
-            return False
+            yield file_name, read()
+
+
+def batch_map_response(map_bytes, file_name):
+    """Returns the response for one map of a batch, runs in BATCH_POOL."""
+    if map_bytes is None:
+        return map_error("map file too big", file_name)
+
+    return map_response(memoryview(map_bytes), file_name)
+
+
+def batch_pool():
+    """Returns the process pool which reads the maps of batch uploads."""
+    global BATCH_POOL
+
+    if BATCH_POOL is None:
+        # the pool starts its processes lazily, once this process has
+        # threads, so they're forked from the forkserver like the sandbox
+        # workers and never inherit a lock another thread holds
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        BATCH_POOL = concurrent.futures.ProcessPoolExecutor(
+            config.BATCH_WORKERS or os.cpu_count(), mp_context=context,
+            initializer=start_batch_worker)
+
+    return BATCH_POOL
+
+
+def start_batch_worker():
+    """
+    Batch workers read their maps themselves, under the sandbox memory
+    limit.
+    """
+    global SANDBOX, BATCH_WORKER
+
+    SANDBOX = None
+    BATCH_WORKER = True
+    # Ctrl+C reaches the whole process group, the pool's owner shuts it down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sandbox.limit_memory(config.SANDBOX_MEMORY * 1024 * 1024)
+
+
+def thumbnail_parameters():
+    """
+    Returns the thumbnail source, size and format asked for by the request.
+    Raises ValueError if they're invalid.
+    """
+    source = request.values.get('source', 'auto')
+    if source != 'auto' and source not in dict(thumbnails.SOURCES):
+        raise ValueError("unknown thumbnail source: " + source)
+
+    try:
+        size = int(request.values.get('size', config.THUMBNAIL_SIZE))
+    except ValueError:
+        raise ValueError("thumbnail size has to be a number")
+    if not 1 <= size <= config.THUMBNAIL_MAX_SIZE:
+        raise ValueError("thumbnail size has to be between 1 and " +
+                         str(config.THUMBNAIL_MAX_SIZE))
 
+    image_format = request.values.get('format', 'png')
+    if image_format not in thumbnails.FORMATS:
+        raise ValueError("unknown thumbnail format: " + image_format)
 
-def is_valid_wts(strings_file_path):
-    """Checks if the given file is a valid strings file."""
-    with open(strings_file_path, 'r') as f:
+    return source, size, image_format
+
+
+def search_parameters():
+    """
+    Returns the text, filters, page and page size asked for by the GET
+    /search request. Filters are read from the raw query string since the
+    operators of max_players>=8 or map_width<128 aren't key=value pairs.
+    Raises ValueError if any of them is invalid.
+    """
+    filters = []
+    query_string = request.query_string.decode('latin-1')
+    for term in query_string.split('&'):
+        term = urllib.parse.unquote_plus(term)
+        name = term.split('=', 1)[0]
+        if term and name not in SEARCH_PARAMETERS:
+            filters.append(catalog.parse_filter(term))
+
+    try:
+        page = int(request.args.get('page', 1))
+        page_size = int(request.args.get('page_size',
+                                         config.SEARCH_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("page and page_size must be numbers")
+    if page < 1 or not 1 <= page_size <= config.SEARCH_MAX_PAGE_SIZE:
+        raise ValueError("page must be positive and page_size between 1 "
+                         "and " + str(config.SEARCH_MAX_PAGE_SIZE))
+
+    return request.args.get('q'), filters, page, page_size
+
+
+def search_error(error_string, status):
+    """Returns the JSON error response of GET /search."""
+    return json.dumps({"success": False, "error": str(error_string),
+                       "results": None}, sort_keys=True, indent=4) + '\n', \
+        status
+
+
+def thumbnail_key(digest, source, size, image_format):
+    """Returns the thumbnail cache key, also used as its ETag."""
+    return '%s-%s-%d.%s' % (digest, source, size, image_format)
+
+
+def read_thumbnail(map_buffer, source, size, image_format):
+    """
+    Renders the thumbnail of the map's preview or minimap picture ("auto"
+    tries the preview first). Raises ValueError if there's no picture which
+    can be decoded.
+    """
+    archive = mpq.MPQArchive(map_buffer,
+                             config.EXTRACT_MAX_OUTPUT * 1024 * 1024,
+                             config.EXTRACT_MAX_RATIO)
+    error = "doesn't contain a preview or minimap picture"
+
+    for name, member_name in thumbnails.SOURCES:
+        if source not in ('auto', name):
+            continue
         try:
-            first_line = f.readline()
-        except UnicodeDecodeError:  # probably a binary file
-            return False
+            picture = archive.read_file(member_name)
+        except KeyError:
+            continue
 
-        if not 'STRING' in first_line:  # probably not a strings file
-            return False
+        if member_name.endswith('.tga'):
+            decode = thumbnails.decode_tga
         else:
-            return True
+            decode = thumbnails.decode_blp
+        try:
+            return thumbnails.render(decode(picture), size, image_format)
+        except ValueError as e:
+            error = member_name + ": " + str(e)
+
+    raise ValueError(error)
+
+
+def thumbnail_response(image, key, image_format):
+    """Returns the response carrying the thumbnail image."""
+    return Response(image, mimetype=thumbnails.FORMATS[image_format][1],
+                    headers={'ETag': '"' + key + '"',
+                             'Cache-Control': 'public, max-age=86400'})
+
+
+def thumbnail_error(error_string, file_name, status):
+    return json.dumps(map_error(error_string, file_name), sort_keys=True,
+                      indent=4) + '\n', status
+
+
+def job_map_response(map_bytes, file_name):
+    """
+    Reads the map of an asynchronous job in the sandbox, or in BATCH_POOL
+    without it.
+    """
+    if SANDBOX is not None:
+        response = map_response(memoryview(map_bytes), file_name)
+    else:
+        future = batch_pool().submit(batch_map_response, map_bytes,
+                                     file_name)
+        try:
+            response = future.result()
+        except Exception as e:  # the worker itself died
+            response = map_error("can't process map file: " + str(e),
+                                 file_name)
+
+    metrics.count_map(len(map_bytes), response['error'])
+    return response
+
+
+JOB_QUEUE = jobs.JobQueue(job_map_response, config.JOB_WORKERS,
+                          config.JOB_QUEUE_SIZE, config.JOB_RESULT_TTL,
+                          config.JOB_DB)
 
 
 @KRAFTVER.route('/', methods=['POST'])
 def route():
     """Accepts map, reads it and returns found data."""
-    # remove slash at the end of TMP_DIR, if any
-    if config.TMP_DIR[-1] == "/":
-        config.TMP_DIR = config.TMP_DIR[:-1]
+    started = time.perf_counter()
+    metrics.start_request()
 
-    file_name = config.TMP_DIR + "/kraftver-" + str(uuid.uuid1())
-    unpack_dir_name = file_name + "-data"
-    f = request.files['map']
-    f.save(file_name)
+    # The upload is streamed into memory and checked while the form is
+    # parsed
+    try:
+        with metrics.stage('upload'):
+            f = map_upload()
+        values = request.values
+    except upload.InvalidUpload as e:
+        f = None
+        # the form wasn't parsed, only the query string has parameters
+        values = request.args
+        response = map_error(e.error, e.file_name or "")
+        metrics.count_map(e.received, response['error'])
 
-    # Check if we didn't receive an empty file
-    if os.stat(file_name).st_size == 0:
-        os.remove(file_name)
-        shutil.rmtree(unpack_dir_name)
-        return json.dumps(map_error("empty map file", f), sort_keys=True,
-                          indent=4) + '\n'
+    try:
+        fields = response_fields(values)
+        output_format = response_format(values)
+    except ValueError as e:
+        return json.dumps(map_error(e, f.filename if f else ""),
+                          sort_keys=True, indent=4) + '\n', 400
+
+    if f is not None:
+        with upload_buffer(f) as map_buffer:
+            response = map_response(map_buffer, f.filename, fields,
+                                    profile_request())
+            metrics.count_map(len(map_buffer), response['error'])
+    else:
+        response = project(response, fields)
 
-    # Check if the uploaded file is a valid wc3 map
-    if not valid_map(file_name):
-        os.remove(file_name)
-        shutil.rmtree(unpack_dir_name)
-        return json.dumps(map_error("invalid map file", f), sort_keys=True,
-                          indent=4) + '\n'
+    # Return the data
+    with metrics.stage('serialize'):
+        body, mimetype = serialize(response, output_format)
 
-    # Try to read the map
+    metrics.REQUEST_SECONDS.observe('/', time.perf_counter() - started)
+    return Response(body, mimetype=mimetype,
+                    headers={'Server-Timing': metrics.server_timing()})
+
+
+@KRAFTVER.route('/batch', methods=['POST'])
+def batch_route():
+    """
+    Accepts many maps (or zip and tar archives of maps) and streams back one
+    JSON response per line, in the order the maps are read.
+    """
+    uploads = request.files.getlist('map')
+    # the archives are listed before anything is read, batches over the
+    # limits are rejected before the response starts
+    for member in batch_members(uploads):
+        pass
+
+    pool = batch_pool()
+    # maps are only read while fewer than this many are in the pool
+    window = 2 * (config.BATCH_WORKERS or os.cpu_count())
+
+    def result(future, file_name, map_size):
+        try:
+            response = future.result()
+        except Exception as e:  # the worker itself died
+            response = map_error("can't process map file: " + str(e),
+                                 file_name)
+        metrics.count_map(map_size, response['error'])
+        return json.dumps(response, sort_keys=True) + '\n'
+
+    def generate():
+        futures = {}
+        maps = batch_maps(uploads)
+        while True:
+            for file_name, map_bytes in maps:
+                future = pool.submit(batch_map_response, map_bytes, file_name)
+                futures[future] = (file_name, len(map_bytes or b''))
+                if len(futures) >= window:
+                    break
+            if not futures:
+                return
+            done = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED).done
+            for future in done:
+                yield result(future, *futures.pop(future))
+
+    # the uploads are read as the response is streamed, after the request
+    # would have closed them
+    request.streams_uploads = True
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(request.close_uploads)
+    return response
+
+
+@KRAFTVER.route('/thumbnail', methods=['POST'])
+def thumbnail_route():
+    """
+    Accepts map and returns a PNG or WebP thumbnail of its preview or
+    minimap picture.
+    """
     try:
-        map_data = read_map(file_name, unpack_dir_name)
-    except Exception as e:
-        os.remove(file_name)
-        shutil.rmtree(unpack_dir_name)
-        return json.dumps(map_error("can't process map file: " + str(e), f),
-                          sort_keys=True, indent=4) + '\n'
+        f = map_upload()
+    except upload.InvalidUpload as e:
+        return thumbnail_error(e.error, e.file_name or "", 400)
 
-    os.remove(file_name)
-    shutil.rmtree(unpack_dir_name)
+    if not thumbnails.available():
+        return thumbnail_error("thumbnails need NumPy and Pillow", f.filename,
+                               501)
+    try:
+        source, size, image_format = thumbnail_parameters()
+    except ValueError as e:
+        return thumbnail_error(e, f.filename, 400)
+
+    with upload_buffer(f) as map_buffer:
+        if not valid_map(map_buffer):
+            return thumbnail_error("invalid map file", f.filename, 400)
+
+        digest = hashlib.sha256(map_buffer).hexdigest()
+        key = thumbnail_key(digest, source, size, image_format)
+        image = None
+        if THUMBNAIL_CACHE is not None:
+            image = THUMBNAIL_CACHE.get(key)
+
+        if image is None:
+            try:
+                with metrics.stage('thumbnail'):
+                    image = read_thumbnail(map_buffer, source, size,
+                                           image_format)
+            except Exception as e:
+                return thumbnail_error("can't create thumbnail: " + str(e),
+                                       f.filename, 422)
+            if THUMBNAIL_CACHE is not None:
+                THUMBNAIL_CACHE.put(key, image)
+
+    return thumbnail_response(image, key, image_format)
+
+
+@KRAFTVER.route('/thumbnail/<digest>', methods=['GET'])
+def cached_thumbnail(digest):
+    """
+    Returns a thumbnail already rendered for the map with the given SHA-256
+    hash, so thumbnails can be served without uploading the map again.
+    """
+    try:
+        source, size, image_format = thumbnail_parameters()
+    except ValueError as e:
+        return thumbnail_error(e, "", 400)
+
+    image = None
+    key = thumbnail_key(digest.lower(), source, size, image_format)
+    if THUMBNAIL_CACHE is not None and \
+       all(char in '0123456789abcdef' for char in digest.lower()):
+        image = THUMBNAIL_CACHE.get(key)
+    if image is None:
+        return thumbnail_error("thumbnail isn't cached, upload the map",
+                               "", 404)
+
+    return thumbnail_response(image, key, image_format)
+
+
+@KRAFTVER.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queues the map for reading and returns the job id right away, the result
+    can be fetched from /jobs/<job id> once it's done.
+    """
+    try:
+        f = map_upload()
+    except upload.InvalidUpload as e:
+        return json.dumps(map_error(e.error, e.file_name or ""),
+                          sort_keys=True, indent=4) + '\n', 400
+
+    # The upload buffer goes away with the request so the job gets a copy
+    with upload_buffer(f) as map_buffer:
+        map_bytes = bytes(map_buffer)
+
+    try:
+        job = JOB_QUEUE.submit(map_bytes, f.filename)
+    except jobs.QueueFull:
+        return json.dumps(map_error("job queue is full", f.filename),
+                          sort_keys=True, indent=4) + '\n', 503, \
+               {'Retry-After': str(config.JOB_RETRY_AFTER)}
+
+    return json.dumps(job.to_dict(), sort_keys=True, indent=4) + '\n', 202, \
+           {'Location': '/jobs/' + job.id}
+
+
+@KRAFTVER.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Returns the status of the given job and its result once it's done."""
+    job = JOB_QUEUE.get(job_id)
+    if job is None:
+        return json.dumps({"job_id": job_id, "status": None,
+                           "error": "unknown or expired job"},
+                          sort_keys=True, indent=4) + '\n', 404
+
+    return json.dumps(job.to_dict(), sort_keys=True, indent=4) + '\n'
+
+
+@KRAFTVER.route('/jobs', methods=['GET'])
+def job_stats():
+    """Returns the job queue depth, wait times and counters."""
+    return json.dumps(JOB_QUEUE.stats(), sort_keys=True, indent=4) + '\n'
+
+
+@KRAFTVER.route('/cache', methods=['GET'])
+def cache_stats():
+    """Returns the result cache hit, miss and eviction counters."""
+    return json.dumps(RESULT_CACHE.stats(), sort_keys=True, indent=4) + '\n'
+
+
+@KRAFTVER.route('/search', methods=['GET'])
+def search_route():
+    """
+    Searches the catalog of the maps read so far. q is matched against their
+    names, authors and descriptions, the other parameters are filters such
+    as max_players>=8, tileset=Northrend or expansion_required.
+    """
+    if CATALOG is None:
+        return search_error("search needs SEARCH_DB", 501)
+    try:
+        text, filters, page, page_size = search_parameters()
+    except ValueError as e:
+        return search_error(e, 400)
+
+    started = time.perf_counter()
+    try:
+        result = CATALOG.search(text, filters, page, page_size)
+    except sqlite3.Error as e:
+        return search_error("can't search the catalog: " + str(e), 503)
+    metrics.REQUEST_SECONDS.observe('/search', time.perf_counter() - started)
+
+    result.update({"success": True, "error": None})
+    return json.dumps(result, sort_keys=True, indent=4) + '\n'
+
+
+def profiles_error():
+    """
+    Returns the error response of the GET /profiles requests which can't be
+    served, None for the others.
+    """
+    if PROFILES is None:
+        error_string, status = "profiling needs PROFILE_DIR", 501
+    elif config.ADMIN_TOKEN is not None and not admin_request():
+        error_string, status = "profiles need the admin token", 403
+    else:
+        return None
+
+    return json.dumps({"success": False, "error": error_string},
+                      sort_keys=True, indent=4) + '\n', status
+
+
+@KRAFTVER.route('/profiles', methods=['GET'])
+def profiles_route():
+    """Lists the profiles kept, most recent first."""
+    error = profiles_error()
+    if error is not None:
+        return error
+
+    return json.dumps({"success": True, "error": None,
+                       "profiles": PROFILES.summaries()},
+                      sort_keys=True, indent=4) + '\n'
+
+
+@KRAFTVER.route('/profiles/<digest>', methods=['GET'])
+def profile_summary(digest):
+    """
+    Returns the summary of the profile of the map with the given SHA-256
+    hash: the functions which took the most cumulative time.
+    """
+    error = profiles_error()
+    if error is not None:
+        return error
+
+    summary = PROFILES.summary(digest.lower())
+    if summary is None:
+        return json.dumps({"success": False, "error": "unknown profile"},
+                          sort_keys=True, indent=4) + '\n', 404
+
+    summary.update({"success": True, "error": None})
+    return json.dumps(summary, sort_keys=True, indent=4) + '\n'
+
+
+@KRAFTVER.route('/profiles/<digest>/pstats', methods=['GET'])
+def profile_download(digest):
+    """
+    Returns the whole profile of the map with the given SHA-256 hash as a
+    pstats file, python3 -m pstats reads it.
+    """
+    error = profiles_error()
+    if error is not None:
+        return error
+
+    data = PROFILES.pstats(digest.lower())
+    if data is None:
+        return json.dumps({"success": False, "error": "unknown profile"},
+                          sort_keys=True, indent=4) + '\n', 404
+
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=' +
+                             digest.lower() + '.pstats'})
+
+
+@KRAFTVER.teardown_request
+def finish_request(error):
+    """
+    Stops collecting stage timings once a request is answered, whether its
+    route started collecting them or not.
+    """
+    metrics.finish_request()
+
+
+@KRAFTVER.errorhandler(workspace.WorkspaceFull)
+def workspaces_full(error):
+    """Rejects the uploads which don't fit in the workspace quota."""
+    return json.dumps(map_error("server is out of upload space, try again "
+                                "later", ""), sort_keys=True, indent=4) + \
+        '\n', 503, {'Retry-After': str(config.WORKSPACE_RETRY_AFTER)}
+
+
+@KRAFTVER.errorhandler(BatchTooLarge)
+def batch_too_large(error):
+    """Rejects the batches with too many maps or bytes of maps."""
+    return json.dumps(map_error(str(error), ""), sort_keys=True,
+                      indent=4) + '\n', 413
+
+
+@KRAFTVER.errorhandler(sandbox.Busy)
+def sandbox_busy(error):
+    """Rejects the maps no sandbox worker became free to read in time."""
+    return json.dumps(map_error("server is busy, try again later", ""),
+                      sort_keys=True, indent=4) + '\n', 503, \
+        {'Retry-After': str(config.SANDBOX_RETRY_AFTER)}
+
+
+@KRAFTVER.route('/metrics', methods=['GET'])
+def metrics_route():
+    """
+    Returns the stage timings, error and byte counters, and the cache and
+    job queue statistics in the Prometheus text format.
+    """
+    extra_lines = []
+    for name, value in sorted(RESULT_CACHE.stats().items()):
+        metric_type = 'gauge' if name == 'memory_entries' else 'counter'
+        extra_lines += metrics.single('kraftver_cache_' + name, metric_type,
+                                      "Result cache " +
+                                      name.replace('_', ' ') + ".", value)
+    if MEMBER_CACHE is not None:
+        for name, value in sorted(MEMBER_CACHE.stats().items()):
+            metric_type = 'gauge' if name == 'memory_entries' else 'counter'
+            extra_lines += metrics.single('kraftver_member_cache_' + name,
+                                          metric_type, "Member cache " +
+                                          name.replace('_', ' ') + ".", value)
+    if THUMBNAIL_CACHE is not None:
+        for name, value in sorted(THUMBNAIL_CACHE.stats().items()):
+            extra_lines += metrics.single('kraftver_thumbnail_cache_' + name,
+                                          'counter', "Thumbnail cache " +
+                                          name + ".", value)
+    if SANDBOX is not None:
+        for name, value in sorted(SANDBOX.stats().items()):
+            metric_type = 'gauge' if name == 'workers' else 'counter'
+            extra_lines += metrics.single('kraftver_sandbox_' + name,
+                                          metric_type, "Sandbox " +
+                                          name.replace('_', ' ') + ".", value)
+    if WORKSPACES is not None:
+        for name, value in sorted(WORKSPACES.stats().items()):
+            metric_type = 'gauge' if name == 'idle' else 'counter'
+            extra_lines += metrics.single('kraftver_workspaces_' + name,
+                                          metric_type, "Upload workspaces " +
+                                          name + ".", value)
+    if PROFILES is not None:
+        for name, value in sorted(PROFILES.stats().items()):
+            extra_lines += metrics.single('kraftver_profiles_' + name,
+                                          'counter', "Profiles " + name + ".",
+                                          value)
+    if CATALOG is not None:
+        for name, value in sorted(CATALOG.stats().items()):
+            extra_lines += metrics.single('kraftver_catalog_' + name,
+                                          'counter', "Catalog " + name + ".",
+                                          value)
+    for name, value in sorted(JOB_QUEUE.stats().items()):
+        metric_type = 'counter' if name in ('submitted', 'rejected',
+                                            'finished', 'expired') \
+                      else 'gauge'
+        extra_lines += metrics.single('kraftver_jobs_' + name, metric_type,
+                                      "Job queue " +
+                                      name.replace('_', ' ') + ".", value)
+
+    return metrics.render(extra_lines), 200, \
+           {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-    # Return the data
-    response = {
-        "success": True,
-        "error": None,
-        "warning": map_data['warning'],
-        "map_name": map_data['map_name'],
-        "map_flags": map_data['map_flags'],
-        "map_flags_w3i": map_data['map_flags_w3i'],
-        "max_players": map_data['max_players'],
-        "tileset": map_data['tileset'],
-        "main_ground_type": map_data['main_ground_type'],
-        "expansion_required": map_data['expansion_required'],
-        "map_version": map_data['map_version'],
-        "editor_version": map_data['editor_version'],
-        "map_name_info_file": map_data['map_name_info_file'],
-        "map_author": map_data['map_author'],
-        "map_description": map_data['map_description'],
-        "recommended_players": map_data['recommended_players'],
-        "left_camera_bound": map_data['left_camera_bound'],
-        "right_camera_bound": map_data['right_camera_bound'],
-        "top_camera_bound": map_data['top_camera_bound'],
-        "bottom_camera_bound": map_data['bottom_camera_bound'],
-        "playable_map_area_height": map_data['playable_map_area_height'],
-        "playable_map_area_width": map_data['playable_map_area_width'],
-        "map_height": map_data['map_height'],
-        "map_width": map_data['map_width'],
-        "file_name": secure_filename(f.filename)
-    }
-    return json.dumps(response, sort_keys=True, indent=4) + '\n'
 
 if __name__ == "__main__":
+    workspace.janitor()
     KRAFTVER.run(host=config.HOST, port=config.PORT, debug=config.DEBUG)
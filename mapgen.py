@@ -0,0 +1,751 @@
+#!/usr/bin/env python3
+"""Synthetic map generator"""
+# Builds valid HM3W + MPQ maps with configurable contents so the parsing
+# pipeline can be tested and benchmarked without shipping copyrighted maps.
+
+import argparse
+import bz2
+import io
+import random
+import struct
+import zlib
+
+import mpq
+
+COMPRESSION_TYPES = ("none", "zlib", "bzip2", "pkware")
+
+
+def encrypt(data, key):
+    """Encrypts the given bytes with the given key, see mpq.decrypt()."""
+    count = len(data) // 4
+    values = struct.unpack_from('<%dI' % count, data)
+    seed = 0xEEEEEEEE
+    encrypted = []
+
+    for value in values:
+        seed = (seed + mpq.CRYPT_TABLE[0x400 + (key & 0xFF)]) & mpq.MASK
+        encrypted.append((value ^ (key + seed)) & mpq.MASK)
+        key = ((((~key) & mpq.MASK) << 0x15) + 0x11111111 |
+               (key >> 0x0B)) & mpq.MASK
+        seed = (value + seed + (seed << 5) + 3) & mpq.MASK
+
+    return struct.pack('<%dI' % count, *encrypted) + bytes(data[count * 4:])
+
+
+def _huffman_codes(huffman):
+    """Returns the (code, length) pairs of a mpq._Huffman table by symbol."""
+    codes = {}
+    code = index = 0
+    for length in range(1, 14):
+        for i in range(huffman.count[length]):
+            codes[huffman.symbol[index]] = (code, length)
+            code += 1
+            index += 1
+        code <<= 1
+
+    return codes
+
+
+LENGTH_CODES = _huffman_codes(mpq._Exploder.LENGTHS)
+DISTANCE_CODES = _huffman_codes(mpq._Exploder.DISTANCES)
+
+
+def implode(data, dictionary_bits=6):
+    """
+    Compresses data into a PKWARE DCL stream with uncoded literals and a
+    greedy match finder. It doesn't compress as well as the real library but
+    it produces streams which exercise every part of the explode path.
+    """
+    output = bytearray([0, dictionary_bits])
+    state = [0, 0]  # bit buffer and bit count
+    window = 64 << dictionary_bits
+
+    def put(value, count):
+        state[0] |= value << state[1]
+        state[1] += count
+        while state[1] >= 8:
+            output.append(state[0] & 0xFF)
+            state[0] >>= 8
+            state[1] -= 8
+
+    def put_code(code):
+        # the codes are stored bit inverted, most significant bit first
+        value, length = code
+        for shift in range(length - 1, -1, -1):
+            put(((value >> shift) & 1) ^ 1, 1)
+
+    def put_length(length):
+        for symbol in range(16):
+            base = mpq._Exploder.LENGTH_BASE[symbol]
+            extra = mpq._Exploder.LENGTH_EXTRA[symbol]
+            if base <= length < base + (1 << extra):
+                break
+        put(1, 1)
+        put_code(LENGTH_CODES[symbol])
+        put(length - mpq._Exploder.LENGTH_BASE[symbol],
+            mpq._Exploder.LENGTH_EXTRA[symbol])
+
+    last_seen = {}
+    position = 0
+    while position < len(data):
+        key = bytes(data[position:position + 3])
+        candidate = last_seen.get(key)
+        last_seen[key] = position
+        length = 0
+        if candidate is not None and len(key) == 3 and \
+           position - candidate <= window:
+            while position + length < len(data) and length < 518 and \
+                  data[candidate + length] == data[position + length]:
+                length += 1
+
+        if length >= 3:
+            put_length(length)
+            distance = position - candidate - 1
+            put_code(DISTANCE_CODES[distance >> dictionary_bits])
+            put(distance & ((1 << dictionary_bits) - 1), dictionary_bits)
+            position += length
+        else:
+            put(0, 1)
+            put(data[position], 8)
+            position += 1
+
+    put_length(519)  # end of stream marker
+    if state[1]:
+        output.append(state[0] & 0xFF)
+
+    return bytes(output)
+
+
+def compress(data, compression):
+    """Compresses one sector with the given compression type."""
+    if compression == "zlib":
+        packed = bytes([mpq.COMPRESSION_ZLIB]) + zlib.compress(data, 9)
+    elif compression == "bzip2":
+        packed = bytes([mpq.COMPRESSION_BZIP2]) + bz2.compress(data, 9)
+    elif compression == "pkware":
+        packed = bytes([mpq.COMPRESSION_PKWARE]) + implode(data)
+    else:
+        return data
+
+    # sectors which don't get smaller are stored as they are
+    if len(packed) >= len(data):
+        return data
+    return packed
+
+
+def build_archive(members, compression="zlib", sector_size_shift=3,
+                  encrypted=False, single_unit=False, listfile="normal",
+                  hash_padding=0):
+    """
+    Builds an MPQ archive from the given (name, data) pairs. The listfile can
+    be "normal" (listfile block before the attributes block, the way the
+    World Editor writes it), "swapped" or "missing". hash_padding fills that
+    many free hash table entries with deleted ones, the way protectors make
+    probing the table slow.
+    """
+    sector_size = 512 << sector_size_shift
+    names = [name for name, data in members]
+    members = list(members)
+
+    if listfile != "missing":
+        listfile_member = ("(listfile)", ("\r\n".join(names) +
+                                          "\r\n").encode('utf-8'))
+        attributes_member = ("(attributes)",
+                             struct.pack('<II', 100, 0) +
+                             b'\x00' * 4 * (len(members) + 2))
+        if listfile == "swapped":
+            members += [attributes_member, listfile_member]
+        else:
+            members += [listfile_member, attributes_member]
+
+    body = bytearray()
+    blocks = []
+    for name, data in members:
+        block_offset = mpq.HEADER.size + len(body)
+        flags = mpq.FLAG_EXISTS
+        if compression != "none":
+            flags |= mpq.FLAG_COMPRESS
+        if encrypted:
+            flags |= mpq.FLAG_ENCRYPTED
+        if single_unit:
+            flags |= mpq.FLAG_SINGLE_UNIT
+
+        key = mpq.hash_string(name.split('\\')[-1], mpq.HASH_FILE_KEY)
+
+        if single_unit or compression == "none":
+            if single_unit:
+                chunks = [compress(data, compression)]
+            else:
+                chunks = [data[i:i + sector_size]
+                          for i in range(0, len(data), sector_size)]
+            if encrypted:
+                chunks = [encrypt(chunk, (key + i) & mpq.MASK)
+                          for i, chunk in enumerate(chunks)]
+            packed = b''.join(chunks)
+        else:
+            sectors = [compress(data[i:i + sector_size], compression)
+                       for i in range(0, len(data), sector_size)]
+            if encrypted:
+                sectors = [encrypt(sector, (key + i) & mpq.MASK)
+                           for i, sector in enumerate(sectors)]
+            offsets = [(len(sectors) + 1) * 4]
+            for sector in sectors:
+                offsets.append(offsets[-1] + len(sector))
+            table = struct.pack('<%dI' % len(offsets), *offsets)
+            if encrypted:
+                table = encrypt(table, (key - 1) & mpq.MASK)
+            packed = table + b''.join(sectors)
+
+        body += packed
+        blocks.append((block_offset, len(packed), len(data), flags))
+
+    hash_table_size = 16
+    while hash_table_size < len(members) * 2 + hash_padding:
+        hash_table_size *= 2
+
+    hash_table = [(mpq.HASH_ENTRY_EMPTY, mpq.HASH_ENTRY_EMPTY, 0xFFFF, 0xFFFF,
+                   mpq.HASH_ENTRY_EMPTY)] * hash_table_size
+    for block_index, (name, data) in enumerate(members):
+        index = mpq.hash_string(name, mpq.HASH_TABLE_OFFSET) % hash_table_size
+        while hash_table[index][4] != mpq.HASH_ENTRY_EMPTY:
+            index = (index + 1) % hash_table_size
+        hash_table[index] = (mpq.hash_string(name, mpq.HASH_NAME_A),
+                             mpq.hash_string(name, mpq.HASH_NAME_B),
+                             0, 0, block_index)
+
+    free = [index for index, entry in enumerate(hash_table)
+            if entry[4] == mpq.HASH_ENTRY_EMPTY]
+    for index in free[:hash_padding]:
+        hash_table[index] = (index, index, 0, 0, mpq.HASH_ENTRY_DELETED)
+
+    hash_table_bytes = encrypt(b''.join(mpq.HASH_ENTRY.pack(*entry)
+                                        for entry in hash_table),
+                               mpq.hash_string("(hash table)",
+                                               mpq.HASH_FILE_KEY))
+    block_table_bytes = encrypt(b''.join(mpq.BLOCK_ENTRY.pack(*entry)
+                                         for entry in blocks),
+                                mpq.hash_string("(block table)",
+                                                mpq.HASH_FILE_KEY))
+
+    hash_table_offset = mpq.HEADER.size + len(body)
+    block_table_offset = hash_table_offset + len(hash_table_bytes)
+    archive_size = block_table_offset + len(block_table_bytes)
+    header = mpq.HEADER.pack(mpq.MPQ_MAGIC, mpq.HEADER.size, archive_size, 0,
+                             sector_size_shift, hash_table_offset,
+                             block_table_offset, hash_table_size, len(blocks))
+
+    return header + bytes(body) + hash_table_bytes + block_table_bytes
+
+
+def _string(text):
+    """Encodes a NUL terminated string."""
+    return text.encode('utf-8') + b'\x00'
+
+
+def build_header(name, flags=0, max_players=4):
+    """Builds the 512 byte HM3W header which prefixes every map."""
+    header = b'HM3W' + struct.pack('<I', 0) + _string(name) + \
+             struct.pack('<II', flags, max_players)
+    return header.ljust(512, b'\x00')
+
+
+def build_w3e(tileset='L', width=33, height=33, tilesets=('Ldrt', 'Lgrs'),
+              cliff_tilesets=('CLdi',), seed=0):
+    """Builds a war3map.w3e terrain file with a random tilepoint grid."""
+    generator = random.Random(seed)
+    data = bytearray(b'W3E!' + struct.pack('<I', 11) + tileset.encode('ascii'))
+    data += struct.pack('<II', 1, len(tilesets))
+    data += b''.join(t.encode('ascii') for t in tilesets)
+    data += struct.pack('<I', len(cliff_tilesets))
+    data += b''.join(t.encode('ascii') for t in cliff_tilesets)
+    data += struct.pack('<IIff', width, height, -128.0 * (width - 1) / 2,
+                        -128.0 * (height - 1) / 2)
+
+    for i in range(width * height):
+        data += struct.pack('<hhBBB', 0x2000 + generator.randint(-256, 256),
+                            0x2000 - 89 * 4 + generator.choice((0, 0x4000)),
+                            (generator.choice((0, 0x20, 0x40)) & 0xF0) |
+                            generator.randrange(len(tilesets)),
+                            generator.randrange(16),
+                            (generator.randrange(len(cliff_tilesets) or 1)
+                             << 4) | generator.randint(0, 3))
+
+    return bytes(data)
+
+
+def build_wts(strings, bom=True, newline='\r\n'):
+    """Builds a war3map.wts string file from a {number: text} dict."""
+    text = ''
+    for number, value in sorted(strings.items()):
+        text += 'STRING ' + str(number) + newline + '{' + newline + \
+                value.replace('\n', newline) + newline + '}' + newline + \
+                newline
+    return (b'\xef\xbb\xbf' if bom else b'') + text.encode('utf-8')
+
+
+def build_w3i(version=25, name='TRIGSTR_001', author='TRIGSTR_002',
+              description='TRIGSTR_003', recommended_players='TRIGSTR_004',
+              players=4, width=64, height=64, ground_type='L', seed=0):
+    """Builds a war3map.w3i info file of the given format version."""
+    generator = random.Random(seed)
+    data = bytearray(struct.pack('<III', version, generator.randint(1, 200),
+                                 6059 if version < 28 else 6072))
+    if version >= 28:
+        data += struct.pack('<IIII', 1, 31, 1, 12173)
+    data += _string(name) + _string(author) + _string(description) + \
+            _string(recommended_players)
+    data += struct.pack('<8f', -2816.0, -3328.0, 2816.0, 2816.0, -2816.0,
+                        2816.0, 2816.0, -3328.0)
+    data += struct.pack('<IIII', 6, 6, 4, 8)
+    data += struct.pack('<II', width - 12, height - 12)
+    data += struct.pack('<I', 0x8000 | 0x0400 | 0x0004)
+    data += ground_type.encode('ascii')
+
+    if version == 18:
+        data += struct.pack('<i', -1)
+    else:
+        data += struct.pack('<i', -1) + _string('')
+    data += _string('') + _string('') + _string('')
+    if version == 18:
+        data += struct.pack('<i', 0)
+    else:
+        data += struct.pack('<I', 0) + _string('')
+    data += _string('') + _string('') + _string('')
+    if version >= 25:
+        data += struct.pack('<Ifff', 0, 3000.0, 5000.0, 0.5)
+        data += bytes([255, 255, 255, 255]) + b'\x00\x00\x00\x00' + \
+                _string('') + b'L' + bytes([255, 255, 255, 255])
+    if version >= 28:
+        data += struct.pack('<I', 0)
+    if version >= 31:
+        data += struct.pack('<II', 3, 1)
+
+    data += struct.pack('<I', players)
+    for i in range(players):
+        data += struct.pack('<IIII', i, 1, 1 + i % 4, 0)
+        data += _string('Player ' + str(i + 1))
+        data += struct.pack('<ffII', 128.0 * i, -128.0 * i, 0, 0)
+        if version >= 31:
+            data += struct.pack('<II', 0, 0)
+
+    data += struct.pack('<I', 2)
+    data += struct.pack('<II', 0, 0x5) + _string('Force 1')
+    data += struct.pack('<II', 0, 0xA) + _string('Force 2')
+
+    data += struct.pack('<I', 1)
+    data += struct.pack('<I', 0xFFFFFFFF) + b'Rhme' + struct.pack('<II', 0, 0)
+
+    data += struct.pack('<I', 1)
+    data += struct.pack('<I', 0xFFFFFFFF) + b'hpea'
+
+    data += struct.pack('<I', 1)
+    data += struct.pack('<I', 0) + _string('Unit Table') + \
+            struct.pack('<II', 1, 0) + struct.pack('<I', 2)
+    data += struct.pack('<I', 50) + b'hfoo' + struct.pack('<I', 50) + b'ogru'
+
+    if version >= 25:
+        data += struct.pack('<I', 1)
+        data += struct.pack('<I', 0) + _string('Item Table') + \
+                struct.pack('<I', 1) + struct.pack('<I', 2)
+        data += struct.pack('<I', 60) + b'ratf' + struct.pack('<I', 40) + \
+                b'rde1'
+
+    return bytes(data)
+
+
+def _placement(generator, type_id, x, y):
+    """Type id, variation, position, angle and scale of a placed object."""
+    return type_id.encode('ascii') + struct.pack(
+        '<i3ff3f', generator.randrange(10), x, y, 0.0,
+        generator.uniform(0, 6.28), 1.0, 1.0, 1.0)
+
+
+def build_doo(count=1000, types=('LTlt', 'ATtr', 'LOrb'), drops=False,
+              seed=0):
+    """
+    Builds a war3map.doo doodad file (TFT format) with count randomly placed
+    doodads. drops makes every hundredth doodad drop an item.
+    """
+    generator = random.Random(seed)
+    data = bytearray(b'W3do' + struct.pack('<IIi', 8, 11, count))
+    for i in range(count):
+        data += _placement(generator, generator.choice(types),
+                           generator.uniform(-2816, 2816),
+                           generator.uniform(-3328, 2816))
+        data += struct.pack('<BBi', 2, 100, -1)
+        if drops and i % 100 == 0:
+            data += struct.pack('<ii', 1, 1) + b'ratc' + \
+                struct.pack('<i', 100)
+        else:
+            data += struct.pack('<i', 0)
+        data += struct.pack('<i', i)
+
+    # special doodads
+    data += struct.pack('<ii', 0, 1) + b'YOtf' + struct.pack('<iii', 0, 0, 0)
+    return bytes(data)
+
+
+def _unit(generator, type_id, player, x, y, gold=12500, drops=0,
+          random_type=-1):
+    """A war3mapUnits.doo record (TFT format)."""
+    data = _placement(generator, type_id, x, y)
+    data += struct.pack('<BiBBiii', 2, player, 0, 0, -1, -1, -1)
+    data += struct.pack('<i', 1 if drops else 0)
+    if drops:
+        data += struct.pack('<i', drops) + (b'ratc' +
+                                            struct.pack('<i', 10)) * drops
+    data += struct.pack('<ifi', gold, -1.0, 1)
+    data += struct.pack('<iii', 0, 0, 0)
+    data += struct.pack('<i', 1) + struct.pack('<i', 0) + b'ratc'
+    data += struct.pack('<i', 1) + b'AHbz' + struct.pack('<ii', 0, 1)
+    data += struct.pack('<i', random_type)
+    if random_type == 0:
+        data += struct.pack('<i', 1)
+    elif random_type == 1:
+        data += struct.pack('<ii', 0, 0)
+    elif random_type == 2:
+        data += struct.pack('<i', 1) + b'hfoo' + struct.pack('<i', 100)
+    data += struct.pack('<iii', -1, -1, 0)
+    return data
+
+
+def build_units(players=4, units=50, seed=0):
+    """
+    Builds a war3mapUnits.doo unit file (TFT format) with a start location
+    and a gold mine next to it for every player and randomly placed neutral
+    creeps, some of which drop items.
+    """
+    generator = random.Random(seed)
+    records = []
+    for player in range(players):
+        x = generator.uniform(-2500, 2500)
+        y = generator.uniform(-2500, 2500)
+        records.append(_unit(generator, 'sloc', player, x, y))
+        records.append(_unit(generator, 'ngol', 15, x + 600, y,
+                             gold=12500 + 1000 * player))
+    for i in range(units):
+        records.append(_unit(generator, generator.choice(('nfrl', 'ngno')),
+                             24, generator.uniform(-2500, 2500),
+                             generator.uniform(-2500, 2500),
+                             drops=i % 3, random_type=i % 4 - 1))
+
+    return b'W3do' + struct.pack('<IIi', 8, 11, len(records)) + \
+        b''.join(records)
+
+
+NATIVES = ('CreateUnit', 'GetTriggerUnit', 'DisplayTextToPlayer',
+           'TriggerRegisterTimerEvent', 'GetLocalPlayer', 'ExecuteFunc',
+           'I2S', 'GetRandomInt', 'SetUnitPosition', 'KillUnit')
+
+
+def build_script(functions=100, globals_count=50, seed=0):
+    """
+    Builds a war3map.j JASS script with a globals block and functions which
+    call natives and the functions defined before them, with string
+    literals, rawcodes and comments in the way.
+    """
+    generator = random.Random(seed)
+    lines = ['globals']
+    for i in range(globals_count):
+        lines.append('    integer udg_Value' + str(i) + ' = ' + str(i))
+    lines.append('    // trigger variables')
+    lines.append('    trigger gg_trg_Main = null')
+    lines.append('endglobals')
+    lines.append('')
+    lines.append('native UnitAlive takes unit id returns boolean')
+
+    for i in range(functions):
+        lines.append('function Function' + str(i) +
+                     ' takes integer a returns nothing')
+        lines.append('    local unit u = CreateUnit(Player(0), \'hfoo\', '
+                     '0.0, 0.0, 270.0)')
+        lines.append('    // call NotCalled(u)')
+        for j in range(generator.randint(2, 6)):
+            native = generator.choice(NATIVES)
+            lines.append('    call ' + native + '("text (' + str(j) +
+                         ') \\"quoted\\"", u)')
+        if i:
+            lines.append('    call Function' + str(generator.randrange(i)) +
+                         '(a + 1)')
+        lines.append('    if (a > 0) and not(UnitAlive(u)) then')
+        lines.append('        set udg_Value0 = GetRandomInt(0, a)')
+        lines.append('    endif')
+        lines.append('endfunction')
+        lines.append('')
+
+    return '\r\n'.join(lines).encode('utf-8')
+
+
+def build_wtg(categories=3, variables=10, triggers=5, version=7):
+    """
+    Builds a war3map.wtg trigger file (4 Reign of Chaos, 7 The Frozen
+    Throne) whose triggers have no events, conditions or actions.
+    """
+    data = bytearray(b'WTG!' + struct.pack('<II', version, categories))
+    for i in range(categories):
+        data += struct.pack('<I', i) + _string('Category ' + str(i))
+        if version == 7:
+            data += struct.pack('<I', 0)
+    data += struct.pack('<II', 2, variables)
+    for i in range(variables):
+        data += _string('Value' + str(i)) + _string('integer') + \
+            struct.pack('<II', 1, 0)
+        if version == 7:
+            data += struct.pack('<I', 1)
+        data += struct.pack('<I', 1) + _string(str(i))
+    data += struct.pack('<I', triggers)
+    for i in range(triggers):
+        data += _string('Trigger ' + str(i)) + _string('')
+        if version == 7:
+            data += struct.pack('<I', 0)
+        data += struct.pack('<IIIIII', 1, 0, 0, 0, i % max(categories, 1),
+                            0)
+    return bytes(data)
+
+
+def build_w3f(maps, name='TRIGSTR_001', author='TRIGSTR_002',
+              description='TRIGSTR_003', expansion=True):
+    """
+    Builds a war3campaign.w3f campaign info file listing the given
+    (chapter, title, path) maps.
+    """
+    data = struct.pack('<III', 1, 3, 6059) + _string(name) + \
+        _string('Normal') + _string(author) + _string(description)
+    data += struct.pack('<Ii', 2 if expansion else 0, -1) + _string('') + \
+        _string('') + struct.pack('<i', 0) + _string('')
+    data += struct.pack('<Ifff4sI', 0, 0.0, 0.0, 0.0, b'\x00\x00\x00\xff', 0)
+    data += struct.pack('<I', len(maps))
+    for chapter, title, path in maps:
+        data += struct.pack('<I', 1) + _string(chapter) + _string(title) + \
+            _string(path)
+    data += struct.pack('<I', len(maps))
+    for chapter, title, path in maps:
+        data += _string('') + _string(path)
+    return data
+
+
+def _picture(width, height):
+    """Returns the BGRA bytes of a gradient picture."""
+    pixels = bytearray()
+    for y in range(height):
+        for x in range(width):
+            pixels += bytes((x * 255 // max(width - 1, 1),
+                             y * 255 // max(height - 1, 1),
+                             (x + y) * 255 // max(width + height - 2, 1),
+                             255 if (x // 8 + y // 8) % 2 else 128))
+    return bytes(pixels)
+
+
+def build_tga(width=256, height=256, rle=False):
+    """Builds a bottom up 32 bit TGA picture, as war3mapPreview.tga."""
+    pixels = _picture(width, height)
+    rows = [pixels[y * width * 4:(y + 1) * width * 4]
+            for y in range(height)][::-1]
+    data = b''.join(rows)
+
+    if rle:
+        # a raw packet per row, then a run of its first pixel
+        packets = bytearray()
+        for row in rows:
+            for start in range(0, width, 128):
+                count = min(128, width - start)
+                packets += bytes([count - 1]) + \
+                    row[start * 4:(start + count) * 4]
+        data = bytes(packets)
+
+    header = struct.pack('<BBB5sHHHHBB', 0, 0, 10 if rle else 2, b'', 0, 0,
+                         width, height, 32, 8)
+    return header + data
+
+
+def build_blp(width=128, height=128, content="palette", alpha_bits=8):
+    """
+    Builds a BLP1 picture with a single mipmap, as war3mapMap.blp. JPEG
+    content needs Pillow.
+    """
+    pixels = _picture(width, height)
+    offset = 4 + 4 * 6 + 4 * 32
+
+    if content == "jpeg":
+        from PIL import Image
+        # the channels are stored as BGRA in a four component JPEG
+        image = Image.frombytes("CMYK", (width, height), pixels)
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=90)
+        prefix = struct.pack('<I', 0)  # no header shared by the mipmaps
+        mipmap = output.getvalue()
+        content_type = 0
+    else:
+        # 256 BGRA colors picked from the picture, every pixel uses the
+        # closest one by its index
+        palette = [pixels[i * 4:i * 4 + 4]
+                   for i in range(0, width * height,
+                                  max(width * height // 256, 1))][:256]
+        palette += [b'\x00' * 4] * (256 - len(palette))
+        prefix = b''.join(palette)
+        step = max(width * height // 256, 1)
+        indexes = bytes(min(i // step, 255) for i in range(width * height))
+        alphas = [pixels[i * 4 + 3] for i in range(width * height)]
+        if alpha_bits == 8:
+            alpha = bytes(alphas)
+        elif alpha_bits == 4:
+            alpha = bytes((alphas[i] >> 4) | (alphas[i + 1] >> 4 << 4)
+                          if i + 1 < len(alphas) else alphas[i] >> 4
+                          for i in range(0, len(alphas), 2))
+        elif alpha_bits == 1:
+            alpha = bytes(sum((alphas[i + bit] >> 7) << bit
+                              for bit in range(8) if i + bit < len(alphas))
+                          for i in range(0, len(alphas), 8))
+        else:
+            alpha = b''
+        mipmap = indexes + alpha
+        content_type = 1
+
+    header = struct.pack('<4sIIIIII', b'BLP1', content_type, alpha_bits,
+                         width, height, 4, 0)
+    offsets = [offset + len(prefix)] + [0] * 15
+    sizes = [len(mipmap)] + [0] * 15
+    return header + struct.pack('<16I16I', *(offsets + sizes)) + prefix + \
+        mipmap
+
+
+def build_map(name='Synthetic Map', version=25, players=4, extra_members=0,
+              member_size=4096, compression="zlib", strings=None,
+              string_table_size=0, subdirectories=0, listfile="normal",
+              encrypted=False, single_unit=False, preview=False,
+              minimap=None, doodads=0, doodad_drops=False, hash_padding=0,
+              script_functions=0, seed=0):
+    """
+    Builds a complete map. extra_members adds filler members of member_size
+    bytes next to the ones kraftver reads, string_table_size pads the string
+    file with that many extra strings and subdirectories puts the filler
+    members that many directories deep. preview adds war3mapPreview.tga and
+    minimap ("palette" or "jpeg") adds war3mapMap.blp. doodads adds that
+    many doodads in war3map.doo and a war3mapUnits.doo. hash_padding pads
+    the hash table with deleted entries. script_functions adds a war3map.j
+    with that many functions and a war3map.wtg.
+    """
+    generator = random.Random(seed)
+    if strings is None:
+        strings = {1: name, 2: 'Kraftver', 3: 'A map built by mapgen.py',
+                   4: str(players) + ' players'}
+    strings = dict(strings)
+    for i in range(string_table_size):
+        strings[1000 + i] = 'Filler string number ' + str(i)
+
+    members = [
+        ('war3map.w3e', build_w3e(seed=seed)),
+        ('war3map.w3i', build_w3i(version=version, players=players,
+                                  seed=seed)),
+        ('war3map.wts', build_wts(strings)),
+    ]
+    if preview:
+        members.append(('war3mapPreview.tga', build_tga()))
+    if minimap:
+        members.append(('war3mapMap.blp', build_blp(content=minimap)))
+    if doodads:
+        members.append(('war3map.doo', build_doo(doodads, drops=doodad_drops,
+                                                 seed=seed)))
+        members.append(('war3mapUnits.doo', build_units(players, seed=seed)))
+    if script_functions:
+        members.append(('war3map.j', build_script(script_functions,
+                                                  seed=seed)))
+        members.append(('war3map.wtg', build_wtg()))
+    for i in range(extra_members):
+        path = ''.join('Dir' + str(depth) + '\\'
+                       for depth in range(subdirectories))
+        # half random, half repeating so the compressors have work to do
+        data = bytes(generator.getrandbits(8)
+                     for j in range(member_size // 2))
+        data += b'kraftver' * ((member_size - len(data)) // 8 + 1)
+        members.append((path + 'filler' + str(i) + '.dat',
+                        data[:member_size]))
+
+    return build_header(name, 0, players) + \
+        build_archive(members, compression, encrypted=encrypted,
+                      single_unit=single_unit, listfile=listfile,
+                      hash_padding=hash_padding)
+
+
+def build_campaign(name='Synthetic Campaign', maps=3, doodads=0,
+                   script_functions=0, seed=0):
+    """
+    Builds a campaign of the given number of maps, each of them built by
+    build_map() with the given doodads and script_functions.
+    """
+    chapters = []
+    members = []
+    for i in range(maps):
+        path = 'Chapter%02d.w3x' % (i + 1)
+        chapters.append(('Chapter ' + str(i + 1), 'Map ' + str(i + 1), path))
+        members.append((path, build_map('Map ' + str(i + 1), doodads=doodads,
+                                        script_functions=script_functions,
+                                        seed=seed + i)))
+    strings = {1: name, 2: 'Kraftver', 3: 'A campaign built by mapgen.py'}
+    members[:0] = [('war3campaign.w3f', build_w3f(chapters)),
+                   ('war3campaign.wts', build_wts(strings))]
+
+    return build_header(name, 0, 1) + build_archive(members)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(
+        description="Builds a synthetic Warcraft III map.")
+    parser.add_argument("output", help="path of the map to write")
+    parser.add_argument("--name", default="Synthetic Map")
+    parser.add_argument("--version", type=int, default=25,
+                        help="war3map.w3i format version (18, 25, 28, 31)")
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--members", type=int, default=0,
+                        help="number of filler members")
+    parser.add_argument("--member-size", type=int, default=4096)
+    parser.add_argument("--compression", choices=COMPRESSION_TYPES,
+                        default="zlib")
+    parser.add_argument("--strings", type=int, default=0,
+                        help="number of filler strings in war3map.wts")
+    parser.add_argument("--subdirectories", type=int, default=0,
+                        help="depth of the filler members' directory")
+    parser.add_argument("--listfile", choices=("normal", "swapped",
+                                               "missing"), default="normal")
+    parser.add_argument("--encrypted", action="store_true")
+    parser.add_argument("--single-unit", action="store_true")
+    parser.add_argument("--preview", action="store_true",
+                        help="add war3mapPreview.tga")
+    parser.add_argument("--minimap", choices=("palette", "jpeg"),
+                        help="add war3mapMap.blp")
+    parser.add_argument("--doodads", type=int, default=0,
+                        help="number of doodads in war3map.doo (adds "
+                             "war3mapUnits.doo too)")
+    parser.add_argument("--hash-padding", type=int, default=0,
+                        help="number of deleted hash table entries")
+    parser.add_argument("--script-functions", type=int, default=0,
+                        help="number of functions in war3map.j (adds "
+                             "war3map.wtg too)")
+    parser.add_argument("--campaign", type=int, default=0,
+                        help="build a campaign of that many maps instead")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.campaign:
+        with open(args.output, 'wb') as f:
+            f.write(build_campaign(args.name, args.campaign, args.doodads,
+                                   args.script_functions, args.seed))
+        return
+
+    map_bytes = build_map(args.name, args.version, args.players,
+                          args.members, args.member_size, args.compression,
+                          string_table_size=args.strings,
+                          subdirectories=args.subdirectories,
+                          listfile=args.listfile, encrypted=args.encrypted,
+                          single_unit=args.single_unit,
+                          preview=args.preview, minimap=args.minimap,
+                          doodads=args.doodads,
+                          hash_padding=args.hash_padding,
+                          script_functions=args.script_functions,
+                          seed=args.seed)
+    with open(args.output, 'wb') as f:
+        f.write(map_bytes)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Metrics"""
+# Every stage of reading a map is timed into a histogram and the errors are
+# counted by their cause, all of it is rendered in the Prometheus text format
+# for /metrics. The stages of the current request are also remembered so
+# they can be sent back in the Server-Timing header.
+
+import threading
+import time
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, 30.0, float('inf'))
+
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets, one series per label value."""
+
+    def __init__(self, name, documentation, label, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self.series = {}  # label value -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = \
+                    [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.documentation,
+                 "# TYPE " + self.name + " histogram"]
+        with self.lock:
+            for label_value, (counts, total, count) in \
+                    sorted(self.series.items()):
+                label = self.label + '="' + escape(label_value) + '"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('%s_bucket{%s,le="%s"} %d' %
+                                 (self.name, label, format_bound(bound),
+                                  bucket_count))
+                lines.append('%s_sum{%s} %r' % (self.name, label, total))
+                lines.append('%s_count{%s} %d' % (self.name, label, count))
+        return lines
+
+
+class Counter(object):
+    """Counter, one series per label value (or a single one without label)."""
+
+    def __init__(self, name, documentation, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, label_value=None):
+        with self.lock:
+            self.series[label_value] = self.series.get(label_value, 0) + value
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.documentation,
+                 "# TYPE " + self.name + " counter"]
+        with self.lock:
+            for label_value, value in sorted(self.series.items(),
+                                             key=lambda item: str(item[0])):
+                if self.label is None:
+                    lines.append('%s %r' % (self.name, value))
+                else:
+                    lines.append('%s{%s="%s"} %r' %
+                                 (self.name, self.label, escape(label_value),
+                                  value))
+        return lines
+
+
+def escape(label_value):
+    """Escapes a label value for the Prometheus text format."""
+    return str(label_value).replace('\\', '\\\\').replace('"', '\\"') \
+                           .replace('\n', '\\n')
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def single(name, metric_type, documentation, value):
+    """Returns the lines of a single unlabeled counter or gauge."""
+    return ["# HELP " + name + " " + documentation,
+            "# TYPE " + name + " " + metric_type,
+            '%s %r' % (name, value)]
+
+
+STAGE_SECONDS = Histogram("kraftver_stage_seconds",
+                          "Time spent in each stage of reading a map.",
+                          "stage")
+REQUEST_SECONDS = Histogram("kraftver_request_seconds",
+                            "Time spent handling a request.", "endpoint")
+ERRORS = Counter("kraftver_errors_total",
+                 "Maps which couldn't be read, by cause.", "cause")
+MAP_BYTES = Counter("kraftver_map_bytes_total", "Bytes of maps processed.")
+MAPS = Counter("kraftver_maps_total", "Maps processed.")
+
+_current = threading.local()
+
+
+def start_request():
+    """Starts collecting the stage timings of the current request."""
+    _current.timings = []
+
+
+def finish_request():
+    """
+    Stops collecting the stage timings of the current request and returns
+    them, stages run outside of a request only go into the histograms.
+    """
+    timings = request_timings()
+    _current.timings = None
+    return timings
+
+
+def request_timings():
+    """Returns the (stage, seconds) pairs of the current request."""
+    return getattr(_current, 'timings', None) or []
+
+
+def server_timing():
+    """Returns the Server-Timing header value of the current request."""
+    return ', '.join('%s;dur=%.3f' % (stage, seconds * 1000)
+                     for stage, seconds in request_timings())
+
+
+class stage(object):
+    """Context manager which times a stage of reading a map."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, time.perf_counter() - self.started)
+
+
+def record(name, seconds):
+    """
+    Records the time of a stage, and of the current request if one was
+    started, also used for the stages run by another process for it.
+    """
+    STAGE_SECONDS.observe(name, seconds)
+    timings = getattr(_current, 'timings', None)
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+def count_map(map_size, error):
+    """Counts a processed map and, if it couldn't be read, its error."""
+    MAPS.inc()
+    MAP_BYTES.inc(map_size)
+    if error:
+        # the details after the colon are specific to the map
+        ERRORS.inc(label_value=error.split(':', 1)[0])
+
+
+def render(extra_lines=()):
+    """Returns all metrics in the Prometheus text format."""
+    lines = []
+    for metric in (STAGE_SECONDS, REQUEST_SECONDS, ERRORS, MAP_BYTES, MAPS):
+        lines += metric.render()
+    lines += extra_lines
+    return '\n'.join(lines) + '\n'
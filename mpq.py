@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+"""MPQ archive reader"""
+# Warcraft III maps are MPQ archives prefixed with a 512 byte HM3W header.
+# This module reads the MPQ header, hash table and block table straight from
+# a buffer and decompresses only the members that are asked for, so we don't
+# have to unpack the whole archive to disk with an external tool.
+
+import bz2
+import hashlib
+import struct
+import zlib
+
+import listfile
+
+MPQ_MAGIC = b'MPQ\x1a'
+MPQ_USER_DATA_MAGIC = b'MPQ\x1b'
+
+# hash types used by hash_string()
+HASH_TABLE_OFFSET = 0
+HASH_NAME_A = 1
+HASH_NAME_B = 2
+HASH_FILE_KEY = 3
+
+# block flags
+FLAG_IMPLODE = 0x00000100
+FLAG_COMPRESS = 0x00000200
+FLAG_ENCRYPTED = 0x00010000
+FLAG_FIX_KEY = 0x00020000
+FLAG_SINGLE_UNIT = 0x01000000
+FLAG_DELETE_MARKER = 0x02000000
+FLAG_EXISTS = 0x80000000
+
+# compression types stored in the first byte of a compressed sector
+COMPRESSION_ZLIB = 0x02
+COMPRESSION_PKWARE = 0x08
+COMPRESSION_BZIP2 = 0x10
+SUPPORTED_COMPRESSION = COMPRESSION_ZLIB | COMPRESSION_PKWARE | \
+                        COMPRESSION_BZIP2
+
+# hash table entries with these block indices are empty or deleted
+HASH_ENTRY_EMPTY = 0xFFFFFFFF
+HASH_ENTRY_DELETED = 0xFFFFFFFE
+
+# files the archive uses for its own bookkeeping
+SPECIAL_FILES = ("(listfile)", "(attributes)", "(signature)")
+
+HEADER = struct.Struct('<4sIIHHIIII')
+USER_DATA_HEADER = struct.Struct('<4sIII')
+HASH_ENTRY = struct.Struct('<IIHHI')
+BLOCK_ENTRY = struct.Struct('<IIII')
+
+MASK = 0xFFFFFFFF
+
+
+class LimitExceeded(ValueError):
+    """
+    Raised when a member would decompress past the archive's output or
+    compression ratio limit.
+    """
+
+
+def _build_crypt_table():
+    """Builds the 0x500 entries long table used for hashing and encryption."""
+    table = [0] * 0x500
+    seed = 0x00100001
+
+    for i in range(0x100):
+        index = i
+        for j in range(5):
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp1 = (seed & 0xFFFF) << 0x10
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp2 = seed & 0xFFFF
+            table[index] = temp1 | temp2
+            index += 0x100
+
+    return table
+
+CRYPT_TABLE = _build_crypt_table()
+
+
+def normalize_name(name):
+    """
+    Returns the bytes of the given archive file name which are hashed. MPQ
+    file names use backslashes as path separators and are case insensitive
+    for the ASCII letters only, like the game's own toupper() table.
+    """
+    return name.replace('/', '\\').encode('utf-8').upper()
+
+
+def hash_string(name, hash_type):
+    """Hashes the given archive file name."""
+    seed1 = 0x7FED7FED
+    seed2 = 0xEEEEEEEE
+
+    for char in normalize_name(name):
+        seed1 = CRYPT_TABLE[(hash_type << 8) + char] ^ ((seed1 + seed2) & MASK)
+        seed2 = (char + seed1 + seed2 + (seed2 << 5) + 3) & MASK
+
+    return seed1
+
+
+def _name_hashes(name):
+    return (hash_string(name, HASH_TABLE_OFFSET),
+            hash_string(name, HASH_NAME_A), hash_string(name, HASH_NAME_B))
+
+# (hash table offset, name hash A, name hash B) of the known member names,
+# by their normalize_name()
+NAME_HASHES = dict((normalize_name(name), _name_hashes(name))
+                   for name in listfile.KNOWN_NAMES)
+
+
+def name_hashes(name):
+    """
+    Returns the hash table offset and the two name hashes used to find the
+    given member, the known names aren't hashed again.
+    """
+    hashes = NAME_HASHES.get(normalize_name(name))
+    if hashes is None:
+        hashes = _name_hashes(name)
+    return hashes
+
+
+def decrypt(data, key):
+    """Decrypts the given bytes with the given key."""
+    count = len(data) // 4
+    values = struct.unpack_from('<%dI' % count, data)
+    seed = 0xEEEEEEEE
+    decrypted = []
+
+    for value in values:
+        seed = (seed + CRYPT_TABLE[0x400 + (key & 0xFF)]) & MASK
+        value = (value ^ (key + seed)) & MASK
+        key = ((((~key) & MASK) << 0x15) + 0x11111111 | (key >> 0x0B)) & MASK
+        seed = (value + seed + (seed << 5) + 3) & MASK
+        decrypted.append(value)
+
+    # the trailing bytes which don't make up a whole word are not encrypted
+    return struct.pack('<%dI' % count, *decrypted) + bytes(data[count * 4:])
+
+
+class _Huffman(object):
+    """Canonical Huffman code used by the PKWARE Data Compression Library."""
+
+    def __init__(self, compact_lengths):
+        # the code lengths are stored run length encoded, the high nibble is
+        # the repeat count minus one and the low nibble is the length
+        lengths = []
+        for byte in compact_lengths:
+            lengths += [byte & 15] * ((byte >> 4) + 1)
+
+        self.count = [0] * 14
+        for length in lengths:
+            self.count[length] += 1
+
+        offsets = [0] * 14
+        for length in range(1, 13):
+            offsets[length + 1] = offsets[length] + self.count[length]
+
+        self.symbol = [0] * len(lengths)
+        for symbol, length in enumerate(lengths):
+            if length != 0:
+                self.symbol[offsets[length]] = symbol
+                offsets[length] += 1
+
+
+class _Exploder(object):
+    """
+    Decompresses data compressed with the PKWARE Data Compression Library
+    implode algorithm. This is a port of Mark Adler's blast.c.
+    """
+    LITERALS = _Huffman(bytes([
+        11, 124, 8, 7, 28, 7, 188, 13, 76, 4, 10, 8, 12, 10, 12, 10, 8, 23, 8,
+        9, 7, 6, 7, 8, 7, 6, 55, 8, 23, 24, 12, 11, 7, 9, 11, 12, 6, 7, 22, 5,
+        7, 24, 6, 11, 9, 6, 7, 22, 7, 11, 38, 7, 9, 8, 25, 11, 8, 11, 9, 12,
+        8, 12, 5, 38, 5, 38, 5, 11, 7, 5, 6, 21, 6, 10, 53, 8, 7, 24, 10, 27,
+        44, 253, 253, 253, 252, 252, 252, 13, 12, 45, 12, 45, 12, 61, 12, 45,
+        44, 173]))
+    LENGTHS = _Huffman(bytes([2, 35, 36, 53, 38, 23]))
+    DISTANCES = _Huffman(bytes([2, 20, 53, 230, 247, 151, 248]))
+    LENGTH_BASE = (3, 2, 4, 5, 6, 7, 8, 9, 10, 12, 16, 24, 40, 72, 136, 264)
+    LENGTH_EXTRA = (0, 0, 0, 0, 0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8)
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+        self.bit_buffer = 0
+        self.bit_count = 0
+
+    def bits(self, need):
+        """Returns the next need bits from the input, least significant first."""
+        while self.bit_count < need:
+            if self.position >= len(self.data):
+                raise ValueError("imploded data is truncated")
+            self.bit_buffer |= self.data[self.position] << self.bit_count
+            self.position += 1
+            self.bit_count += 8
+
+        value = self.bit_buffer & ((1 << need) - 1)
+        self.bit_buffer >>= need
+        self.bit_count -= need
+        return value
+
+    def decode(self, huffman):
+        """Decodes one symbol, the codes are stored bit inverted."""
+        code = first = index = 0
+        for length in range(1, 14):
+            code |= self.bits(1) ^ 1
+            count = huffman.count[length]
+            if code - first < count:
+                return huffman.symbol[index + code - first]
+            index += count
+            first = (first + count) << 1
+            code <<= 1
+
+        raise ValueError("imploded data contains an invalid code")
+
+    def explode(self, limit=None):
+        """
+        Returns the decompressed data. Raises ValueError if it grows past
+        limit bytes.
+        """
+        coded_literals = self.bits(8)
+        if coded_literals > 1:
+            raise ValueError("imploded data has an invalid literal flag")
+        dictionary_bits = self.bits(8)
+        if dictionary_bits < 4 or dictionary_bits > 6:
+            raise ValueError("imploded data has an invalid dictionary size")
+
+        output = bytearray()
+        while True:
+            if self.bits(1):
+                symbol = self.decode(self.LENGTHS)
+                length = self.LENGTH_BASE[symbol] + \
+                         self.bits(self.LENGTH_EXTRA[symbol])
+                if length == 519:  # end of stream marker
+                    break
+
+                shift = 2 if length == 2 else dictionary_bits
+                distance = (self.decode(self.DISTANCES) << shift) + \
+                           self.bits(shift) + 1
+                if distance > len(output):
+                    raise ValueError("imploded data references data before "
+                                     "the start of the output")
+
+                # the copy can overlap the bytes it produces
+                start = len(output) - distance
+                for i in range(length):
+                    output.append(output[start + i])
+                if limit is not None and len(output) > limit:
+                    raise ValueError("imploded data is longer than expected")
+            elif coded_literals:
+                output.append(self.decode(self.LITERALS))
+            else:
+                output.append(self.bits(8))
+
+        return bytes(output)
+
+
+def explode(data, limit=None):
+    """Decompresses PKWARE DCL imploded data, up to limit bytes."""
+    return _Exploder(data).explode(limit)
+
+
+def decompress(data, size, flags):
+    """
+    Decompresses a single sector (or a single unit file) of a member. The
+    output never grows much past the expected size, whatever the data says.
+    """
+    if flags & FLAG_IMPLODE:
+        return explode(data, size)
+
+    compression = data[0]
+    data = data[1:]
+
+    if compression & ~SUPPORTED_COMPRESSION:
+        raise ValueError("unsupported compression type: 0x%02x" % compression)
+
+    # the imploded data bzip2 unpacks may be a bit longer than the sector
+    limit = size * 2 if compression & COMPRESSION_PKWARE else size
+    try:
+        if compression & COMPRESSION_BZIP2:
+            data = bz2.BZ2Decompressor().decompress(data, limit)
+        if compression & COMPRESSION_PKWARE:
+            data = explode(data, size)
+        if compression & COMPRESSION_ZLIB:
+            data = zlib.decompressobj().decompress(data, size)
+    except (OSError, zlib.error) as e:
+        raise ValueError("can't decompress archive member: " + str(e))
+
+    return data
+
+
+def find_header(data):
+    """
+    Returns the offset of the MPQ header in the given buffer, it's always
+    aligned to 512 bytes. Raises ValueError if there's none.
+    """
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        magic = bytes(data[offset:offset + 4])
+        if magic == MPQ_MAGIC:
+            return offset
+        if magic == MPQ_USER_DATA_MAGIC:
+            header_offset = USER_DATA_HEADER.unpack_from(data, offset)[2]
+            if data[offset + header_offset:
+                    offset + header_offset + 4] == MPQ_MAGIC:
+                return offset + header_offset
+        offset += 512
+
+    raise ValueError("can't find MPQ header inside the map file")
+
+
+class MPQArchive(object):
+    """
+    Read-only MPQ archive backed by a buffer (bytes, bytearray, memoryview or
+    mmap). Only the version 0 header fields are used, just like Warcraft III
+    itself does, which keeps most of the "protected" maps readable. The
+    members read may decompress to max_output bytes in total and to at most
+    max_ratio times their compressed size (0 means unbound).
+    """
+
+    def __init__(self, data, max_output=0, max_ratio=0):
+        self.data = data
+        self.offset = find_header(data)
+        self.max_output = max_output
+        self.max_ratio = max_ratio
+        self.output = 0  # bytes of the members read so far
+
+        (magic, header_size, archive_size, format_version, sector_size_shift,
+         hash_table_offset, block_table_offset, hash_table_entries,
+         block_table_entries) = HEADER.unpack_from(self.data, self.offset)
+
+        self.sector_size = 512 << sector_size_shift
+        # names are looked up modulo the declared size, the entries of a
+        # table running past the end of the file are never found
+        self.hash_table_size = hash_table_entries
+        self.hash_table = self._read_table(hash_table_offset,
+                                           hash_table_entries, HASH_ENTRY,
+                                           "(hash table)")
+        self.block_table = self._read_table(block_table_offset,
+                                            block_table_entries, BLOCK_ENTRY,
+                                            "(block table)")
+
+        if len(self.hash_table) == 0:
+            raise ValueError("MPQ archive has an empty hash table")
+
+        self.index = self._build_index()
+
+    def _read_table(self, table_offset, entries, entry_struct, key_name):
+        """Reads and decrypts the hash or block table."""
+        start = self.offset + table_offset
+        size = entries * entry_struct.size
+
+        # protected maps often declare tables which run past the end of the
+        # file, read only the entries which are actually there
+        size = min(size, max(len(self.data) - start, 0))
+        size -= size % entry_struct.size
+
+        table = decrypt(self.data[start:start + size],
+                        hash_string(key_name, HASH_FILE_KEY))
+
+        return [entry_struct.unpack_from(table, i)
+                for i in range(0, size, entry_struct.size)]
+
+    def _build_index(self):
+        """
+        Returns the hash table entries of existing members by their name
+        hashes, with the position of each entry and of the first entry of
+        its run. The game probes the table from a name's position up to the
+        first empty entry, so an entry is only found from positions in its
+        run. Protected maps pad the table with entries which make probing
+        slow, looking names up in the index takes the same time for all.
+        The entries missing from a truncated table are never empty.
+        """
+        size = self.hash_table_size
+        present = len(self.hash_table)
+        empty = [i for i, entry in enumerate(self.hash_table)
+                 if entry[4] == HASH_ENTRY_EMPTY]
+
+        index = {}
+        first = (empty[-1] + 1) % size if empty else 0
+        run_start = first
+        if first >= present:
+            first = 0
+        for step in range(present):
+            i = (first + step) % present
+            hash_a, hash_b, locale, platform, block_index = \
+                self.hash_table[i]
+            if block_index == HASH_ENTRY_EMPTY:
+                run_start = (i + 1) % size
+                continue
+            if block_index < len(self.block_table) and \
+               self.block_table[block_index][3] & FLAG_EXISTS:
+                # without empty entries every entry is found from anywhere
+                index.setdefault((hash_a, hash_b), []).append(
+                    (i, run_start if empty else (i + 1) % size))
+
+        return index
+
+    def _find_block(self, name):
+        """Returns the block table entry for the given name or None."""
+        offset, name_a, name_b = name_hashes(name)
+        size = self.hash_table_size
+        start = offset % size
+
+        # the entry probing would reach first
+        found = None
+        for i, run_start in self.index.get((name_a, name_b), ()):
+            distance = (i - start) % size
+            if distance <= (i - run_start) % size and \
+               (found is None or distance < found[0]):
+                found = (distance, i)
+        if found is None:
+            return None
+
+        return self.block_table[self.hash_table[found[1]][4]]
+
+    def has_file(self, name):
+        """Checks if the archive contains a member with the given name."""
+        return self._find_block(name) is not None
+
+    def member_digest(self, name):
+        """
+        Returns a digest of the member's stored (compressed and maybe
+        encrypted) bytes and of everything its decoding depends on, so
+        members with the same digest have the same contents. Nothing is
+        decompressed. Raises KeyError if the archive doesn't contain it.
+        """
+        block = self._find_block(name)
+        if block is None:
+            raise KeyError(name)
+
+        block_offset, compressed_size, file_size, flags = block
+        digest = hashlib.blake2b(struct.pack('<III', file_size, flags,
+                                             self.sector_size),
+                                 digest_size=16)
+        if flags & FLAG_ENCRYPTED:
+            # the key comes from the name and maybe the member's offset
+            digest.update(name.lower().encode('utf-8', 'replace'))
+            if flags & FLAG_FIX_KEY:
+                digest.update(struct.pack('<I', block_offset))
+        start = self.offset + block_offset
+        digest.update(self.data[start:start + compressed_size])
+        return digest.hexdigest()
+
+    def file_count(self):
+        """
+        Returns the number of members referenced by the hash table, not
+        counting the archive's own bookkeeping files.
+        """
+        count = 0
+        for hash_entry in self.hash_table:
+            block_index = hash_entry[4]
+            if block_index < len(self.block_table) and \
+               self.block_table[block_index][3] & FLAG_EXISTS:
+                count += 1
+
+        for name in SPECIAL_FILES:
+            if self.has_file(name):
+                count -= 1
+
+        return count
+
+    def _check_limits(self, name, compressed_size, file_size):
+        """
+        Raises LimitExceeded if the member's declared size goes past the
+        limits, before anything is decompressed. The sectors are never
+        decompressed past their declared size.
+        """
+        if self.max_ratio and \
+           file_size > self.max_ratio * max(compressed_size, 1):
+            raise LimitExceeded("%s decompresses to more than %d times its "
+                                "size" % (name, self.max_ratio))
+        if self.max_output and self.output + file_size > self.max_output:
+            raise LimitExceeded("%s decompresses past the %d MB limit" %
+                                (name, self.max_output // (1024 * 1024)))
+        self.output += file_size
+
+    def read_file(self, name):
+        """
+        Returns the decompressed contents of the given member. Raises KeyError
+        if the archive doesn't contain it.
+        """
+        return b''.join(self.iter_file(name))
+
+    def iter_file(self, name):
+        """
+        Returns an iterator over the decompressed sectors of the given
+        member, which are only decompressed as they're iterated over so big
+        members are never held in memory whole. Raises KeyError if the
+        archive doesn't contain it.
+        """
+        block = self._find_block(name)
+        if block is None:
+            raise KeyError(name)
+
+        block_offset, compressed_size, file_size, flags = block
+        offset = self.offset + block_offset
+
+        if file_size == 0 or flags & FLAG_DELETE_MARKER:
+            return iter(())
+
+        key = 0
+        if flags & FLAG_ENCRYPTED:
+            key = hash_string(name.replace('/', '\\').split('\\')[-1],
+                              HASH_FILE_KEY)
+            if flags & FLAG_FIX_KEY:
+                key = ((key + block_offset) & MASK) ^ file_size
+
+        compressed = flags & (FLAG_COMPRESS | FLAG_IMPLODE)
+        self._check_limits(name, compressed_size if compressed else
+                           file_size, file_size)
+
+        if flags & FLAG_SINGLE_UNIT:
+            data = self.data[offset:offset + compressed_size]
+            if flags & FLAG_ENCRYPTED:
+                data = decrypt(data, key)
+            if compressed and compressed_size < file_size:
+                data = decompress(data, file_size, flags)
+            return iter((bytes(data[:file_size]),))
+
+        sector_count = (file_size + self.sector_size - 1) // self.sector_size
+
+        if compressed:
+            table_size = (sector_count + 1) * 4
+            table = self.data[offset:offset + table_size]
+            if len(table) < table_size:
+                raise ValueError("archive member " + name + " is truncated")
+            if flags & FLAG_ENCRYPTED:
+                table = decrypt(table, (key - 1) & MASK)
+            sector_offsets = struct.unpack('<%dI' % (sector_count + 1), table)
+        else:
+            sector_offsets = [min(i * self.sector_size, file_size)
+                              for i in range(sector_count + 1)]
+
+        return self._sectors(name, offset, sector_offsets, file_size, flags,
+                             key)
+
+    def _sectors(self, name, offset, sector_offsets, file_size, flags, key):
+        """Yields the decompressed sectors of a member, one at a time."""
+        compressed = flags & (FLAG_COMPRESS | FLAG_IMPLODE)
+        for i in range(len(sector_offsets) - 1):
+            expected_size = min(self.sector_size,
+                                file_size - i * self.sector_size)
+            data = self.data[offset + sector_offsets[i]:
+                             offset + sector_offsets[i + 1]]
+            if flags & FLAG_ENCRYPTED:
+                data = decrypt(data, (key + i) & MASK)
+            if compressed and len(data) < expected_size:
+                data = decompress(data, expected_size, flags)
+            if len(data) != expected_size:
+                raise ValueError("archive member " + name + " is corrupted")
+            yield bytes(data)
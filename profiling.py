@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Request profiling"""
+# The stage timings tell which stage of reading a pathologically slow map
+# takes the time, not where inside it. A sample of the uploads (and the ones
+# an admin asks for) are read under cProfile instead, in the process which
+# reads them, and the profile comes back marshalled with the response. The
+# profiles are kept in a directory shared by all workers on the node, one
+# per map under its SHA-256 hash, in the pstats file format next to a JSON
+# summary of the functions which took the most time. The oldest profiles
+# are removed once there are too many. Profiled maps are read without the
+# per-member cache, the profile shows all of their parsing.
+
+import cProfile
+import json
+import marshal
+import os
+import pstats
+import re
+import threading
+import time
+
+PSTATS_EXTENSION = '.pstats'
+SUMMARY_EXTENSION = '.json'
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+# whether the current thread runs a function under the profiler
+_LOCAL = threading.local()
+
+
+def active():
+    """Tells whether the current thread is being profiled by run()."""
+    return getattr(_LOCAL, 'active', False)
+
+
+def run(function, *args):
+    """
+    Runs function(*args) under the profiler. Returns its result, the seconds
+    it took and its profile marshalled in the pstats file format.
+    """
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    _LOCAL.active = True
+    profiler.enable()
+    try:
+        result = function(*args)
+    finally:
+        profiler.disable()
+        _LOCAL.active = False
+    seconds = time.perf_counter() - started
+
+    profiler.create_stats()
+    return result, seconds, marshal.dumps(profiler.stats)
+
+
+def top_functions(data, count):
+    """
+    Returns the count functions of the marshalled profile with the most
+    cumulative time, with their call counts and times in seconds.
+    """
+    stats = marshal.loads(data)
+    functions = sorted(stats.items(), key=lambda item: item[1][3],
+                       reverse=True)
+
+    top = []
+    for function, (primitive_calls, calls, total, cumulative, callers) in \
+            functions[:count]:
+        top.append({
+            "function": pstats.func_std_string(
+                pstats.func_strip_path(function)),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "total_seconds": round(total, 6),
+            "cumulative_seconds": round(cumulative, 6),
+        })
+    return top
+
+
+class ProfileStore(object):
+    """
+    Profiles stored in a directory shared by all workers on the node, the
+    oldest ones are removed once there are more than max_profiles (0 means
+    unbound). Summaries list the top_count functions with the most time.
+    """
+
+    def __init__(self, directory, max_profiles=0, top_count=30):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.top_count = top_count
+        self.lock = threading.Lock()
+        self.counters = {"saved": 0, "evictions": 0, "errors": 0}
+
+    def _path(self, digest, extension):
+        return os.path.join(self.directory, digest + extension)
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def _write(self, path, data):
+        temporary = path + '.' + str(os.getpid()) + '.' + \
+            str(threading.get_ident())
+        os.makedirs(self.directory, exist_ok=True)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        # readers never see a partly written file
+        os.replace(temporary, path)
+
+    def save(self, digest, file_name, seconds, data):
+        """
+        Stores the marshalled profile of reading the map with the given
+        SHA-256 hash, replacing an older profile of the same map.
+        """
+        summary = {
+            "sha256": digest,
+            "file_name": file_name,
+            "recorded": time.time(),
+            "seconds": round(seconds, 6),
+            "functions": top_functions(data, self.top_count),
+        }
+        try:
+            self._write(self._path(digest, PSTATS_EXTENSION), data)
+            # the summary is written last, profiles are listed by it
+            self._write(self._path(digest, SUMMARY_EXTENSION),
+                        json.dumps(summary, sort_keys=True).encode('utf-8'))
+        except OSError:
+            self._count("errors")
+            return
+
+        self._count("saved")
+        if self.max_profiles:
+            self._evict()
+
+    def _summary_files(self):
+        """Returns the (mtime, digest) pairs of the stored summaries."""
+        files = []
+        for entry in os.scandir(self.directory):
+            digest, extension = os.path.splitext(entry.name)
+            if extension == SUMMARY_EXTENSION and DIGEST.match(digest):
+                files.append((entry.stat().st_mtime, digest))
+        return files
+
+    def _evict(self):
+        """Removes the oldest profiles until at most max_profiles are left."""
+        try:
+            files = sorted(self._summary_files(), reverse=True)
+        except OSError:
+            self._count("errors")
+            return
+
+        evicted = 0
+        for mtime, digest in files[self.max_profiles:]:
+            try:
+                os.remove(self._path(digest, SUMMARY_EXTENSION))
+                os.remove(self._path(digest, PSTATS_EXTENSION))
+            except OSError:
+                continue
+            evicted += 1
+        self._count("evictions", evicted)
+
+    def summary(self, digest):
+        """
+        Returns the summary of the profile of the map with the given SHA-256
+        hash, or None if there's none.
+        """
+        if not DIGEST.match(digest):
+            return None
+        try:
+            with open(self._path(digest, SUMMARY_EXTENSION), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def summaries(self):
+        """
+        Returns the summaries of the stored profiles without their
+        functions, most recent first.
+        """
+        try:
+            files = sorted(self._summary_files(), reverse=True)
+        except FileNotFoundError:
+            return []
+        except OSError:
+            self._count("errors")
+            return []
+
+        summaries = []
+        for mtime, digest in files:
+            summary = self.summary(digest)
+            if summary is not None:
+                del summary["functions"]
+                summaries.append(summary)
+        return summaries
+
+    def pstats(self, digest):
+        """
+        Returns the pstats file of the profile of the map with the given
+        SHA-256 hash, or None if there's none.
+        """
+        if not DIGEST.match(digest):
+            return None
+        try:
+            with open(self._path(digest, PSTATS_EXTENSION), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def stats(self):
+        """Returns the saved, eviction and error counters."""
+        with self.lock:
+            return dict(self.counters)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Sandboxed map reading"""
+# A map crafted to take forever or to eat all the memory would stall the
+# server worker reading it and everybody else's requests with it. Maps are
+# read by a pool of long-lived worker processes instead, each of them with
+# an address space limit. A map gets a fixed time to be read, the worker
+# reading it is killed and replaced when it runs out of time or memory, the
+# other workers keep serving. Workers are forked from a forkserver which has
+# the modules they need imported already, never from the threaded server.
+
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import threading
+
+import metrics
+
+
+class SandboxError(Exception):
+    """Raised when a sandbox worker couldn't finish its job."""
+
+
+class Timeout(SandboxError):
+    """The job took longer than the pool's timeout."""
+
+
+class OutOfMemory(SandboxError):
+    """The job needed more memory than the worker may use."""
+
+
+class WorkerLost(SandboxError):
+    """The worker died during the job."""
+
+
+class Busy(SandboxError):
+    """No worker became free within the pool's wait."""
+
+
+def limit_memory(memory):
+    """Limits the address space of the current process to memory bytes."""
+    if memory:
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+
+
+def _serve(connection, memory):
+    """
+    The worker process: runs the jobs sent over the connection until it's
+    closed. A job is the function and its arguments followed by the bytes
+    passed as its first argument (as a memoryview). The function's result,
+    exception and stage timings are sent back.
+    """
+    limit_memory(memory)
+    # Ctrl+C reaches the whole process group, the pool stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        try:
+            function, args = connection.recv()
+            data = connection.recv_bytes()
+        except EOFError:
+            return
+
+        metrics.start_request()
+        try:
+            result = function(memoryview(data), *args)
+            error = None
+        except MemoryError:
+            # whatever was half done may be broken, start over
+            connection.send((None, OutOfMemory(), []))
+            return
+        except Exception as e:
+            result = None
+            error = e
+
+        del data
+        connection.send((result, error, metrics.finish_request()))
+
+
+class SandboxWorker(object):
+    """A worker process of the pool and its end of the connection."""
+
+    def __init__(self, context, memory):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve,
+                                       args=(child_connection, memory))
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def kill(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+
+
+class SandboxPool(object):
+    """
+    Pool of worker processes which run the jobs of the current process, up
+    to workers at the same time. A job gets timeout seconds and its worker
+    may use memory bytes of address space (0 means unbound), jobs wait at
+    most wait seconds (None means forever) for a free worker. The workers
+    are started lazily, forked processes get workers of their own.
+    """
+
+    def __init__(self, workers, timeout, memory=0, preload=(), wait=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory = memory
+        self.wait = wait
+        self.preload = list(preload)
+        self.lock = threading.Lock()
+        self.pid = None
+        self.idle = None
+        self.all = []
+        self.counters = {"jobs": 0, "timeouts": 0, "out_of_memory": 0,
+                         "lost": 0, "started": 0, "busy": 0}
+
+    def _check_process(self):
+        """Forked processes can't use the parent's workers."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.context = multiprocessing.get_context('forkserver')
+            self.context.set_forkserver_preload(self.preload)
+            self.idle = queue.Queue()
+            self.all = []
+            # a None slot starts a worker when it's taken
+            for i in range(self.workers):
+                self.idle.put(None)
+
+    def _start_worker(self):
+        with self.lock:
+            self.counters["started"] += 1
+        worker = SandboxWorker(self.context, self.memory)
+        with self.lock:
+            self.all.append(worker)
+        return worker
+
+    def _discard(self, worker, counter):
+        """Kills the worker and frees its slot for a new one."""
+        worker.kill()
+        with self.lock:
+            self.counters[counter] += 1
+            if worker in self.all:
+                self.all.remove(worker)
+        self.idle.put(None)
+
+    def start(self):
+        """Starts all the workers up front."""
+        with self.lock:
+            self._check_process()
+        slots = []
+        for i in range(self.workers):
+            worker = self.idle.get()
+            if worker is None:
+                worker = self._start_worker()
+            slots.append(worker)
+        for worker in slots:
+            self.idle.put(worker)
+
+    def run(self, function, data, *args):
+        """
+        Runs function(memoryview(data), *args) in a worker and returns its
+        result and the (stage, seconds) timings of the stages it ran.
+        Exceptions of the function are raised again, SandboxError if the
+        worker ran out of time or memory or died, Busy if no worker became
+        free in time.
+        """
+        with self.lock:
+            self._check_process()
+            self.counters["jobs"] += 1
+
+        try:
+            worker = self.idle.get(timeout=self.wait)
+        except queue.Empty:
+            with self.lock:
+                self.counters["busy"] += 1
+            raise Busy("all the map readers are busy")
+        if worker is None:
+            try:
+                worker = self._start_worker()
+            except BaseException:
+                self.idle.put(None)
+                raise
+
+        try:
+            worker.connection.send((function, args))
+            worker.connection.send_bytes(data)
+            if not worker.connection.poll(self.timeout):
+                raise Timeout("reading the map took longer than %d seconds" %
+                              self.timeout)
+            result, error, timings = worker.connection.recv()
+        except Timeout:
+            self._discard(worker, "timeouts")
+            raise
+        except (EOFError, OSError):
+            self._discard(worker, "lost")
+            raise WorkerLost("the map reader died")
+        except BaseException:
+            self._discard(worker, "lost")
+            raise
+
+        if isinstance(error, OutOfMemory):
+            self._discard(worker, "out_of_memory")
+            if not self.memory:
+                raise OutOfMemory("reading the map ran out of memory")
+            raise OutOfMemory("reading the map needs more than %d MB of "
+                              "memory" % (self.memory // (1024 * 1024)))
+        self.idle.put(worker)
+        if error is not None:
+            raise error
+        return result, timings
+
+    def close(self):
+        """Stops the workers of this process."""
+        with self.lock:
+            workers, self.all = self.all, []
+        for worker in workers:
+            worker.kill()
+
+    def stats(self):
+        """Returns the job and worker counters."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["workers"] = len(self.all)
+        return stats
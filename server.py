@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""Production server"""
+# Flask's development server reads one map at a time in a single process.
+# This server binds the listening socket and imports the application once,
+# then forks SERVER_WORKERS processes which share both. Every worker runs an
+# asyncio front end which receives the uploads of many clients at the same
+# time and only hands complete requests to SERVER_CONCURRENCY threads running
+# the application, so slow clients never hold up reading the maps and a
+# single container uses every core. Dead workers are replaced, SIGTERM and
+# SIGINT let the running requests finish before the workers exit.
+
+import asyncio
+import concurrent.futures
+import email.utils
+import http.client
+import io
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+import urllib.parse
+
+import config
+import main
+import upload
+import workspace
+
+from werkzeug.exceptions import HTTPException
+
+MAX_HEAD_SIZE = 64 * 1024
+READ_SIZE = 256 * 1024
+
+_END = object()  # marks the end of a response body
+
+
+class HTTPError(Exception):
+    """
+    Raised when a request can't be handled, carries the status code and for
+    the temporary errors the seconds after which the client may retry.
+    """
+
+    def __init__(self, status, retry_after=None):
+        Exception.__init__(self, status)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Shutdown(Exception):
+    """Raised in the master process when it's asked to stop."""
+
+
+def parse_head(head):
+    """
+    Returns the method, target, protocol version and the list of (name,
+    value) headers of the given request head.
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise HTTPError(400)
+    if not version.startswith('HTTP/1.'):
+        raise HTTPError(505)
+
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(':')
+        if not separator or not name or name != name.strip():
+            raise HTTPError(400)
+        headers.append((name, value.strip()))
+
+    return method, target, version, headers
+
+
+def spool(length):
+    """Returns the buffer for a request body of the given length."""
+    if length is not None and \
+       length > config.MEMORY_UPLOAD_THRESHOLD * 1024 * 1024:
+        try:
+            return main.upload_spool(length)
+        except workspace.WorkspaceFull:
+            raise HTTPError(503, config.WORKSPACE_RETRY_AFTER)
+
+    return io.BytesIO()
+
+
+class Worker(object):
+    """A worker process serving requests from the shared socket."""
+
+    def __init__(self, listener, application):
+        self.listener = listener
+        self.application = application
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            config.SERVER_CONCURRENCY)
+        self.max_size = application.config['MAX_CONTENT_LENGTH']
+        self.urls = application.url_map.bind('localhost')
+        self.idle = set()  # writers of the connections waiting for a request
+        self.active = 0
+        self.stopping = False
+
+    def run(self):
+        # the processes reading batches and jobs come from the forkserver,
+        # they inherit neither the listening socket, the event loop's signal
+        # handlers nor the locks of this process' threads
+        main.batch_pool()
+
+        # every request may hold two workspaces, its body and the map
+        if main.WORKSPACES is not None:
+            main.WORKSPACES.prepare(config.SERVER_CONCURRENCY * 2)
+        if main.SANDBOX is not None:
+            main.SANDBOX.start()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle, sock=self.listener, limit=MAX_HEAD_SIZE))
+
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.stop)
+
+        try:
+            self.loop.run_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+            self.loop.close()
+            main.BATCH_POOL.shutdown()
+            if main.WORKSPACES is not None:
+                main.WORKSPACES.close()
+            if main.SANDBOX is not None:
+                main.SANDBOX.close()
+
+    def stop(self):
+        """Stops accepting connections and exits once the requests are done."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.server.close()
+        for writer in list(self.idle):
+            writer.close()
+        asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        deadline = time.time() + config.SERVER_SHUTDOWN_TIMEOUT
+        while self.active and time.time() < deadline:
+            await asyncio.sleep(0.1)
+        self.loop.stop()
+
+    async def handle(self, reader, writer):
+        """Serves the requests of a single connection."""
+        try:
+            keep_alive = True
+            while keep_alive and not self.stopping:
+                self.idle.add(writer)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'),
+                        config.SERVER_KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError,
+                        ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    self.write_error(writer, 431)
+                    break
+                finally:
+                    self.idle.discard(writer)
+
+                self.active += 1
+                try:
+                    keep_alive = await self.serve(reader, writer, head)
+                except HTTPError as e:
+                    self.write_error(writer, e.status, e.retry_after)
+                    keep_alive = False
+                except asyncio.TimeoutError:
+                    self.write_error(writer, 408)
+                    keep_alive = False
+                finally:
+                    self.active -= 1
+
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the client went away
+        except Exception:
+            traceback.print_exc()  # the response can't be completed
+        finally:
+            writer.close()
+
+    async def serve(self, reader, writer, head):
+        """
+        Serves a single request, returns whether the connection can be
+        reused.
+        """
+        method, target, version, headers = parse_head(head)
+        fields = dict((name.lower(), value) for name, value in headers)
+
+        keep_alive = version == 'HTTP/1.1' and \
+            fields.get('connection', '').lower() != 'close'
+
+        checker = self.upload_checker(method, target, fields)
+        body, invalid_upload = await asyncio.wait_for(
+            self.read_body(reader, writer, fields, checker),
+            config.SERVER_READ_TIMEOUT)
+
+        environ = self.environ(method, target, version, headers, body,
+                               writer)
+        if invalid_upload is not None:
+            # the rest of the body is never read
+            environ['kraftver.invalid_upload'] = invalid_upload
+            keep_alive = False
+        future = self.loop.run_in_executor(self.executor, self.call, environ)
+        try:
+            status, response_headers, iterator, iterable = \
+                await asyncio.wait_for(asyncio.shield(future),
+                                       config.SERVER_REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            # the thread can't be interrupted, the body is released once it
+            # finishes on its own
+            future.add_done_callback(lambda future: self.release(future,
+                                                                 body))
+            raise HTTPError(504)
+        except Exception:
+            body.close()
+            traceback.print_exc()
+            raise HTTPError(500)
+
+        try:
+            keep_alive = await self.write_response(
+                writer, method, version, keep_alive, status,
+                response_headers, iterator)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            body.close()
+
+        if invalid_upload is not None:
+            await self.linger(reader, writer)
+
+        return keep_alive
+
+    def release(self, future, body):
+        """Releases the request and response of a timed out request."""
+        if not future.cancelled() and future.exception() is None:
+            iterable = future.result()[3]
+            if hasattr(iterable, 'close'):
+                iterable.close()
+        body.close()
+
+    def upload_checker(self, method, target, fields):
+        """
+        Returns the upload.MultipartChecker of a request to a view taking a
+        map, or None.
+        """
+        path = urllib.parse.unquote(target.partition('?')[0], 'latin-1')
+        try:
+            endpoint = self.urls.match(path, method)[0]
+        except HTTPException:
+            return None
+        if endpoint not in main.MAP_UPLOAD_ENDPOINTS:
+            return None
+
+        length = None
+        if 'chunked' not in fields.get('transfer-encoding', '').lower():
+            try:
+                length = int(fields['content-length'])
+            except (KeyError, ValueError):
+                pass  # read_body() rejects invalid lengths
+        return upload.MultipartChecker(fields.get('content-type', ''), 'map',
+                                       length)
+
+    async def read_body(self, reader, writer, fields, checker):
+        """
+        Receives the request body into a buffer. Returns it and, if the
+        checker found out the uploaded map isn't one, the upload.InvalidUpload
+        exception, the rest of the body is left unread then.
+        """
+        chunked = 'chunked' in fields.get('transfer-encoding', '').lower()
+        length = None
+        if not chunked and 'content-length' in fields:
+            try:
+                length = int(fields['content-length'])
+            except ValueError:
+                raise HTTPError(400)
+            if length < 0:
+                raise HTTPError(400)
+            if length > self.max_size:
+                raise HTTPError(413)
+
+        if fields.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        body = spool(length)
+        invalid_upload = None
+        try:
+            if chunked:
+                await self.read_chunked(reader, body, checker)
+            elif length:
+                remaining = length
+                while remaining:
+                    data = await reader.read(min(remaining, READ_SIZE))
+                    if not data:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    body.write(data)
+                    remaining -= len(data)
+                    if checker is not None:
+                        checker.feed(data)
+        except upload.InvalidUpload as e:
+            invalid_upload = e
+        except BaseException:
+            body.close()
+            raise
+
+        body.seek(0)
+        return body, invalid_upload
+
+    async def read_chunked(self, reader, body, checker):
+        """Receives a body sent with the chunked transfer coding."""
+        size = 0
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            try:
+                chunk_size = int(line.split(b';')[0], 16)
+            except ValueError:
+                raise HTTPError(400)
+            if chunk_size == 0:
+                break
+            size += chunk_size
+            if size > self.max_size:
+                raise HTTPError(413)
+            data = await reader.readexactly(chunk_size)
+            body.write(data)
+            if checker is not None:
+                checker.feed(data)
+            await reader.readexactly(2)
+
+        # skip the trailers
+        while await reader.readuntil(b'\r\n') != b'\r\n':
+            pass
+
+    async def linger(self, reader, writer):
+        """
+        Discards what the client still sends of a rejected upload for up to
+        SERVER_LINGER_TIMEOUT seconds after the response: closing a
+        connection with unread data resets it, the client could lose the
+        response.
+        """
+        await writer.drain()
+        if writer.can_write_eof():
+            writer.write_eof()
+        deadline = self.loop.time() + config.SERVER_LINGER_TIMEOUT
+        try:
+            while self.loop.time() < deadline:
+                if not await asyncio.wait_for(reader.read(READ_SIZE),
+                                              deadline - self.loop.time()):
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+
+    def environ(self, method, target, version, headers, body, writer):
+        """Returns the WSGI environment of a request."""
+        path, separator, query = target.partition('?')
+        server = writer.get_extra_info('sockname') or ('', 0)
+        peer = writer.get_extra_info('peername') or ('', 0)
+
+        body.seek(0, 2)
+        length = body.tell()
+        body.seek(0)
+
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': str(peer[0]),
+            'REMOTE_PORT': str(peer[1]),
+            'CONTENT_LENGTH': str(length),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+
+        for name, value in headers:
+            key = name.upper().replace('-', '_')
+            # the body is already received and decoded
+            if key in ('CONTENT_LENGTH', 'TRANSFER_ENCODING', 'EXPECT'):
+                continue
+            if key != 'CONTENT_TYPE':
+                key = 'HTTP_' + key
+            if key in environ:
+                environ[key] += ',' + value
+            else:
+                environ[key] = value
+
+        return environ
+
+    def call(self, environ):
+        """
+        Runs the application, in an executor thread. Returns the status, the
+        headers, an iterator over the body (with its first chunk already
+        produced) and the iterable to close once it's sent.
+        """
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = status
+            response['headers'] = headers
+
+        iterable = self.application(environ, start_response)
+        iterator = iter(iterable)
+        # streamed responses may call start_response with their first chunk
+        first = next(iterator, _END)
+        response['sent'] = True
+
+        def chunks():
+            if first is not _END:
+                yield first
+            for chunk in iterator:
+                yield chunk
+
+        return response['status'], response['headers'], chunks(), iterable
+
+    async def write_response(self, writer, method, version, keep_alive, status,
+                       headers, iterator):
+        """Sends the response, returns whether the connection can be reused."""
+        names = set(name.lower() for name, value in headers)
+        chunked = False
+        if 'content-length' not in names and method != 'HEAD':
+            if version == 'HTTP/1.1':
+                chunked = True
+                headers = headers + [('Transfer-Encoding', 'chunked')]
+            else:
+                keep_alive = False
+
+        if self.stopping:
+            keep_alive = False
+        if not keep_alive:
+            headers = headers + [('Connection', 'close')]
+
+        head = 'HTTP/1.1 ' + status + '\r\n' + \
+            'Date: ' + email.utils.formatdate(usegmt=True) + '\r\n' + \
+            ''.join(name + ': ' + value + '\r\n' for name, value in headers)
+        writer.write(head.encode('latin-1') + b'\r\n')
+
+        while True:
+            # the first chunk is ready, the next ones may take a while (the
+            # batch responses are streamed as the maps are read)
+            chunk = await self.loop.run_in_executor(
+                self.executor, next, iterator, _END)
+            if chunk is _END:
+                break
+            if method == 'HEAD' or not chunk:
+                continue
+            if chunked:
+                writer.write(('%x\r\n' % len(chunk)).encode('ascii') +
+                             chunk + b'\r\n')
+            else:
+                writer.write(chunk)
+            await writer.drain()
+
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+
+        return keep_alive
+
+    def write_error(self, writer, status, retry_after=None):
+        """
+        Sends a bare error response and lets the connection be closed, with
+        a Retry-After header if retry_after seconds are given.
+        """
+        reason = http.client.responses.get(status, '')
+        body = (str(status) + ' ' + reason + '\n').encode('latin-1')
+        retry_header = ''
+        if retry_after is not None:
+            retry_header = 'Retry-After: %d\r\n' % retry_after
+        writer.write(('HTTP/1.1 %d %s\r\n'
+                      'Content-Type: text/plain\r\n'
+                      'Content-Length: %d\r\n%s'
+                      'Connection: close\r\n\r\n' %
+                      (status, reason, len(body), retry_header))
+                     .encode('latin-1') + body)
+
+
+def listen(host, port):
+    """Returns the listening socket shared by the workers."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(config.SERVER_BACKLOG)
+    listener.setblocking(False)
+    return listener
+
+
+def spawn(listener):
+    """Forks a worker process and returns its pid."""
+    pid = os.fork()
+    if pid:
+        return pid
+
+    status = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        Worker(listener, main.KRAFTVER).run()
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def janitor():
+    """Removes the files left by crashed workers, reports how many."""
+    removed = workspace.janitor()
+    if removed:
+        sys.stderr.write("kraftver: janitor removed %d leftover files\n" %
+                         removed)
+
+
+def shutdown(signum, frame):
+    raise Shutdown()
+
+
+def serve():
+    """Runs the master process: forks the workers and replaces dead ones."""
+    listener = listen(config.HOST, config.PORT)
+    worker_count = config.SERVER_WORKERS or os.cpu_count()
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    workers = {}  # pid -> time it was started
+    try:
+        janitor()
+        next_janitor = time.time() + config.WORKSPACE_JANITOR_INTERVAL
+        for i in range(worker_count):
+            workers[spawn(listener)] = time.time()
+        sys.stderr.write("kraftver: serving on %s:%d with %d workers\n" %
+                         (config.HOST, config.PORT, worker_count))
+
+        while True:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                if time.time() >= next_janitor:
+                    janitor()
+                    next_janitor = time.time() + \
+                        config.WORKSPACE_JANITOR_INTERVAL
+                time.sleep(1)
+                continue
+            started = workers.pop(pid, None)
+            if started is None:
+                continue
+            sys.stderr.write("kraftver: worker %d exited with status %d\n" %
+                             (pid, status))
+            # don't fork in a tight loop when the workers die right away
+            if time.time() - started < 1:
+                time.sleep(1)
+            workers[spawn(listener)] = time.time()
+    except Shutdown:
+        pass
+
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in workers:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+
+if __name__ == "__main__":
+    serve()
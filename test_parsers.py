@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Parser tests"""
+# Known-good byte vectors for the map parsers, built by hand from the file
+# format descriptions instead of with mapgen.py, which shares its tables with
+# mpq.py. Run with python3 -m pytest.
+
+import struct
+
+import pytest
+
+import mpq
+import w3i
+import wts
+
+
+def test_explode_blast_reference():
+    # the example stream of Mark Adler's blast.c
+    assert mpq.explode(bytes.fromhex('00048224258f807f')) == \
+        b'AIAIAIAIAIAIA'
+
+
+def test_explode_truncated():
+    with pytest.raises(ValueError):
+        mpq.explode(bytes.fromhex('00048224'))
+
+
+def test_explode_limit():
+    with pytest.raises(ValueError):
+        mpq.explode(bytes.fromhex('00048224258f807f'), 4)
+
+
+def test_table_keys():
+    # the keys the hash and block tables are encrypted with, as every MPQ
+    # reader has them
+    assert mpq.hash_string('(hash table)', mpq.HASH_FILE_KEY) == 0xC3AF3770
+    assert mpq.hash_string('(block table)', mpq.HASH_FILE_KEY) == 0xEC83B3A3
+
+
+def test_hash_case_and_separators():
+    for hash_type in (mpq.HASH_TABLE_OFFSET, mpq.HASH_NAME_A,
+                      mpq.HASH_NAME_B, mpq.HASH_FILE_KEY):
+        assert mpq.hash_string('Units/war3map.doo', hash_type) == \
+            mpq.hash_string('UNITS\\WAR3MAP.DOO', hash_type)
+
+
+def test_hash_uppercases_ascii_only():
+    assert mpq.normalize_name('aé/ß.txt') == \
+        b'A\xc3\xa9\\\xc3\x9f.TXT'
+    # str.upper() would make these hash the same ('ß' to 'SS')
+    assert mpq.hash_string('é', mpq.HASH_NAME_A) != \
+        mpq.hash_string('É', mpq.HASH_NAME_A)
+    assert mpq.hash_string('ß', mpq.HASH_NAME_A) != \
+        mpq.hash_string('SS', mpq.HASH_NAME_A)
+    assert mpq.name_hashes('war3map.w3i') == \
+        mpq.name_hashes('WAR3MAP.W3I')
+
+
+def w3i_string(value):
+    return value + b'\x00'
+
+
+def w3i_file(version):
+    """
+    Returns a war3map.w3i of the given version with a single player and
+    force and no upgrades, tech or random tables.
+    """
+    data = struct.pack('<III', version, 12, 6059)
+    if version >= 27:
+        data += struct.pack('<IIII', 1, 31, 1, 12345)
+    data += b''.join(w3i_string(value) for value in (
+        b'Test Map', b'Author', b'Description', b'1-2'))
+    # camera bounds and their complements, playable area, flags, ground
+    data += struct.pack('<8f', -1.0, -2.0, 3.0, 4.0, -5.0, 6.0, 7.0, -8.0)
+    data += struct.pack('<4I', 1, 2, 3, 4)
+    data += struct.pack('<II', 96, 64)
+    data += b'\x04\x00\x00\x00' + b'L'
+
+    if version >= 25:
+        data += struct.pack('<i', -1) + w3i_string(b'')
+        data += b''.join(w3i_string(value) for value in (
+            b'Loading', b'Title', b'Subtitle'))
+        data += struct.pack('<I', 0) + w3i_string(b'')
+        data += b''.join(w3i_string(value) for value in (
+            b'Prologue', b'Prologue Title', b'Prologue Subtitle'))
+        data += struct.pack('<Ifff', 0, 3000.0, 5000.0, 0.5)
+        data += b'\x10\x20\x30\xff' + b'RAhr'
+        data += w3i_string(b'Default') + b'L' + b'\x40\x50\x60\xff'
+    else:
+        data += struct.pack('<i', 2)
+        data += b''.join(w3i_string(value) for value in (
+            b'Loading', b'Title', b'Subtitle'))
+        data += struct.pack('<i', 0)
+        data += b''.join(w3i_string(value) for value in (
+            b'Prologue', b'Prologue Title', b'Prologue Subtitle'))
+
+    if version >= 28:
+        data += struct.pack('<I', 1)  # Lua
+    if version >= 31:
+        data += struct.pack('<II', 3, 1)
+
+    data += struct.pack('<I', 1)
+    data += struct.pack('<IIII', 0, 2, 2, 1) + w3i_string(b'Player 1')
+    data += struct.pack('<ffII', 128.0, -256.0, 0, 0)
+    if version >= 31:
+        data += struct.pack('<II', 0, 0)
+
+    data += struct.pack('<I', 1)
+    data += struct.pack('<II', 0x07, 1) + w3i_string(b'Force 1')
+
+    data += struct.pack('<III', 0, 0, 0)  # upgrades, tech, unit tables
+    if version >= 25:
+        data += struct.pack('<I', 0)  # item tables
+    return data
+
+
+@pytest.mark.parametrize('version', w3i.SUPPORTED_VERSIONS)
+def test_w3i_versions(version):
+    info = w3i.parse(w3i_file(version))
+
+    assert info["version"] == version
+    assert info["map_version"] == 12
+    assert info["editor_version"] == 6059
+    assert info["game_version"] == \
+        ((1, 31, 1, 12345) if version >= 27 else None)
+    assert (info["name"], info["author"], info["recommended_players"]) == \
+        (b'Test Map', b'Author', b'1-2')
+    assert (info["playable_width"], info["playable_height"]) == (96, 64)
+    assert info["main_ground_type"] == b'L'
+    assert info["loading_screen"]["title"] == b'Title'
+    assert info["prologue"]["subtitle"] == b'Prologue Subtitle'
+    assert info["script_language"] == ("Lua" if version >= 28 else None)
+    assert info["supported_modes"] == (3 if version >= 31 else None)
+
+    player, = info["players"]
+    assert (player["type"], player["race"], player["name"]) == \
+        ("Computer", "Orc", b'Player 1')
+    assert player["fixed_start_position"]
+    assert (player["start_x"], player["start_y"]) == (128.0, -256.0)
+    force, = info["forces"]
+    assert force["allied"] and force["shared_vision"]
+    assert not force["shared_units"]
+    assert force["name"] == b'Force 1'
+
+    assert info["upgrades"] == []
+    assert info["tech"] == []
+    assert info["random_unit_tables"] == []
+    assert info["random_item_tables"] == ([] if version >= 25 else None)
+
+
+def test_w3i_truncated_header():
+    with pytest.raises(ValueError):
+        w3i.parse(w3i_file(25)[:20])
+
+
+def test_w3i_damaged_rest():
+    # everything after the main ground type is cut off
+    data = w3i_file(25)
+    info = w3i.parse(data[:data.index(b'\x04\x00\x00\x00L') + 5])
+    assert info["name"] == b'Test Map'
+    assert info["players"] is None
+
+
+def test_w3i_huge_position_count():
+    data = w3i_file(25)[:-8] + struct.pack('<I', 1) + \
+        struct.pack('<I', 0) + w3i_string(b'Table') + \
+        struct.pack('<I', 0x3FFFFFFF) + struct.pack('<I', 0)
+    info = w3i.parse(data)
+    assert info["tech"] == []
+    assert info["random_unit_tables"] is None
+
+
+def test_wts_bom_and_crlf():
+    table = wts.StringTable(
+        b'\xef\xbb\xbfSTRING 1\r\n{\r\nHello\r\nWorld\r\n}\r\n\r\n'
+        b'STRING 2\r\n// comment\r\n{\r\nSecond\r\n}\r\n\r\n'
+        b'STRING 1\r\n{\r\nDuplicate\r\n}\r\n')
+
+    assert table.get(1) == 'Hello\nWorld'
+    assert table['TRIGSTR_002'] == 'Second'
+    assert table['TRIGSTR_001'] == 'Hello\nWorld'
+    assert table.get(3) is None
+    with pytest.raises(KeyError):
+        table['TRIGSTR_003']
+    assert len(table) == 2
+
+
+def test_wts_closing_brace_inside_string():
+    table = wts.StringTable(b'STRING 7\n{\n}not the end\n}\n')
+    assert table.get(7) == '}not the end'
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""Map thumbnails"""
+# Maps carry their own pictures: war3mapPreview.tga is the preview shown in
+# the game's lobby and war3mapMap.blp is the minimap. Both are decoded into
+# RGBA arrays with NumPy (channel swaps, palette lookups and alpha planes are
+# done on whole arrays, never pixel by pixel) and resized and encoded into
+# PNG or WebP with Pillow. Both libraries are optional, without them there
+# are no thumbnails.
+
+import io
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# archive members holding the pictures, in the order they're tried
+SOURCES = (
+    ("preview", "war3mapPreview.tga"),
+    ("minimap", "war3mapMap.blp"),
+)
+
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+TGA_HEADER = struct.Struct('<BBB5sHHHHBB')
+BLP1_HEADER = struct.Struct('<4sIIIIII16I16I')
+
+TGA_TRUECOLOR = 2
+TGA_RLE_TRUECOLOR = 10
+
+BLP_JPEG = 0
+BLP_PALETTE = 1
+
+
+def available():
+    """Returns whether the libraries needed for thumbnails are installed."""
+    return numpy is not None and Image is not None
+
+
+def decode_tga(data):
+    """
+    Decodes an uncompressed or run length encoded true color TGA image into
+    a (height, width, 4) RGBA array. Raises ValueError if it can't.
+    """
+    data = bytes(data)
+    try:
+        (id_length, color_map_type, image_type, color_map, x_origin,
+         y_origin, width, height, bits, descriptor) = \
+            TGA_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("TGA image is truncated")
+
+    if image_type not in (TGA_TRUECOLOR, TGA_RLE_TRUECOLOR) or \
+       bits not in (24, 32):
+        raise ValueError("unsupported TGA image type %d (%d bits)" %
+                         (image_type, bits))
+
+    position = TGA_HEADER.size + id_length
+    if color_map_type:
+        # color map length and entry size, unused by true color images
+        entries, entry_bits = struct.unpack_from('<HB', color_map, 2)
+        position += entries * ((entry_bits + 7) // 8)
+
+    depth = bits // 8
+    size = width * height * depth
+    if image_type == TGA_RLE_TRUECOLOR:
+        pixels = _unpack_tga_rle(data, position, size, depth)
+    else:
+        pixels = data[position:position + size]
+    if len(pixels) < size:
+        raise ValueError("TGA image is truncated")
+
+    bgra = numpy.frombuffer(pixels, numpy.uint8, size).reshape(
+        height, width, depth)
+    rgba = numpy.empty((height, width, 4), numpy.uint8)
+    rgba[..., :3] = bgra[..., 2::-1]
+    if depth == 4 and descriptor & 0x0F:
+        rgba[..., 3] = bgra[..., 3]
+    else:
+        rgba[..., 3] = 255
+
+    # rows are stored bottom up unless the origin is in the top left corner
+    if not descriptor & 0x20:
+        rgba = rgba[::-1]
+
+    return rgba
+
+
+def _unpack_tga_rle(data, position, size, depth):
+    """
+    Expands the run length encoded TGA packets, a packet at a time. Where a
+    packet starts depends on the type and length of the one before it, so
+    the headers have to be walked in order anyway. Each step only slices
+    or repeats whole pixels as bytes, which is faster than expanding the
+    walked run lengths with numpy.repeat() and gathering the pixels.
+    """
+    chunks = []
+    length = 0
+    while length < size and position < len(data):
+        header = data[position]
+        count = (header & 0x7F) + 1
+        position += 1
+        if header & 0x80:
+            chunk = data[position:position + depth] * count
+            position += depth
+        else:
+            chunk = data[position:position + count * depth]
+            position += count * depth
+        chunks.append(chunk)
+        length += len(chunk)
+
+    return b''.join(chunks)[:size]
+
+
+def decode_blp(data):
+    """
+    Decodes the first mipmap of a BLP1 (JPEG or palette) image into a
+    (height, width, 4) RGBA array. Raises ValueError if it can't.
+    """
+    data = bytes(data)
+    try:
+        header = BLP1_HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("BLP image is truncated")
+
+    magic, content, alpha_bits, width, height = header[:5]
+    offset, size = header[7], header[23]
+    if magic != b'BLP1':
+        raise ValueError("unsupported BLP version " +
+                         repr(magic.decode('latin-1')))
+    if offset + size > len(data) or not width or not height:
+        raise ValueError("BLP image is truncated")
+
+    if content == BLP_JPEG:
+        return _decode_blp_jpeg(data, offset, size, alpha_bits, width,
+                                height)
+    if content == BLP_PALETTE:
+        return _decode_blp_palette(data, offset, alpha_bits, width, height)
+
+    raise ValueError("unsupported BLP content type %d" % content)
+
+
+def _decode_blp_jpeg(data, offset, size, alpha_bits, width, height):
+    """The mipmaps share a JPEG header, the channels are stored as BGRA."""
+    position = BLP1_HEADER.size
+    header_size = struct.unpack_from('<I', data, position)[0]
+    jpeg = data[position + 4:position + 4 + header_size] + \
+        data[offset:offset + size]
+
+    image = Image.open(io.BytesIO(jpeg))
+    if image.mode != "CMYK":
+        raise ValueError("unsupported BLP JPEG mode " + image.mode)
+    # the four channels are stored as they are, libjpeg mustn't convert
+    # them from YCCK
+    decoder, extents, tile_offset, arguments = image.tile[0]
+    image.tile = [(decoder, extents, tile_offset, (arguments[0], "CMYK"))]
+
+    bgra = numpy.asarray(image)[:height, :width]
+    rgba = bgra[..., [2, 1, 0, 3]].copy()
+    if not alpha_bits:
+        rgba[..., 3] = 255
+
+    return rgba
+
+
+def _decode_blp_palette(data, offset, alpha_bits, width, height):
+    """A 256 color BGRA palette, an index per pixel and an alpha plane."""
+    palette = numpy.frombuffer(data, numpy.uint8, 1024,
+                               BLP1_HEADER.size).reshape(256, 4)
+    count = width * height
+    alpha_size = (count * alpha_bits + 7) // 8
+    if offset + count + alpha_size > len(data):
+        raise ValueError("BLP image is truncated")
+
+    indexes = numpy.frombuffer(data, numpy.uint8, count, offset)
+    rgba = numpy.empty((count, 4), numpy.uint8)
+    rgba[:, :3] = palette[indexes][:, 2::-1]
+
+    alpha = numpy.frombuffer(data, numpy.uint8, alpha_size, offset + count)
+    if alpha_bits == 8:
+        rgba[:, 3] = alpha
+    elif alpha_bits == 4:
+        # two pixels a byte, the first one in the low nibble
+        nibbles = numpy.empty(alpha_size * 2, numpy.uint8)
+        nibbles[0::2] = alpha & 0x0F
+        nibbles[1::2] = alpha >> 4
+        rgba[:, 3] = nibbles[:count] * 17
+    elif alpha_bits == 1:
+        bits = numpy.unpackbits(alpha, bitorder='little')
+        rgba[:, 3] = bits[:count] * 255
+    else:
+        rgba[:, 3] = 255
+
+    return rgba.reshape(height, width, 4)
+
+
+def render(rgba, size, image_format):
+    """
+    Returns the RGBA array scaled to fit in a size x size square (keeping
+    its aspect ratio) and encoded in the given format ("png" or "webp").
+    """
+    image = Image.fromarray(numpy.ascontiguousarray(rgba))
+    image.thumbnail((size, size), Image.LANCZOS)
+    # fully opaque pictures don't need the alpha channel
+    if rgba[..., 3].min() == 255:
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, FORMATS[image_format][0])
+    return output.getvalue()
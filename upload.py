@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Upload checks"""
+# Maps are checked while they're still being received: the HM3W magic as soon
+# as the first bytes arrive, the 512 byte HM3W header, then the MPQ header
+# and its hash and block table offsets against the declared upload size once
+# UPLOAD_CHECK_SIZE bytes are in. Uploads which can't be maps are rejected
+# right away instead of after the whole (up to MAX_MAP_SIZE) body arrived.
+# Anything these checks let through is still fully validated by the parser.
+
+import config
+import mpq
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, \
+    NeedData
+
+HM3W_HEADER_SIZE = 512
+
+# bytes of the map name's terminator, flags and max players number
+HM3W_HEADER_TAIL_SIZE = 9
+
+
+class InvalidUpload(Exception):
+    """
+    Raised when an upload is known not to be a readable map before all of it
+    is received. Not a ValueError, Werkzeug's form parser silences those.
+    """
+
+    def __init__(self, error, file_name, received):
+        Exception.__init__(self, error)
+        self.error = error
+        self.file_name = file_name
+        self.received = received  # bytes of the map received so far
+
+
+class MapChecker(object):
+    """
+    Checks the beginning of a map as it's received. Only the first
+    UPLOAD_CHECK_SIZE bytes are kept, feed() raises InvalidUpload as soon as
+    they show the upload isn't a map.
+    """
+
+    def __init__(self, file_name, declared_size=None):
+        self.file_name = file_name
+        self.declared_size = declared_size  # an upper bound of the map size
+        self.head = bytearray()
+        self.received = 0
+        self.done = False
+
+    def feed(self, data):
+        self.received += len(data)
+        if self.done:
+            return
+
+        self.head += data[:config.UPLOAD_CHECK_SIZE * 1024 - len(self.head)]
+        if len(self.head) >= 4 and self.head[:4] != b'HM3W':
+            self.reject("invalid map file")
+
+        if len(self.head) >= HM3W_HEADER_SIZE:
+            try:
+                name_end = self.head.index(b'\x00', 8, HM3W_HEADER_SIZE)
+            except ValueError:
+                name_end = HM3W_HEADER_SIZE
+            if name_end + HM3W_HEADER_TAIL_SIZE > HM3W_HEADER_SIZE:
+                self.reject("can't process map file: map header is "
+                            "truncated")
+
+        if len(self.head) >= config.UPLOAD_CHECK_SIZE * 1024:
+            self.check_archive()
+            self.done = True
+            self.head = None
+
+    def check_archive(self):
+        """
+        Checks the MPQ header, if it's in the received part of the map (it
+        almost always follows the HM3W header).
+        """
+        try:
+            offset = mpq.find_header(self.head)
+        except ValueError:
+            return
+
+        (magic, header_size, archive_size, format_version, sector_size_shift,
+         hash_table_offset, block_table_offset, hash_table_entries,
+         block_table_entries) = mpq.HEADER.unpack_from(self.head, offset)
+
+        # tables running past the end of the map are cut short by the
+        # reader, tables starting past it are empty
+        if not hash_table_entries or (
+                self.declared_size is not None and
+                offset + hash_table_offset >= self.declared_size):
+            self.reject("can't process map file: MPQ archive has an empty "
+                        "hash table")
+        if not block_table_entries or (
+                self.declared_size is not None and
+                offset + block_table_offset >= self.declared_size):
+            self.reject("can't process map file: MPQ archive has an empty "
+                        "block table")
+
+    def reject(self, error):
+        self.done = True
+        self.head = None
+        raise InvalidUpload(error, self.file_name, self.received)
+
+
+class MultipartChecker(object):
+    """
+    Runs a MapChecker on the given file field of a multipart/form-data body
+    as the body is received, for servers which receive the whole body before
+    the application parses it.
+    """
+
+    def __init__(self, content_type, field_name, declared_size=None):
+        mimetype, options = parse_options_header(content_type)
+        self.done = mimetype != 'multipart/form-data' or \
+            'boundary' not in options
+        if not self.done:
+            self.decoder = MultipartDecoder(options['boundary'].encode(
+                'latin-1'))
+        self.field_name = field_name
+        self.declared_size = declared_size
+        self.checker = None
+
+    def feed(self, data):
+        if self.done:
+            return
+
+        try:
+            self.decoder.receive_data(data)
+            event = self.decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)) and \
+                    not self.done:
+                if isinstance(event, File) and \
+                   event.name == self.field_name and self.checker is None:
+                    self.checker = MapChecker(event.filename,
+                                              self.declared_size)
+                elif isinstance(event, Data) and self.checker is not None:
+                    self.checker.feed(event.data)
+                    self.done = self.checker.done or not event.more_data
+                event = self.decoder.next_event()
+        except ValueError:
+            # a malformed body is left to the application's form parser
+            self.done = True
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""war3map.w3e terrain parser"""
+# The w3e file holds the map's terrain: the ground and cliff tilesets used and
+# a grid of (width x height) tilepoints, 7 bytes each, with the ground height,
+# water level, flags, ground texture and cliff layer of every point. Big maps
+# have hundreds of thousands of tilepoints so the grid is viewed as a NumPy
+# structured array over the buffer and all the statistics are computed on
+# whole columns of it. NumPy is optional, without it only the header is read.
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HEADER = struct.Struct('<4sIcII')
+COUNT = struct.Struct('<I')
+GRID = struct.Struct('<IIff')
+
+if numpy is not None:
+    TILEPOINT = numpy.dtype([
+        ('height', '<i2'),  # ground height, 0x2000 is zero
+        ('water', '<u2'),  # water level plus the map edge flag (0x4000)
+        ('texture', 'u1'),  # flags in the high nibble, texture in the low
+        ('variation', 'u1'),
+        ('cliff', 'u1'),  # cliff tileset in the high nibble, layer in the low
+    ])
+
+# tilepoint flags
+RAMP = 0x10
+BLIGHT = 0x20
+WATER = 0x40
+BOUNDARY = 0x80
+
+# water levels are stored relative to this height
+WATER_OFFSET = -89.6
+
+
+def parse(data):
+    """
+    Parses the w3e file contents. Returns the tilesets, cliff tilesets, grid
+    size and offset and, when NumPy is available, the tilepoints as a
+    structured array over the data. Raises ValueError if the file is
+    truncated.
+    """
+    data = bytes(data)
+
+    try:
+        magic, version, tileset, custom_tilesets, tileset_count = \
+            HEADER.unpack_from(data)
+        position = HEADER.size
+        tilesets = [data[position + 4 * i:position + 4 * i + 4]
+                    .decode('latin-1') for i in range(tileset_count)]
+        position += 4 * tileset_count
+
+        cliff_tileset_count = COUNT.unpack_from(data, position)[0]
+        position += COUNT.size
+        cliff_tilesets = [data[position + 4 * i:position + 4 * i + 4]
+                          .decode('latin-1')
+                          for i in range(cliff_tileset_count)]
+        position += 4 * cliff_tileset_count
+
+        width, height, offset_x, offset_y = GRID.unpack_from(data, position)
+        position += GRID.size
+    except struct.error:
+        raise ValueError("war3map.w3e is truncated")
+
+    if len(tilesets) != tileset_count or \
+       len(cliff_tilesets) != cliff_tileset_count:
+        raise ValueError("war3map.w3e is truncated")
+
+    terrain = {
+        "version": version,
+        "tileset": tileset.decode('latin-1'),
+        "custom_tilesets": custom_tilesets == 1,
+        "tilesets": tilesets,
+        "cliff_tilesets": cliff_tilesets,
+        "width": width,
+        "height": height,
+        "offset_x": offset_x,
+        "offset_y": offset_y,
+        "tilepoints": None,
+    }
+
+    if numpy is not None:
+        count = width * height
+        if len(data) - position < count * TILEPOINT.itemsize:
+            raise ValueError("war3map.w3e is truncated")
+        terrain["tilepoints"] = numpy.frombuffer(
+            data, TILEPOINT, count, position).reshape(height, width)
+
+    return terrain
+
+
+def heights(tilepoints):
+    """Returns the final height of every tilepoint, in world units."""
+    layer = (tilepoints['cliff'] & 0x0F).astype(numpy.float32)
+    return (tilepoints['height'].astype(numpy.float32) - 0x2000) / 4 + \
+        (layer - 2) * 128
+
+
+def water_levels(tilepoints):
+    """Returns the water level of every tilepoint, in world units."""
+    water = (tilepoints['water'] & 0x3FFF).astype(numpy.float32)
+    return (water - 0x2000) / 4 + WATER_OFFSET
+
+
+def downsample(grid, size):
+    """
+    Returns the grid averaged down to at most size x size cells (smaller
+    grids are returned as they are).
+    """
+    rows, columns = grid.shape
+    row_starts = numpy.unique(numpy.linspace(0, rows, min(size, rows),
+                                             endpoint=False).astype(int))
+    column_starts = numpy.unique(numpy.linspace(0, columns,
+                                                min(size, columns),
+                                                endpoint=False).astype(int))
+
+    sums = numpy.add.reduceat(numpy.add.reduceat(grid, row_starts, axis=0),
+                              column_starts, axis=1)
+    row_sizes = numpy.diff(numpy.append(row_starts, rows))
+    column_sizes = numpy.diff(numpy.append(column_starts, columns))
+    return sums / numpy.outer(row_sizes, column_sizes)
+
+
+def statistics(terrain, heightmap_size):
+    """
+    Returns the tileset coverage, height and water statistics and a
+    heightmap downsampled to heightmap_size cells a side (rows start at the
+    southern edge) of the parsed terrain, or None without NumPy.
+    """
+    tilepoints = terrain["tilepoints"]
+    if tilepoints is None or not tilepoints.size:
+        return None
+
+    count = float(tilepoints.size)
+    flags = tilepoints['texture'] & 0xF0
+    textures = tilepoints['texture'] & 0x0F
+
+    # textures past the tileset list show up as the first tileset in game
+    texture_counts = numpy.bincount(textures.ravel(), minlength=16)
+    coverage = {}
+    for index, tileset in enumerate(terrain["tilesets"]):
+        points = int(texture_counts[index])
+        if index == 0:
+            points += int(texture_counts[len(terrain["tilesets"]):].sum())
+        if points:
+            coverage[tileset] = round(coverage.get(tileset, 0) +
+                                      points * 100 / count, 2)
+
+    point_heights = heights(tilepoints)
+    water = (flags & WATER) != 0
+    water_points = int(numpy.count_nonzero(water))
+    water_depths = (water_levels(tilepoints) - point_heights)[water]
+
+    return {
+        "tileset_coverage": coverage,
+        "height_min": round(float(point_heights.min()), 2),
+        "height_max": round(float(point_heights.max()), 2),
+        "height_mean": round(float(point_heights.mean()), 2),
+        "height_std": round(float(point_heights.std()), 2),
+        "water_coverage": round(water_points * 100 / count, 2),
+        "water_depth_mean": round(float(water_depths.mean()), 2)
+                            if water_points else None,
+        "water_depth_max": round(float(water_depths.max()), 2)
+                           if water_points else None,
+        "ramp_coverage": round(int(numpy.count_nonzero(flags & RAMP)) *
+                               100 / count, 2),
+        "blight_coverage": round(int(numpy.count_nonzero(flags & BLIGHT)) *
+                                 100 / count, 2),
+        "heightmap": numpy.round(downsample(point_heights, heightmap_size),
+                                 1).tolist(),
+    }
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""war3campaign.w3f parser"""
+# The w3f file holds a campaign's info: name, author, description, the
+# campaign screen's background, sound and fog, and the maps the campaign
+# is made of with the paths of their archive members. Strings are returned
+# as raw bytes, like the w3i parser's, they're often TRIGSTR_xxx references
+# into war3campaign.wts.
+
+import struct
+
+# format version 1 is shared by Reign of Chaos and The Frozen Throne
+SUPPORTED_VERSIONS = (1,)
+
+INT = struct.Struct('<I')
+SIGNED_INT = struct.Struct('<i')
+VERSIONS = struct.Struct('<III')
+FOG = struct.Struct('<Ifff4s')
+
+CURSOR_RACES = {0: "Human", 1: "Orc", 2: "Undead", 3: "Night Elf"}
+
+
+class _Reader(object):
+    """Cursor over the w3f buffer."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def unpack(self, structure):
+        values = structure.unpack_from(self.data, self.position)
+        self.position += structure.size
+        return values
+
+    def int(self):
+        value = INT.unpack_from(self.data, self.position)[0]
+        self.position += 4
+        return value
+
+    def string(self):
+        """Returns the NUL terminated string at the cursor as bytes."""
+        end = self.data.index(b'\x00', self.position)
+        value = self.data[self.position:end]
+        self.position = end + 1
+        return value
+
+    def strings(self, count):
+        return [self.string() for i in range(count)]
+
+
+def parse(data):
+    """
+    Parses the w3f file contents. Raises ValueError if it's truncated or of
+    an unsupported version.
+    """
+    data = bytes(data)
+    reader = _Reader(data)
+    info = {}
+
+    try:
+        info["version"], info["campaign_version"], info["editor_version"] = \
+            reader.unpack(VERSIONS)
+    except struct.error:
+        raise ValueError("war3campaign.w3f is truncated")
+    if info["version"] not in SUPPORTED_VERSIONS:
+        raise ValueError("unsupported war3campaign.w3f version %d" %
+                         info["version"])
+
+    try:
+        (info["name"], info["difficulty"], info["author"],
+         info["description"]) = reader.strings(4)
+
+        # bit 0 variable difficulty, bit 1 expansion (w3x) maps
+        flags = reader.int()
+        info["variable_difficulty"] = bool(flags & 0x01)
+        info["expansion"] = bool(flags & 0x02)
+
+        info["background"] = reader.unpack(SIGNED_INT)[0]
+        info["background_path"] = reader.string()
+        info["minimap_path"] = reader.string()
+        info["sound"] = reader.unpack(SIGNED_INT)[0]
+        info["sound_path"] = reader.string()
+
+        style, start_z, end_z, density, color = reader.unpack(FOG)
+        info["fog"] = None
+        if style:
+            info["fog"] = {"style": style, "start_z": start_z,
+                           "end_z": end_z, "density": density,
+                           "color": tuple(bytearray(color))}
+
+        race = reader.int()
+        info["cursor_race"] = CURSOR_RACES.get(race, str(race))
+
+        maps = []
+        for i in range(reader.int()):
+            visible = reader.int()
+            chapter, title, path = reader.strings(3)
+            maps.append({"visible": visible == 1, "chapter": chapter,
+                         "title": title, "path": path})
+        info["maps"] = maps
+
+        order = []
+        for i in range(reader.int()):
+            unknown, path = reader.strings(2)
+            order.append(path)
+        info["order"] = order
+    except (struct.error, ValueError):
+        raise ValueError("war3campaign.w3f is truncated")
+
+    return info
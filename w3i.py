@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""war3map.w3i parser"""
+# The w3i file holds the map's info: name, author, camera bounds, players,
+# forces, available upgrades and tech and so on. It's decoded in a single pass
+# over the buffer with precompiled structs, strings are located with
+# bytes.index() and returned as raw bytes so the caller decides how to decode
+# them (they're often TRIGSTR_xxx references into war3map.wts).
+
+import struct
+
+# format versions: 18 Reign of Chaos, 25 The Frozen Throne, 27/28 1.31
+# (game version and script language added), 31 1.32 (Reforged)
+SUPPORTED_VERSIONS = (18, 25, 27, 28, 31)
+
+INT = struct.Struct('<I')
+SIGNED_INT = struct.Struct('<i')
+VERSIONS = struct.Struct('<III')
+GAME_VERSION = struct.Struct('<IIII')
+CAMERA = struct.Struct('<8f4I2I4sc')
+FOG = struct.Struct('<Ifff4sI')
+LIGHT_AND_WATER = struct.Struct('<c4s')
+MODES = struct.Struct('<II')
+PLAYER = struct.Struct('<IIII')
+PLAYER_POSITION = struct.Struct('<ffII')
+PLAYER_ENEMIES = struct.Struct('<II')
+FORCE = struct.Struct('<II')
+UPGRADE = struct.Struct('<I4sII')
+TECH = struct.Struct('<I4s')
+RANDOM_TABLE_LINE = struct.Struct('<I4s')
+
+PLAYER_TYPES = {1: "Human", 2: "Computer", 3: "Neutral", 4: "Rescuable"}
+PLAYER_RACES = {0: "Selectable", 1: "Human", 2: "Orc", 3: "Undead",
+                4: "Night Elf"}
+UPGRADE_AVAILABILITY = {0: "Unavailable", 1: "Available", 2: "Researched"}
+
+
+class _Reader(object):
+    """Cursor over the w3i buffer."""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def unpack(self, structure):
+        values = structure.unpack_from(self.data, self.position)
+        self.position += structure.size
+        return values
+
+    def check(self, size):
+        """Raises ValueError unless size more bytes follow the cursor."""
+        if size > len(self.data) - self.position:
+            raise ValueError("war3map.w3i is truncated")
+
+    def int(self):
+        value = INT.unpack_from(self.data, self.position)[0]
+        self.position += 4
+        return value
+
+    def string(self):
+        """Returns the NUL terminated string at the cursor as bytes."""
+        end = self.data.index(b'\x00', self.position)
+        value = self.data[self.position:end]
+        self.position = end + 1
+        return value
+
+    def strings(self, count):
+        return [self.string() for i in range(count)]
+
+
+def bit_string(flag_bytes):
+    """
+    Returns the given bytes as a string of ones and zeros, most significant
+    bit of each byte first.
+    """
+    return ''.join(format(byte, '08b') for byte in bytearray(flag_bytes))
+
+
+def parse(data):
+    """
+    Parses the w3i file contents. Raises ValueError if the fixed part of the
+    file (everything up to the main ground type) can't be read. The rest of
+    the file (players, forces, upgrades, tech...) is decoded as well but if
+    it's damaged, as it is in some protected maps, those keys are None.
+    """
+    data = bytes(data)
+    reader = _Reader(data)
+    info = {}
+
+    try:
+        info["version"], info["map_version"], info["editor_version"] = \
+            reader.unpack(VERSIONS)
+        version = info["version"]
+
+        info["game_version"] = None
+        if version >= 27 and version in SUPPORTED_VERSIONS:
+            info["game_version"] = reader.unpack(GAME_VERSION)
+
+        (info["name"], info["author"], info["description"],
+         info["recommended_players"]) = reader.strings(4)
+
+        camera = reader.unpack(CAMERA)
+    except (struct.error, ValueError):
+        raise ValueError("war3map.w3i is truncated")
+
+    info["camera_bounds"] = camera[:8]
+    info["camera_bounds_complements"] = camera[8:12]
+    info["playable_width"], info["playable_height"] = camera[12:14]
+    info["flags"] = camera[14]
+    info["main_ground_type"] = camera[15]
+
+    for key in ("loading_screen", "prologue", "fog", "weather_id",
+                "sound_environment", "light_environment", "water_color",
+                "script_language", "supported_modes", "game_data_version",
+                "players", "forces", "upgrades", "tech",
+                "random_unit_tables", "random_item_tables"):
+        info[key] = None
+
+    if version not in SUPPORTED_VERSIONS:
+        return info
+
+    try:
+        _parse_rest(reader, info, version)
+    except (struct.error, ValueError, IndexError):
+        pass  # keep whatever we managed to read
+
+    return info
+
+
+def _parse_rest(reader, info, version):
+    """Parses everything after the main ground type."""
+    # in 18 the background is the campaign background, in 25+ it's the
+    # loading screen background which can also be a custom model
+    loading_screen = {"background": reader.unpack(SIGNED_INT)[0],
+                      "model": reader.string() if version >= 25 else None}
+    (loading_screen["text"], loading_screen["title"],
+     loading_screen["subtitle"]) = reader.strings(3)
+
+    prologue = {}
+    if version >= 25:
+        loading_screen["game_data_set"] = reader.int()
+        prologue["model"] = reader.string()
+    else:
+        loading_screen["number"] = reader.unpack(SIGNED_INT)[0]
+        prologue["model"] = None
+    prologue["text"], prologue["title"], prologue["subtitle"] = \
+        reader.strings(3)
+
+    info["loading_screen"] = loading_screen
+    info["prologue"] = prologue
+
+    if version >= 25:
+        style, start_z, end_z, density, color, weather_id = reader.unpack(FOG)
+        info["fog"] = {"style": style, "start_z": start_z, "end_z": end_z,
+                       "density": density, "color": tuple(bytearray(color))}
+        info["weather_id"] = weather_id
+        info["sound_environment"] = reader.string()
+        light_environment, water_color = reader.unpack(LIGHT_AND_WATER)
+        info["light_environment"] = light_environment
+        info["water_color"] = tuple(bytearray(water_color))
+
+    if version >= 28:
+        info["script_language"] = "Lua" if reader.int() == 1 else "JASS"
+
+    if version >= 31:
+        info["supported_modes"], info["game_data_version"] = \
+            reader.unpack(MODES)
+
+    players = []
+    for i in range(reader.int()):
+        number, player_type, race, fixed_start = reader.unpack(PLAYER)
+        name = reader.string()
+        start_x, start_y, ally_low, ally_high = \
+            reader.unpack(PLAYER_POSITION)
+        player = {
+            "number": number,
+            "type": PLAYER_TYPES.get(player_type, str(player_type)),
+            "race": PLAYER_RACES.get(race, str(race)),
+            "fixed_start_position": fixed_start == 1,
+            "name": name,
+            "start_x": start_x,
+            "start_y": start_y,
+            "ally_low_priorities": ally_low,
+            "ally_high_priorities": ally_high,
+        }
+        if version >= 31:
+            player["enemy_low_priorities"], \
+                player["enemy_high_priorities"] = \
+                reader.unpack(PLAYER_ENEMIES)
+        players.append(player)
+    info["players"] = players
+
+    forces = []
+    for i in range(reader.int()):
+        flags, player_mask = reader.unpack(FORCE)
+        forces.append({
+            "flags": flags,
+            "allied": bool(flags & 0x01),
+            "allied_victory": bool(flags & 0x02),
+            "shared_vision": bool(flags & 0x04),
+            "shared_units": bool(flags & 0x10),
+            "shared_advanced_units": bool(flags & 0x20),
+            "player_mask": player_mask,
+            "name": reader.string(),
+        })
+    info["forces"] = forces
+
+    upgrades = []
+    for i in range(reader.int()):
+        player_mask, upgrade_id, level, availability = reader.unpack(UPGRADE)
+        upgrades.append({
+            "player_mask": player_mask,
+            "id": upgrade_id.decode('latin-1'),
+            "level": level,
+            "availability": UPGRADE_AVAILABILITY.get(availability,
+                                                     str(availability)),
+        })
+    info["upgrades"] = upgrades
+
+    tech = []
+    for i in range(reader.int()):
+        player_mask, tech_id = reader.unpack(TECH)
+        tech.append({"player_mask": player_mask,
+                     "id": tech_id.decode('latin-1')})
+    info["tech"] = tech
+
+    random_unit_tables = []
+    for i in range(reader.int()):
+        number = reader.int()
+        name = reader.string()
+        position_count = reader.int()
+        # the count sizes the structs below, it can't be more than the data
+        reader.check(4 * position_count)
+        position_types = struct.unpack_from('<%dI' % position_count,
+                                            reader.data, reader.position)
+        reader.position += 4 * position_count
+        line_struct = struct.Struct('<I' + '4s' * position_count)
+        lines = []
+        for j in range(reader.int()):
+            line = reader.unpack(line_struct)
+            lines.append({"chance": line[0],
+                          "ids": [unit_id.decode('latin-1')
+                                  for unit_id in line[1:]]})
+        random_unit_tables.append({"number": number, "name": name,
+                                   "position_types": list(position_types),
+                                   "lines": lines})
+    info["random_unit_tables"] = random_unit_tables
+
+    if version >= 25:
+        random_item_tables = []
+        for i in range(reader.int()):
+            number = reader.int()
+            name = reader.string()
+            item_sets = []
+            for j in range(reader.int()):
+                items = []
+                for k in range(reader.int()):
+                    chance, item_id = reader.unpack(RANDOM_TABLE_LINE)
+                    items.append({"chance": chance,
+                                  "id": item_id.decode('latin-1')})
+                item_sets.append(items)
+            random_item_tables.append({"number": number, "name": name,
+                                       "item_sets": item_sets})
+        info["random_item_tables"] = random_item_tables
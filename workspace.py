@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Upload workspaces"""
+# Uploads too big for a bytes buffer are received into workspace files in
+# WORKSPACE_DIR, a tmpfs by default so they never touch a disk. Every worker
+# keeps its files open and reuses them, emptying them between requests
+# instead of creating and removing files. A workspace's file is extended to
+# the upload's size when it's handed out, so the total size of the files is
+# what all the workers on the node have reserved and is kept under a quota,
+# the workers check and extend them one at a time under a lock file.
+# What crashed workers leave behind is removed by janitor(), which the
+# server runs at startup and every WORKSPACE_JANITOR_INTERVAL seconds.
+
+import fcntl
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+
+import config
+
+# held by the worker checking the quota and reserving a workspace
+LOCK_NAME = 'kraftver.lock'
+
+# workspace files are named after the worker's pid, entries of older
+# versions (kraftver-<uuid> directories) have no pid
+WORKSPACE_NAME = re.compile(r'^kraftver-(?:(\d+)-\d+$)?')
+
+# temporary files of cache.FileCache.put() and profiling.ProfileStore.save(),
+# <name>.<pid>.<thread id>
+TEMPORARY_NAME = re.compile(r'\.(\d+)\.\d+$')
+
+
+class WorkspaceFull(Exception):
+    """Raised when an upload would take the workspaces past their quota."""
+
+
+class Workspace(object):
+    """
+    Write-once upload container backed by a workspace file. Writes go through
+    the file descriptor (a full tmpfs is an OSError, not a SIGBUS), the
+    complete upload is mapped read-only.
+    """
+
+    def __init__(self, pool, fd, path):
+        self.pool = pool
+        self.fd = fd
+        self.path = path
+        self.size = 0
+        self.position = 0
+        self.mapping = None
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            written = os.pwrite(self.fd, view, self.position)
+            view = view[written:]
+            self.position += written
+        self.size = max(self.size, self.position)
+        return len(data)
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self.position
+        elif whence == 2:
+            position += self.size
+        if position < 0:
+            raise OSError("seek out of range")
+        self.position = position
+        return position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        data = os.pread(self.fd, max(size, 0), self.position)
+        self.position += len(data)
+        return data
+
+    def getbuffer(self):
+        """Returns a memoryview over the written part of the workspace."""
+        if not self.size:
+            return memoryview(b'')
+        if self.mapping is None:
+            self.mapping = mmap.mmap(self.fd, self.size,
+                                     access=mmap.ACCESS_READ)
+        return memoryview(self.mapping)
+
+    def close(self):
+        if self.fd is None:
+            return
+
+        reusable = True
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # a view is still alive, the file can't be emptied under it
+                reusable = False
+        self.pool.release(self.fd, self.path, reusable)
+        self.fd = None
+
+
+class WorkspacePool(object):
+    """
+    The workspace files of a worker process in the given directory, all the
+    workers' files together are kept under quota bytes (0 means unbound).
+    """
+
+    def __init__(self, directory, quota=0):
+        self.directory = directory
+        self.quota = quota
+        self.lock = threading.Lock()
+        self.pid = None
+        self.free = []
+        self.created = 0
+        self.lock_fd = None
+        self.counters = {"acquired": 0, "rejected": 0, "discarded": 0}
+
+    def _check_process(self):
+        """Forked workers start over with files of their own."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.free = []
+            self.created = 0
+            # flock() locks are shared with the parent's descriptor
+            self.lock_fd = None
+
+    def _create(self):
+        self.created += 1
+        path = os.path.join(self.directory, 'kraftver-%d-%d' %
+                            (self.pid, self.created))
+        # a file with the same name belongs to a dead process with our pid
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        return fd, path
+
+    def prepare(self, count):
+        """Creates the worker's files up front."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self._check_process()
+            while len(self.free) < count:
+                self.free.append(self._create())
+
+    def usage(self):
+        """Returns the bytes reserved by the workspaces of all workers."""
+        total = 0
+        for entry in os.scandir(self.directory):
+            if WORKSPACE_NAME.match(entry.name) and \
+               entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+        return total
+
+    def _lock_file(self):
+        """Returns the descriptor of this worker's lock file."""
+        if self.lock_fd is None:
+            self.lock_fd = os.open(os.path.join(self.directory, LOCK_NAME),
+                                   os.O_RDWR | os.O_CREAT, 0o600)
+        return self.lock_fd
+
+    def acquire(self, capacity):
+        """
+        Returns a workspace for an upload of up to capacity bytes. Raises
+        WorkspaceFull if it doesn't fit in the quota.
+        """
+        with self.lock:
+            self._check_process()
+            os.makedirs(self.directory, exist_ok=True)
+            if self.free:
+                fd, path = self.free.pop()
+            else:
+                fd, path = self._create()
+
+            # no other worker looks at the usage until the reservation shows
+            # up in it, the pages are only allocated as the upload is written
+            lock_fd = self._lock_file() if self.quota else None
+            if lock_fd is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                if self.quota and self.usage() + capacity > self.quota:
+                    self.counters["rejected"] += 1
+                    self.free.append((fd, path))
+                    raise WorkspaceFull()
+                os.ftruncate(fd, capacity)
+            except OSError:
+                self.free.append((fd, path))
+                raise
+            finally:
+                if lock_fd is not None:
+                    fcntl.flock(lock_fd, fcntl.LOCK_UN)
+            self.counters["acquired"] += 1
+
+        return Workspace(self, fd, path)
+
+    def release(self, fd, path, reusable):
+        """Empties a workspace's file and keeps it for the next upload."""
+        if reusable:
+            try:
+                os.ftruncate(fd, 0)
+            except OSError:
+                reusable = False
+        if not reusable:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.close(fd)
+            with self.lock:
+                self.counters["discarded"] += 1
+            return
+
+        with self.lock:
+            self.free.append((fd, path))
+
+    def close(self):
+        """Removes the worker's idle files, when it exits."""
+        with self.lock:
+            free, self.free = self.free, []
+            if self.lock_fd is not None and self.pid == os.getpid():
+                os.close(self.lock_fd)
+            self.lock_fd = None
+        for fd, path in free:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.close(fd)
+
+    def stats(self):
+        """Returns the workspace counters and this worker's idle files."""
+        with self.lock:
+            stats = dict(self.counters)
+            stats["idle"] = len(self.free)
+        return stats
+
+
+def alive(pid):
+    """Returns whether a process with the given pid exists."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def reclaim(directory, pattern, ttl):
+    """
+    Removes the entries of the given directory whose name matches the
+    pattern and whose process, the pid in the pattern's first group, is no
+    longer running. Entries without a pid are removed once they're older
+    than ttl seconds. Returns how many were removed.
+    """
+    removed = 0
+    deadline = time.time() - ttl
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0
+
+    for entry in entries:
+        match = pattern.search(entry.name)
+        if match is None:
+            continue
+        if match.group(1) is not None and alive(int(match.group(1))):
+            continue
+        try:
+            if match.group(1) is None and \
+               entry.stat(follow_symlinks=False).st_mtime > deadline:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            continue
+        removed += 1
+
+    return removed
+
+
+def janitor():
+    """
+    Removes what crashed processes left behind: workspace files and the
+    temporary files of the thumbnail cache and the profiles. Returns how
+    many were removed.
+    """
+    removed = 0
+    if config.WORKSPACE_DIR is not None:
+        removed += reclaim(config.WORKSPACE_DIR, WORKSPACE_NAME,
+                           config.WORKSPACE_TTL)
+    if config.THUMBNAIL_CACHE_DIR is not None:
+        removed += reclaim(config.THUMBNAIL_CACHE_DIR, TEMPORARY_NAME,
+                           config.WORKSPACE_TTL)
+    if config.PROFILE_DIR is not None:
+        removed += reclaim(config.PROFILE_DIR, TEMPORARY_NAME,
+                           config.WORKSPACE_TTL)
+    return removed
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""war3map.wtg trigger file parser"""
+# The wtg file holds the World Editor's trigger tree: the trigger categories,
+# the global variables and then the triggers with their events, conditions
+# and actions. The functions of those have a number of parameters only the
+# editor's TriggerData.txt knows, so only the header is parsed: the
+# categories, the variables and the number of triggers which follows them.
+# The file is read a chunk at a time and only up to the trigger count, only
+# the counts are kept.
+
+import struct
+
+# format versions: 4 Reign of Chaos, 7 The Frozen Throne
+SUPPORTED_VERSIONS = (4, 7)
+
+HEADER = struct.Struct('<4sII')
+INT = struct.Struct('<I')
+VARIABLE = struct.Struct('<II')
+
+# names and initial values are never this long
+MAX_STRING = 64 * 1024
+
+
+class _Reader(object):
+    """
+    Cursor over the chunks of the wtg file, only the bytes which weren't
+    read yet are kept.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.position = 0
+
+    def _fill(self, size):
+        """Reads chunks until size bytes past the cursor are buffered."""
+        while len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise ValueError("war3map.wtg is truncated")
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+
+    def unpack(self, structure):
+        self._fill(structure.size)
+        values = structure.unpack_from(self.buffer, self.position)
+        self.position += structure.size
+        return values
+
+    def int(self):
+        return self.unpack(INT)[0]
+
+    def skip(self, size):
+        self._fill(size)
+        self.position += size
+
+    def string(self):
+        """Skips the NUL terminated string at the cursor."""
+        while True:
+            end = self.buffer.find(b'\x00', self.position)
+            if end >= 0:
+                break
+            if len(self.buffer) - self.position > MAX_STRING:
+                raise ValueError("war3map.wtg has an overlong string")
+            self._fill(len(self.buffer) - self.position + 1)
+        self.position = end + 1
+
+
+def parse(chunks):
+    """
+    Parses the header of the wtg file made of the given chunks of bytes.
+    Returns its version and the number of trigger categories, comment
+    categories, variables, array variables and triggers. Raises ValueError
+    if the file is truncated or of an unsupported version.
+    """
+    reader = _Reader(chunks)
+    magic, version, category_count = reader.unpack(HEADER)
+    if magic != b'WTG!':
+        raise ValueError("war3map.wtg isn't a trigger file")
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError("unsupported war3map.wtg version %d" % version)
+
+    comment_categories = 0
+    for i in range(category_count):
+        reader.skip(INT.size)  # category id
+        reader.string()  # name
+        if version == 7 and reader.int():
+            comment_categories += 1
+
+    reader.skip(INT.size)  # unknown, always 2
+    variable_count = reader.int()
+    array_variables = 0
+    for i in range(variable_count):
+        reader.string()  # name
+        reader.string()  # type
+        unknown, is_array = reader.unpack(VARIABLE)
+        if version == 7:
+            reader.skip(INT.size)  # array size
+        reader.skip(INT.size)  # initialized
+        reader.string()  # initial value
+        if is_array:
+            array_variables += 1
+
+    return {
+        "version": version,
+        "categories": category_count,
+        "comment_categories": comment_categories,
+        "variables": variable_count,
+        "array_variables": array_variables,
+        "triggers": reader.int(),
+    }
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""war3map.wts string table"""
+# The strings file holds every string of the map as blocks of
+#
+#   STRING 12
+#   // optional comment
+#   {
+#   the string, possibly spanning multiple lines
+#   }
+#
+# and the w3i file refers to them as TRIGSTR_012. Localized maps carry tens of
+# megabytes of strings while we need a handful of them (which are usually the
+# first ones), so the file is indexed incrementally: it's scanned for block
+# boundaries only until the asked for string is found, and only the strings
+# which are asked for are decoded.
+
+UTF8_BOM = b'\xef\xbb\xbf'
+
+
+class StringTable(object):
+    """
+    Lazily indexed and decoded string table. Look strings up by number with
+    get() or by reference (table['TRIGSTR_012']) like a dictionary. When a
+    number is used by more than one block the first one wins.
+    """
+
+    def __init__(self, data):
+        data = bytes(data)
+        if data.startswith(UTF8_BOM):
+            data = data[len(UTF8_BOM):]
+        self.data = data
+
+        self.spans = {}  # string number -> (body start, body end)
+        self.position = 0  # where the scan for the next block continues
+
+    def _next_block(self):
+        """
+        Indexes the next block and returns its number, or None once the end
+        of the file is reached.
+        """
+        data = self.data
+        length = len(data)
+
+        while self.position < length:
+            header = data.find(b'STRING', self.position)
+            line_end = data.find(b'\n', header)
+            if header < 0 or line_end < 0:
+                break
+            position = line_end + 1
+            self.position = position
+
+            try:
+                number = int(data[header + 6:line_end].split()[0])
+            except (ValueError, IndexError):
+                continue
+
+            # skip the comment lines, the next line has to open the string
+            while data.startswith(b'//', position):
+                line_end = data.find(b'\n', position)
+                position = length if line_end < 0 else line_end + 1
+            line_end = data.find(b'\n', position)
+            if line_end < 0 or data[position:line_end].rstrip(b'\r') != b'{':
+                self.position = position
+                continue
+            start = line_end + 1
+
+            # the string ends with a line which holds just the closing brace
+            end = start - 1
+            while True:
+                end = data.find(b'\n}', end)
+                if end < 0:
+                    end = position = length
+                    break
+                position = end + 2
+                if data[position:position + 1] in (b'\n', b'') or \
+                   data[position:position + 2] == b'\r\n':
+                    break
+                end += 1
+
+            self.position = position
+            if number not in self.spans:
+                self.spans[number] = (start, end)
+            return number
+
+        self.position = length
+        return None
+
+    def __len__(self):
+        while self._next_block() is not None:
+            pass
+        return len(self.spans)
+
+    def get(self, number, default=None):
+        """Returns the string with the given number."""
+        while number not in self.spans:
+            if self._next_block() is None:
+                return default
+
+        start, end = self.spans[number]
+        value = self.data[start:end].decode('utf-8', 'replace')
+        return value.replace('\r\n', '\n').replace('\r', '\n').strip('\n')
+
+    def __getitem__(self, reference):
+        """Returns the string a TRIGSTR_xxx reference points to."""
+        digits = reference[reference.find('TRIGSTR_') + 8:]
+        length = 0
+        while length < len(digits) and digits[length].isdigit():
+            length += 1
+
+        value = None
+        if length:
+            value = self.get(int(digits[:length]))
+        if value is None:
+            raise KeyError(reference)
+
+        return value